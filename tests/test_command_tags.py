@@ -94,6 +94,18 @@ class TestCommandTagsHelpers(TestCommandTagsBase):
         assert 'test_nikola' in new_tags[0]
         assert set(new_tags[0]) == set(new_parsed_tags)
 
+    def test_add_workers(self):
+        self._add_test_post(title='2', tags=['python'])
+        self._force_scan()
+        posts = [os.path.join('posts', post) for post in os.listdir('posts')]
+        tags = 'test_nikola'
+
+        add_tags(self._site, tags, posts, workers=2)
+
+        for post in posts:
+            assert 'test_nikola' in self._parse_new_tags(post)
+        assert not [name for name in os.listdir('posts') if name.endswith('-tmp')]
+
     def test_add_dry_run(self):
         posts = [os.path.join('posts', post) for post in os.listdir('posts')]
         tags = 'test_nikola'
@@ -118,6 +130,19 @@ class TestCommandTagsHelpers(TestCommandTagsBase):
         tags = [tag for tag in tags if tag_pattern.search(tag)]
         assert len(tags) == 5
 
+    def test_auto_tag_cache(self, monkeypatch):
+        post = os.path.join('posts', os.listdir('posts')[0])
+        tagger = _AutoTag(self._site, use_nltk=False, cache_folder='cache')
+        tags = tagger.tag(post)
+        assert os.path.isfile(os.path.join('cache', 'autotag.json'))
+
+        # unchanged posts are not read again.
+        def fail(self, post):
+            raise AssertionError('{0} was read again'.format(post.source_path))
+        monkeypatch.setattr(_AutoTag, '_get_post_text', fail)
+        cached_tagger = _AutoTag(self._site, use_nltk=False, cache_folder='cache')
+        assert cached_tagger.tag(post) == tags
+
     def test_auto_tag_nltk(self):
         post = os.path.join('posts', os.listdir('posts')[0])
         tagger = _AutoTag(self._site)
@@ -0,0 +1,85 @@
+import os
+from textwrap import dedent
+
+from v7.graphviz.graphviz import Graphviz, Plugin, cache_path, find_graphs, render_dot
+
+
+def test_find_graphs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'file.dot').write_text('graph file {}')
+    text = dedent('''\
+        Some text.
+
+        .. graphviz::
+
+           digraph foo {
+               "bar" -> "baz";
+           }
+
+        .. digraph::
+           :alt: Title
+
+              "a" -> "b";
+
+        * A list item
+
+          .. graph::
+             :inline:
+
+             "c" -- "d";
+
+        Not part of the graph.
+
+        .. graphviz:: file.dot
+
+        .. graphviz:: missing.dot
+    ''')
+    assert list(find_graphs(text)) == [
+        'digraph foo {\n    "bar" -> "baz";\n}',
+        'digraph "Title" {\n   "a" -> "b";\n};',
+        'graph "" {\n"c" -- "d";\n};',
+        'graph file {}',
+    ]
+
+
+def test_render_dot_cache_hit(tmp_path):
+    cache_folder = str(tmp_path / 'cache')
+    path = cache_path(cache_folder, 'no-such-dot', 'graph {}')
+    os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as outf:
+        outf.write(b'<svg/>')
+
+    # dot is never run for a cached graph
+    assert render_dot('no-such-dot', 'graph {}', cache_folder) == (0, b'<svg/>', b'')
+    assert cache_path(cache_folder, 'no-such-dot', 'graph {}') != cache_path(cache_folder, 'dot', 'graph {}')
+
+
+class FakePost(object):
+    class compiler(object):
+        name = 'rest'
+
+    def __init__(self, source):
+        self.source = source
+
+    def translated_source_path(self, lang):
+        return self.source
+
+
+class FakeSite(object):
+    config = {'TRANSLATIONS': {'en': ''}}
+
+    def __init__(self, timeline):
+        self.timeline = timeline
+
+
+def test_prerender_without_dot(tmp_path, monkeypatch):
+    source = tmp_path / 'post.rst'
+    source.write_text('.. graphviz::\n\n   graph {}\n')
+    monkeypatch.setattr(Graphviz, 'dot_path', 'no-such-dot', raising=False)
+    monkeypatch.setattr(Graphviz, 'cache_folder', str(tmp_path / 'cache'))
+    plugin = Plugin()
+    plugin.workers = 2
+
+    # The directive reports the error when the post is compiled
+    plugin.prerender(FakeSite([FakePost(str(source))]))
+    assert not (tmp_path / 'cache').exists()
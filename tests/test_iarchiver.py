@@ -0,0 +1,60 @@
+import threading
+from datetime import datetime, timedelta
+
+import dateutil.tz
+import pytest
+
+from nikola.log import get_logger
+from v7.iarchiver.iarchiver import Journal, Submitter
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+
+class ArchiveHandler(BaseHTTPRequestHandler):
+    """Stands in for web.archive.org/save: 'flaky' fails once, 'missing' always."""
+
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(self.path)
+        if self.path.endswith('missing') or (self.path.endswith('flaky') and self.requests.count(self.path) == 1):
+            self.send_response(404 if self.path.endswith('missing') else 503)
+        else:
+            self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def save_url():
+    ArchiveHandler.requests = []
+    server = HTTPServer(('127.0.0.1', 0), ArchiveHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield 'http://127.0.0.1:{0}/save/{{0}}'.format(server.server_port)
+    server.shutdown()
+
+
+def test_submit_retries_and_journal(tmp_path, save_url):
+    journal_path = str(tmp_path / 'cache' / 'iarchiver.jsonl')
+    urls = ['http://example.com/ok', 'http://example.com/flaky', 'http://example.com/missing']
+    submitter = Submitter(save_url, Journal(journal_path), get_logger('test'), rate=100, backoff=0)
+
+    assert submitter.submit(urls) == 2
+    assert ArchiveHandler.requests.count('/save/http://example.com/flaky') == 2
+    assert ArchiveHandler.requests.count('/save/http://example.com/missing') == 1
+
+    # A new run sees what was archived, and what failed
+    journal = Journal(journal_path)
+    before = datetime.now(dateutil.tz.tzutc()) - timedelta(days=1)
+    assert journal.archived_since('http://example.com/ok', before)
+    assert journal.archived_since('http://example.com/flaky', before)
+    assert not journal.archived_since('http://example.com/ok', before + timedelta(days=2))
+    assert journal.failed('http://example.com/missing')
+    assert not journal.failed('http://example.com/ok')
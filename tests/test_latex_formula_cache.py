@@ -0,0 +1,54 @@
+import os
+
+import pytest
+
+from v7.latex_formula_renderer.latex_formula_cache import LaTeXFormulaCacheCommand
+from v7.latex_formula_renderer.latex_formula_renderer import LaTeXFormulaRendererPlugin
+
+USED = ('x^2', (0, 0, 0), 1.0, 'inline', 'latex')
+UNUSED = ('y^2', (0, 0, 0), 1.0, 'inline', 'latex')
+
+
+class FakeSite(object):
+    debug = True
+
+    def __init__(self, config, collectors):
+        self.config = {'CACHE_FOLDER': 'cache', 'OUTPUT_FOLDER': 'output'}
+        self.config.update(config)
+        self.latex_formula_collectors = collectors
+
+    def scan_posts(self):
+        pass
+
+
+def run_gc(config, collectors):
+    """Cache two formulae, run --gc and return its result and the cached files left."""
+    site = FakeSite(config, collectors)
+    renderer = LaTeXFormulaRendererPlugin()
+    renderer.set_site(site)
+    formula_cache = renderer.get_formula_cache()
+    for base_name in formula_cache.get_base_names([USED, UNUSED]):
+        formula_cache.put_content_into_cache(base_name + '.png', b'png')
+    command = LaTeXFormulaCacheCommand()
+    command.site = site
+    result = command._execute({'gc': True, 'compact': False}, [])
+    files = sorted(fn for fn in os.listdir(os.path.join('cache', 'formulae')) if fn.endswith('.png'))
+    return result, files
+
+
+def test_gc_removes_unused_formulae(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    result, files = run_gc({}, [lambda: [USED]])
+    assert result == 0
+    assert len(files) == 1
+
+
+@pytest.mark.parametrize('config, collectors', [
+    ({'LATEX_FORMULA_AS_DATAURI': True}, [lambda: [USED]]),
+    ({}, []),
+])
+def test_gc_refused_without_complete_collectors(tmp_path, monkeypatch, config, collectors):
+    monkeypatch.chdir(tmp_path)
+    result, files = run_gc(config, collectors)
+    assert result == 1
+    assert len(files) == 2
@@ -0,0 +1,75 @@
+import json
+import os
+
+import pytest
+
+pytest.importorskip('mincss.processor')
+
+from v7.mincss import mincss as plugin  # noqa: E402
+
+CSS = '''body { color: red }
+.used { color: blue }
+.unused, .later { color: green }
+@media (max-width: 10px) { .used { margin: 0 } .gone { margin: 1px } }
+'''
+
+PAGE = '''<html><head><link rel="stylesheet" href="{0}assets/css/theme.css"></head>
+<body>{1}</body></html>
+'''
+
+
+class Site(object):
+    config = {'OUTPUT_FOLDER': 'output', 'CACHE_FOLDER': 'cache'}
+
+
+def write(path, text):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as outf:
+        outf.write(text)
+
+
+def run():
+    command = plugin.CommandMincss()
+    command.site = Site()
+    command._execute({'incremental': True, 'workers': 2}, [])
+    with open(os.path.join('output', 'assets', 'css', 'theme.css')) as inf:
+        return inf.read()
+
+
+def test_incremental_reuses_page_cache(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write(os.path.join('output', 'assets', 'css', 'theme.css'), CSS)
+    write(os.path.join('output', 'index.html'), PAGE.format('', '<p class="used"></p>'))
+    write(os.path.join('output', 'a', 'index.html'), PAGE.format('../', '<p></p>'))
+
+    css = run()
+    assert '.used { color: blue }' in css
+    assert 'unused' not in css and 'later' not in css and 'gone' not in css
+    with open(os.path.join('cache', 'mincss.json')) as inf:
+        cache = json.load(inf)
+    assert len(cache['pages']) == 2
+
+    # Nothing changed: no page is matched again, and the CSS is left alone.
+    def fail(*args, **kwargs):
+        raise AssertionError('pages were matched again')
+    executor = plugin.ProcessPoolExecutor
+    monkeypatch.setattr(plugin, 'ProcessPoolExecutor', fail)
+    mtime = os.stat(os.path.join('output', 'assets', 'css', 'theme.css')).st_mtime
+    assert run() == css
+    assert os.stat(os.path.join('output', 'assets', 'css', 'theme.css')).st_mtime == mtime
+    monkeypatch.setattr(plugin, 'ProcessPoolExecutor', executor)
+
+    # A changed page brings back rules from the original CSS.
+    write(os.path.join('output', 'a', 'index.html'), PAGE.format('../', '<p class="later"></p>'))
+    css = run()
+    assert '.later { color: green }' in css
+    assert 'unused' not in css
+    with open(os.path.join('cache', 'mincss.json')) as inf:
+        assert len(json.load(inf)['pages']) == 2
+
+
+def test_unsupported_version(monkeypatch):
+    assert plugin.ProcessorAdapter.supported()
+    monkeypatch.setattr(plugin, 'mincss_version', '0.12.0')
+    assert not plugin.ProcessorAdapter.supported()
@@ -1,9 +1,15 @@
 import os
+import sys
 from textwrap import dedent
 from typing import Dict
 
+import pytest
+from doit.cmd_base import ModuleTaskLoader
+from doit.doit_cmd import DoitMain
+
+from nikola.log import get_logger
 from tests import execute_plugin_tasks
-from v8.plantuml.plantuml import PlantUmlTask
+from v8.plantuml.plantuml import PlantUmlCache, PlantUmlServer, PlantUmlTask
 
 
 # Note this test is also sufficient to prove that rendering binary image files will work
@@ -76,6 +82,82 @@ def test_render_file_error(tmp_site_path):
     ]
 
 
+@pytest.mark.skipif('PLANTUML_SERVER_TESTS' not in os.environ, reason='PlantUML picoweb "POST /render" needs PlantUML >= 1.2021.5')
+def test_render_file_server(tmp_site_path):
+    (tmp_site_path / 'pages' / 'one.puml').write_text('@startuml\nparticipant "one ✓"\n@enduml\n', encoding='utf8')
+    (tmp_site_path / 'pages' / 'two.puml').write_text('@startuml\nparticipant "two"\n@enduml\n', encoding='utf8')
+
+    plugin = create_plugin({
+        'PLANTUML_FILES': (
+            ('pages/*.puml', '', '.txt', ['-tutxt']),
+        ),
+        'PLANTUML_SERVER': True,
+    })
+
+    try:
+        execute_plugin_tasks(plugin)
+    finally:
+        plugin.plantuml_manager.server.stop()
+
+    assert 'one ✓' in (tmp_site_path / 'output' / 'one.txt').read_text(encoding='utf8')
+    assert 'two' in (tmp_site_path / 'output' / 'two.txt').read_text(encoding='utf8')
+
+
+STUB_SERVER = dedent('''\
+    import json, sys
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf8'))
+            bad = 'bad' in request['source']
+            self.send_response(400 if bad else 200)
+            if bad:
+                self.send_header('X-PlantUML-Diagram-Error', 'Syntax Error?')
+                self.send_header('X-PlantUML-Diagram-Error-Line', '2')
+            self.end_headers()
+            self.wfile.write(' '.join(request['options'] + [request['source']]).encode('utf8'))
+
+        def log_message(self, *args):
+            pass
+
+    port = int(sys.argv[1].split(':')[1])
+    HTTPServer(('127.0.0.1', port), Handler).serve_forever()
+''')
+
+
+def test_server_with_stub(tmp_path):
+    (tmp_path / 'stub.py').write_text(STUB_SERVER)
+    server = PlantUmlServer([sys.executable, str(tmp_path / 'stub.py')], get_logger('test'), 30)
+    try:
+        assert server.render('@startuml\n✓\n@enduml'.encode('utf8'), ['-tutxt']) == \
+            ('-tutxt @startuml\n✓\n@enduml'.encode('utf8'), None)
+        assert server.render(b'@startuml\nbad\n@enduml', []) == \
+            (b'@startuml\nbad\n@enduml', 'PlantUML error (line 2): Syntax Error?')
+    finally:
+        server.stop()
+
+
+def test_server_start_failure_is_an_error_result(tmp_site_path):
+    (tmp_site_path / 'pages' / 'test.puml').write_text('@startuml\n@enduml\n')
+    plugin = create_plugin({
+        'PLANTUML_FILES': (
+            ('pages/*.puml', '', '.txt', ['-tutxt']),
+        ),
+        'PLANTUML_SERVER': True,
+    })
+    plugin.plantuml_manager.server.exec = [sys.executable, '-c', 'import sys; sys.exit(3)']
+
+    error = 'PlantUML server failed to start (return code 3)'
+    assert plugin.plantuml_manager.render(b'@startuml\n@enduml', []) == (b'', error)
+    # The failure is remembered rather than retried for every diagram
+    plugin.plantuml_manager.server.exec = ['no-such-plantuml']
+    assert plugin.plantuml_manager.render(b'@startuml\n@enduml', []) == (b'', error)
+
+    with pytest.raises(Exception, match='failed to start'):
+        execute_plugin_tasks(plugin)
+
+
 def test_gen_tasks(tmp_site_path):
     (tmp_site_path / 'pages' / 'b').mkdir(parents=True)
     (tmp_site_path / 'other' / 'diagrams' / 'd').mkdir(parents=True)
@@ -102,6 +184,66 @@ def test_gen_tasks(tmp_site_path):
     ]
 
 
+def test_gen_batch_task(tmp_site_path):
+    (tmp_site_path / 'pages' / 'b').mkdir(parents=True)
+    (tmp_site_path / 'pages' / 'aaa.puml').touch()
+    (tmp_site_path / 'pages' / 'b' / 'bbb.puml').touch()
+
+    plugin = create_plugin({
+        'PLANTUML_ARGS': ['-Iincludes/include1.iuml'],
+        'PLANTUML_BATCH': True,
+        'PLANTUML_FILES': (
+            ('pages/*.puml', '', '.txt', []),
+        ),
+    })
+
+    tasks = plugin_tasks(plugin)
+
+    assert len(tasks) == 1
+    assert sorted(tasks[0]['targets']) == ['output/aaa.txt', 'output/b/bbb.txt']
+    assert sorted(tasks[0]['file_dep']) == ['includes/include1.iuml', 'pages/aaa.puml', 'pages/b/bbb.puml']
+
+
+def test_render_batch_only_renders_stale_files(tmp_site_path, monkeypatch):
+    for name in ('aaa', 'bbb', 'ccc'):
+        (tmp_site_path / 'pages' / name).with_suffix('.puml').write_text(name)
+
+    plugin = create_plugin({
+        'PLANTUML_BATCH': True,
+        'PLANTUML_FILES': (
+            ('pages/*.puml', '', '.txt', []),
+        ),
+        'PLANTUML_WORKERS': 2,
+    })
+    rendered = []
+
+    def render_file(src, dst, args):
+        rendered.append(str(src))
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        dst.write_bytes(src.read_bytes())
+
+    monkeypatch.setattr(plugin, 'render_file', render_file)
+
+    run_doit(plugin)
+    assert sorted(rendered) == ['pages/aaa.puml', 'pages/bbb.puml', 'pages/ccc.puml']
+
+    # doit passes every file_dep as 'changed' because ccc.txt is missing, still only aaa & ccc are stale
+    rendered.clear()
+    (tmp_site_path / 'pages' / 'aaa.puml').write_text('changed')
+    (tmp_site_path / 'output' / 'ccc.txt').unlink()
+    run_doit(plugin)
+    assert sorted(rendered) == ['pages/aaa.puml', 'pages/ccc.puml']
+
+    rendered.clear()
+    run_doit(plugin)
+    assert rendered == []
+
+    # A config change re-renders every file
+    plugin._common_args = ['-DX=1']
+    run_doit(plugin)
+    assert sorted(rendered) == ['pages/aaa.puml', 'pages/bbb.puml', 'pages/ccc.puml']
+
+
 def test_task_depends_on_included_files(tmp_site_path):
     plugin = create_plugin({
         'PLANTUML_ARGS': [
@@ -128,6 +270,79 @@ def test_task_depends_on_included_files(tmp_site_path):
     ]
 
 
+def test_cache_key_depends_only_on_referenced_includes(tmp_site_path):
+    (tmp_site_path / 'used.iuml').write_text('participant used\n!include nested.iuml')
+    (tmp_site_path / 'nested.iuml').write_text('participant nested')
+    (tmp_site_path / 'unused.iuml').write_text('participant unused')
+    cache = PlantUmlCache(tmp_site_path / 'cache', 1000, get_logger('test'))
+
+    def key():
+        return cache.key(b'@startuml\n!include used.iuml\n@enduml', ['-tsvg'], 'PlantUML version 1')
+
+    original = key()
+    assert key() == original
+
+    (tmp_site_path / 'unused.iuml').write_text('participant changed')
+    assert key() == original
+
+    (tmp_site_path / 'nested.iuml').write_text('participant changed')
+    assert key() != original
+
+    assert cache.key(b'@startuml\n@enduml', ['-tsvg'], 'PlantUML version 1') \
+        != cache.key(b'@startuml\n@enduml', ['-tpng'], 'PlantUML version 1') \
+        != cache.key(b'@startuml\n@enduml', ['-tpng'], 'PlantUML version 2')
+
+
+def test_cache_key_resolves_includes_relative_to_including_file(tmp_site_path):
+    (tmp_site_path / 'pages' / 'inc').mkdir(parents=True)
+    (tmp_site_path / 'pages' / 'inc' / 'outer.iuml').write_text('!include inner.iuml')
+    (tmp_site_path / 'pages' / 'inc' / 'inner.iuml').write_text('participant inner')
+    (tmp_site_path / 'inner.iuml').write_text('participant decoy')
+    source = b'@startuml\n!include inc/outer.iuml\n@enduml'
+    cache = PlantUmlCache(tmp_site_path / 'cache', 1000, get_logger('test'))
+
+    def key():
+        return cache.key(source, [], 'PlantUML version 1', tmp_site_path / 'pages' / 'diagram.puml')
+
+    original = key()
+    (tmp_site_path / 'inner.iuml').write_text('participant changed')
+    assert key() == original
+
+    (tmp_site_path / 'pages' / 'inc' / 'inner.iuml').write_text('participant changed')
+    assert key() != original
+
+
+def test_cache_evicts_least_recently_used(tmp_site_path):
+    cache = PlantUmlCache(tmp_site_path / 'cache', 25, get_logger('test'))
+    cache.put('aa1', b'1' * 10)
+    cache.put('bb2', b'2' * 10)
+    assert cache.get('aa1') == b'1' * 10
+    cache.put('cc3', b'3' * 10)
+
+    assert cache.get('bb2') is None
+    assert cache.get('aa1') == b'1' * 10
+    assert cache.get('cc3') == b'3' * 10
+
+    # A new instance sees the same files
+    assert PlantUmlCache(tmp_site_path / 'cache', 25, get_logger('test')).get('cc3') == b'3' * 10
+
+
+def test_cache_ignores_and_removes_stale_temp_files(tmp_site_path):
+    cache = PlantUmlCache(tmp_site_path / 'cache', 100, get_logger('test'))
+    cache.put('aa1', b'1' * 10)
+    old = tmp_site_path / 'cache' / 'aa' / 'tmpold.tmp'
+    old.write_bytes(b'x' * 10)
+    os.utime(str(old), (0, 0))
+    recent = tmp_site_path / 'cache' / 'aa' / 'tmprecent.tmp'
+    recent.write_bytes(b'x' * 10)
+
+    cache = PlantUmlCache(tmp_site_path / 'cache', 100, get_logger('test'))
+    assert cache.get('aa1') == b'1' * 10
+    assert cache._size == 10
+    assert not old.exists()
+    assert recent.exists()
+
+
 def create_plugin(config: Dict):
     plugin = PlantUmlTask()
     plugin.set_site(FakeSite(config))
@@ -148,6 +363,12 @@ class FakeSite:
             self.config['PLANTUML_EXEC'] = os.environ['PLANTUML_EXEC'].split()
 
 
+def run_doit(plugin):
+    """Runs the plugin's tasks through doit, so actions get doit's real 'changed'"""
+    loader = ModuleTaskLoader({'task_' + plugin.name: plugin.gen_tasks})
+    assert DoitMain(loader).run(['--db-file', '.doit.db']) == 0
+
+
 def plugin_tasks(plugin):
     tasks = list(plugin.gen_tasks())
     assert tasks.pop(0) == plugin.group_task()
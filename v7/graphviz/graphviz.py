@@ -26,8 +26,13 @@
 
 import hashlib
 import os
+import re
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from subprocess import Popen, PIPE
 
+import blinker
+
 from docutils import nodes
 from docutils.parsers.rst import Directive, directives
 from docutils.statemachine import StringList
@@ -35,6 +40,9 @@ from docutils.statemachine import StringList
 from nikola.plugin_categories import RestExtension
 from nikola.utils import LOGGER, makedirs
 
+DIRECTIVE_RE = re.compile(r'^(?P<indent>[ \t]*)\.\.[ \t]+(?P<name>graphviz|graph|digraph)::[ \t]*(?P<argument>\S*)[ \t]*$')
+OPTION_RE = re.compile(r'^:(?P<name>[\w-]+):[ \t]*(?P<value>.*)$')
+
 
 class Plugin(RestExtension):
 
@@ -49,8 +57,106 @@ class Plugin(RestExtension):
         Graphviz.output_folder = self.site.config.get('GRAPHVIZ_OUTPUT', 'output/assets/graphviz')
         Graphviz.graph_path = self.site.config.get('GRAPHVIZ_GRAPH_PATH', '/assets/graphviz/')
         Graphviz.dot_path = self.site.config.get('GRAPHVIZ_DOT', 'dot')
+        prerender = self.site.config.get('GRAPHVIZ_PRERENDER', False)
+        if self.site.config.get('GRAPHVIZ_CACHE', False) or prerender:
+            Graphviz.cache_folder = os.path.join(self.site.config['CACHE_FOLDER'], 'graphviz')
+        if prerender:
+            self.workers = self.site.config.get('GRAPHVIZ_WORKERS', None) or os.cpu_count() or 1
+            blinker.signal('scanned').connect(self.prerender)
         return super(Plugin, self).set_site(site)
 
+    def prerender(self, site):
+        """Render the graphs of all reST posts into the cache, before any post is compiled."""
+        graphs = set()
+        for post in site.timeline:
+            if post.compiler.name != 'rest':
+                continue
+            for lang in site.config['TRANSLATIONS']:
+                source = post.translated_source_path(lang)
+                if not os.path.isfile(source):
+                    continue
+                with open(source, 'rb') as inf:
+                    graphs.update(find_graphs(inf.read().decode('utf-8')))
+        missing = [data for data in graphs if not os.path.exists(cache_path(Graphviz.cache_folder, Graphviz.dot_path, data))]
+        if not missing:
+            return
+        LOGGER.info("Graphviz: rendering {0} graphs using {1} workers".format(len(missing), self.workers))
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            list(executor.map(self._prerender_graph, missing))
+
+    @staticmethod
+    def _prerender_graph(data):
+        # Errors, including a missing dot, are reported later by the directive
+        try:
+            render_dot(Graphviz.dot_path, data, Graphviz.cache_folder)
+        except OSError:
+            pass
+
+
+def find_graphs(text):
+    """Yield the DOT source of every graph directive in reST text, as the directives will see it."""
+    lines = text.splitlines()
+    i = 0
+    while i < len(lines):
+        match = DIRECTIVE_RE.match(lines[i])
+        i += 1
+        if not match:
+            continue
+        indent = len(match.group('indent'))
+        block = []
+        while i < len(lines) and (not lines[i].strip() or len(lines[i]) - len(lines[i].lstrip()) > indent):
+            block.append(lines[i])
+            i += 1
+        while block and not block[-1].strip():
+            block.pop()
+        margin = min((len(line) - len(line.lstrip()) for line in block if line.strip()), default=0)
+        block = [line[margin:] for line in block]
+        options = {}
+        while block and OPTION_RE.match(block[0]):
+            option = OPTION_RE.match(block.pop(0))
+            options[option.group('name')] = option.group('value')
+        while block and not block[0].strip():
+            block.pop(0)
+        if match.group('argument'):
+            try:
+                with open(match.group('argument'), 'rb') as inf:
+                    yield inf.read().decode('utf-8')
+            except IOError:
+                pass
+        elif match.group('name') == 'graphviz':
+            yield '\n'.join(block)
+        else:
+            yield '\n'.join(['{0} "{1}" {{'.format(match.group('name'), options.get('alt', ''))] + block + ['};'])
+
+
+def cache_path(cache_folder, dot_path, data):
+    """Path of the cached SVG for DOT source rendered with dot_path."""
+    key = hashlib.sha256('\0'.join([dot_path, '-Tsvg', data]).encode('utf8')).hexdigest()
+    return os.path.join(cache_folder, key[:2], key + '.svg')
+
+
+def render_dot(dot_path, data, cache_folder=None):
+    """Render DOT source to SVG, returns (return code, svg_data, errors).
+
+    Successful renders are stored in, and taken from, cache_folder if it is not None.
+    """
+    if cache_folder:
+        path = cache_path(cache_folder, dot_path, data)
+        try:
+            with open(path, 'rb') as inf:
+                return 0, inf.read(), b''
+        except IOError:
+            pass
+    p = Popen([dot_path, '-Tsvg'], stdin=PIPE, stdout=PIPE, stderr=PIPE)
+    svg_data, errors = p.communicate(input=data.encode('utf8'))
+    code = p.wait()
+    if cache_folder and not code:
+        makedirs(os.path.dirname(path))
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as outf:
+            outf.write(svg_data)
+        os.replace(outf.name, path)
+    return code, svg_data, errors
+
 
 class Graphviz(Directive):
     """ Restructured text extension for inserting graphs as SVG
@@ -68,6 +174,7 @@ class Graphviz(Directive):
     required_arguments = 0
     optional_arguments = 1
     ignore_alt = True
+    cache_folder = None
     option_spec = {
         'alt': directives.unchanged,
         'inline': directives.flag,
@@ -88,9 +195,7 @@ class Graphviz(Directive):
             data = '\n'.join(self.content)
         node_list = []
         try:
-            p = Popen([self.dot_path, '-Tsvg'], stdin=PIPE, stdout=PIPE, stderr=PIPE)
-            svg_data, errors = p.communicate(input=data.encode('utf8'))
-            code = p.wait()
+            code, svg_data, errors = render_dot(self.dot_path, data, self.cache_folder)
             if code:  # Some error
                 document = self.state.document
                 return [document.reporter.error(
@@ -26,14 +26,18 @@
 
 from __future__ import print_function
 import codecs
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+import json
 import os
 import sys
+import threading
 import time
+import dateutil.parser
 import dateutil.tz
 
 from nikola.plugin_categories import Command
-from nikola.utils import get_logger, STDERR_HANDLER
+from nikola.utils import get_logger, makedirs, STDERR_HANDLER
 
 if sys.version_info[0] == 2:
     import robotparser as robotparser
@@ -44,6 +48,142 @@ elif sys.version_info[0] >= 3:
     from urllib.parse import urljoin
     import urllib.request as web_browser
 
+try:
+    from urllib.error import HTTPError
+except ImportError:
+    from urllib2 import HTTPError  # NOQA
+
+
+class TokenBucket(object):
+    """Allow `rate` requests per second on average, in bursts of up to `capacity`."""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Wait until a request may be sent."""
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class Journal(object):
+    """The outcome of every archive request, kept in a JSON lines file.
+
+    Each result is appended (and flushed) as soon as it is known, so an
+    interrupted run loses nothing; the file is compacted when loaded.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.lock = threading.Lock()
+        if os.path.isfile(path):
+            with codecs.open(path, 'rb', 'utf8') as inf:
+                for line in inf:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:  # Truncated by an interruption
+                        continue
+                    self.entries[entry['url']] = entry
+        makedirs(os.path.dirname(path))
+        with codecs.open(path, 'wb+', 'utf8') as outf:
+            for entry in self.entries.values():
+                outf.write(json.dumps(entry) + '\n')
+
+    def archived_since(self, url, date):
+        """Return True if url was archived at or after date."""
+        entry = self.entries.get(url)
+        return (entry is not None and entry['status'] == 'archived' and
+                dateutil.parser.parse(entry['time']) >= date)
+
+    def failed(self, url):
+        """Return True if the last request for url failed."""
+        entry = self.entries.get(url)
+        return entry is not None and entry['status'] == 'failed'
+
+    def record(self, url, status, attempts, error=None):
+        entry = {
+            'url': url,
+            'status': status,
+            'attempts': attempts,
+            'time': datetime.now(dateutil.tz.tzutc()).isoformat(),
+        }
+        if error is not None:
+            entry['error'] = error
+        with self.lock:
+            self.entries[url] = entry
+            with codecs.open(self.path, 'ab', 'utf8') as outf:
+                outf.write(json.dumps(entry) + '\n')
+
+
+class Submitter(object):
+    """Send archive requests from a pool of threads.
+
+    Requests are rate limited with a token bucket (shared by all threads),
+    and retried with exponential backoff on network errors, HTTP 429 and
+    server errors.
+    """
+
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, save_url, journal, logger, workers=4, rate=0.25,
+                 retries=3, backoff=10, timeout=60):
+        self.save_url = save_url
+        self.journal = journal
+        self.logger = logger
+        self.workers = workers
+        self.bucket = TokenBucket(rate)
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+    def archive(self, url):
+        """Send the archive request for url, return (attempts, error)."""
+        attempt = 0
+        while True:
+            attempt += 1
+            self.bucket.acquire()
+            try:
+                """ Intentionally not urlencoded """
+                web_browser.urlopen(self.save_url.format(url), timeout=self.timeout).read()
+                return attempt, None
+            except Exception as e:
+                if isinstance(e, HTTPError) and e.code not in self.RETRY_STATUSES:
+                    return attempt, str(e)
+                if attempt > self.retries:
+                    return attempt, str(e)
+                self.logger.debug("==> retrying {0} after: {1}".format(url, e))
+            time.sleep(self.backoff * 2 ** (attempt - 1))
+
+    def submit(self, urls):
+        """Archive all urls, return the number of successful requests."""
+        archived = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = dict((executor.submit(self.archive, url), url) for url in urls)
+            for future in as_completed(futures):
+                url = futures[future]
+                attempts, error = future.result()
+                if error is None:
+                    self.journal.record(url, 'archived', attempts)
+                    self.logger.info("==> sent archive request for {0}".format(url))
+                    archived += 1
+                else:
+                    self.journal.record(url, 'failed', attempts, error)
+                    self.logger.warn("==> unknown problem when archiving {0}: ({1})".format(url, error))
+        return archived
+
 
 class Iarchiver(Command):
     """Archive site updates."""
@@ -74,34 +214,38 @@ class Iarchiver(Command):
             last_iarchivedate = datetime(1970, 1, 1).replace(tzinfo=dateutil.tz.tzutc())
             firstrun = True
 
-        self.site.scan_posts()
+        journal = Journal(os.path.join(self.site.config['CACHE_FOLDER'], 'iarchiver.jsonl'))
 
-        sent_requests = False
-        self.logger.info("Beginning submission of archive requests. This can take some time....")
+        self.site.scan_posts()
 
+        urls = []
         for post in self.site.timeline:
             if post.is_draft or post.publish_later:
                 continue
-            postdate = datetime.strptime(post.formatted_date("%Y-%m-%dT%H:%M:%S"), "%Y-%m-%dT%H:%M:%S")
-            postdate_sitetime = self.site.tzinfo.localize(postdate)
-            postdate_utc = postdate_sitetime.astimezone(dateutil.tz.tzutc())
-            if (firstrun or last_iarchivedate <= postdate_utc):
-                post_permalink = post.permalink(absolute=True)
-                archival_request = "http://web.archive.org/save/{0}".format(post_permalink)
+            post_permalink = post.permalink(absolute=True)
+            if journal.archived_since(post_permalink, post.date):
+                """ Already done, maybe by an interrupted run """
+                continue
+            # post.date is timezone-aware, in the site's timezone
+            if (firstrun or last_iarchivedate <= post.date or journal.failed(post_permalink)):
                 if (iatestbot.can_fetch("ia_archiver", post_permalink)):
-                    try:
-                        """ Intentionally not urlencoded """
-                        web_browser.urlopen(archival_request).read()
-                        self.logger.info("==> sent archive request for {0}".format(post_permalink))
-                    except Exception as e:
-                        self.logger.warn("==> unknown problem when archiving {0}: ({1})".format(post_permalink, e))
-
-                    """ Throttle requests """
-                    time.sleep(4)
-                    sent_requests = True
+                    urls.append(post_permalink)
                 else:
                     self.logger.warn("==> /robots.txt directives blocked archiving of ({0})".format(post_permalink))
 
+        self.logger.info("Beginning submission of {0} archive requests. This can take some time....".format(len(urls)))
+
+        submitter = Submitter(
+            self.site.config.get('IARCHIVER_SAVE_URL', 'http://web.archive.org/save/{0}'),
+            journal,
+            self.logger,
+            workers=self.site.config.get('IARCHIVER_WORKERS', 4),
+            rate=self.site.config.get('IARCHIVER_RATE', 0.25),
+            retries=self.site.config.get('IARCHIVER_RETRIES', 3),
+            backoff=self.site.config.get('IARCHIVER_BACKOFF', 10),
+        )
+        sent_requests = submitter.submit(urls) > 0
+
         """ Record archival time """
         with codecs.open(timestamp_path, 'wb+', 'utf8') as outf:
             outf.write(new_iarchivedate.strftime("%Y-%m-%dT%H:%M:%S.%f%z"))
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+# Copyright © 2014-2017 Felix Fontein
+#
+# Permission is hereby granted, free of charge, to any
+# person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the
+# Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice
+# shall be included in all copies or substantial portions of
+# the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY
+# KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS
+# OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Provide the Nikola command latex_formula_cache, which maintains the cache of the LaTeX formula renderer."""
+
+from nikola.plugin_categories import Command
+from nikola import utils
+
+_LOGGER = utils.get_logger('latex_formula_cache', utils.STDERR_HANDLER)
+
+
+class LaTeXFormulaCacheCommand(Command):
+    """Remove unused formulae from the LaTeX formula cache and compact its database."""
+
+    name = 'latex_formula_cache'
+
+    doc_usage = "[--gc] [--compact]"
+    doc_purpose = "maintain the cache of the LaTeX formula renderer"
+    doc_description = ("Without options, show the number of formulae used by the site. "
+                       "Formulae which are only rendered directly (not announced by a formula collector) "
+                       "count as unused and will be rendered again when needed. "
+                       "--gc does nothing with LATEX_FORMULA_AS_DATAURI, or when no formula collector is registered.")
+    cmd_options = [
+        {
+            'name': 'gc',
+            'long': 'gc',
+            'default': False,
+            'type': bool,
+            'help': "Forget formulae no post uses any more and delete their cached images",
+        },
+        {
+            'name': 'compact',
+            'long': 'compact',
+            'default': False,
+            'type': bool,
+            'help': "Compact the formula database",
+        },
+    ]
+
+    def _execute(self, options, args):
+        """Run the command."""
+        renderer = getattr(self.site, 'latex_formula_renderer', None)
+        if renderer is None:
+            utils.req_missing(['latex_formula_renderer'], 'use the latex_formula_cache command', python=False)
+            return 1
+        formula_cache = renderer.get_formula_cache()
+
+        self.site.scan_posts()
+        formulae = renderer.collect_formulae()
+        _LOGGER.info("The site uses {0} distinct formulae.".format(len(formulae)))
+
+        result = 0
+        if options['gc']:
+            # Every formula the collectors do not return counts as unused, so
+            # only collect garbage when they announce the formulae of all posts
+            if renderer.uses_data_URIs():
+                _LOGGER.warning("Not removing unused formulae: with LATEX_FORMULA_AS_DATAURI, formulae are "
+                                "rendered directly and not announced by formula collectors.")
+                result = 1
+            elif not self.site.latex_formula_collectors:
+                _LOGGER.warning("Not removing unused formulae: no formula collector is registered, "
+                                "so every formula would count as unused.")
+                result = 1
+            else:
+                used_base_names = formula_cache.get_base_names(formulae)
+                entries, files = formula_cache.collect_garbage(used_base_names)
+                _LOGGER.info("Removed {0} unused formulae and {1} cached files.".format(entries, files))
+        if options['compact']:
+            formula_cache.compact()
+            _LOGGER.info("Compacted formula database.")
+        return result
@@ -37,9 +37,13 @@ import tempfile
 import shutil
 import subprocess
 import base64
+import contextlib
 import json
+import re
+import sqlite3
 import threading
 import xml.etree.ElementTree
+from concurrent.futures import ThreadPoolExecutor
 
 from PIL import Image
 
@@ -303,92 +307,125 @@ class FormulaCache(object):
 
     def __get_database_file(self):
         """Get filename of formula filename database."""
-        return os.path.join(self.__cache_directory, "formulae.db.json")
+        return os.path.join(self.__cache_directory, "formulae.sqlite3")
 
-    def __create_empty_database(Self):
-        """Get empty formula filename database."""
-        return dict(), set()
+    def __get_json_database_file(self):
+        """Get filename of the formula filename database used by older versions."""
+        return os.path.join(self.__cache_directory, "formulae.db.json")
 
-    def __read_database(self):
-        """Read formula filename database. Always returns something valid."""
-        if self.__cache_directory is None:
-            return self.__create_empty_database()
-        if not self.__cache_directory_exists:
-            self.__cache_directory_exists = _ensure_dir_existence(self.__cache_directory)
+    def __get_connection(self):
+        """Open formula filename database if necessary. Must be called with the internal lock held."""
+        if self.__database is None:
+            if self.__cache_directory is None:
+                database_file = ':memory:'
+            else:
+                if not self.__cache_directory_exists:
+                    self.__cache_directory_exists = _ensure_dir_existence(self.__cache_directory)
+                database_file = self.__get_database_file()
+            # Autocommit mode; writes use explicit 'BEGIN IMMEDIATE' transactions,
+            # which lock the database against other processes
+            self.__database = sqlite3.connect(database_file, timeout=60, isolation_level=None, check_same_thread=False)
+            self.__database.execute("CREATE TABLE IF NOT EXISTS formulae (search_text TEXT PRIMARY KEY, base_name TEXT NOT NULL UNIQUE)")
+            if self.__cache_directory is not None:
+                self.__import_json_database()
+        return self.__database
+
+    def __import_json_database(self):
+        """Import the formula filename database of older versions, so that cached formulae keep their names."""
+        json_file = self.__get_json_database_file()
+        if not os.path.exists(json_file):
+            return
         try:
-            with open(self.__get_database_file(), "rb") as file:
+            with open(json_file, "rb") as file:
                 result = json.loads(file.read().decode('utf-8'))
             if type(result) != list or len(result) != 2 or type(result[0]) != dict or type(result[1]) != list:
                 raise Exception("Read database invalid!")
-            result[1] = set(result[1])
-            return result
+            with self.__transaction() as db:
+                db.executemany("INSERT OR IGNORE INTO formulae (search_text, base_name) VALUES (?, ?)", result[0].items())
+            os.replace(json_file, json_file + '.imported')
         except Exception as e:
-            _LOGGER.warn("Error on reading formulae database: {0}".format(e))
-            return self.__create_empty_database()
+            _LOGGER.warn("Error on importing formulae database: {0}".format(e))
 
-    def __write_database(self, db):
-        """Write formula filename database to cache."""
-        if self.__cache_directory is None:
-            return
-        if not self.__cache_directory_exists:
-            self.__cache_directory_exists = _ensure_dir_existence(self.__cache_directory)
+    @contextlib.contextmanager
+    def __transaction(self):
+        """Run a write transaction, holding the database lock against other processes."""
+        db = self.__database
+        db.execute("BEGIN IMMEDIATE")
         try:
-            new_db = [db[0], sorted(list(db[1]))]
-            with open(self.__get_database_file(), "wb") as file:
-                file.write(json.dumps(new_db, sort_keys=True).encode('utf-8'))
-        except Exception as e:
-            _LOGGER.warn("Error on writing formulae database: {0}".format(e))
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def __lookup(self, db, searchText):
+        row = db.execute("SELECT base_name FROM formulae WHERE search_text = ?", (searchText, )).fetchone()
+        return row[0] if row else None
+
+    def __insert(self, db, searchText):
+        """Insert new base name for searchText. Must be called inside a transaction."""
+        base_name = self.__lookup(db, searchText)
+        if base_name is not None:
+            # Another process was faster
+            return base_name
+        base_name = hashlib.sha224(searchText.encode(encoding="UTF-8", errors="replace")).digest()
+        base_name = str(base64.b64encode(base_name, altchars=b"_."), "UTF-8")[:-2]  # substring gets rid of final '=='
+        suffix = ""
+        counter = -1
+        while db.execute("SELECT 1 FROM formulae WHERE base_name = ?", (base_name + suffix, )).fetchone():
+            counter += 1
+            suffix = "-{0}".format(counter)
+        base_name += suffix
+        db.execute("INSERT INTO formulae (search_text, base_name) VALUES (?, ?)", (searchText, base_name))
+        return base_name
 
     def get_base_name(self, formula_type, formula, color, scale, engine):
         """Get base name for formula with given formula type, color and scale."""
-        searchText = self.__get_search_text(formula_type, formula, color, scale, engine)
-        with self.__internal_lock:
-            if self.__database is None:
-                self.__database = self.__read_database()
-            if searchText in self.__database[0]:
-                return self.__database[0][searchText]
-            else:
-                base_name = hashlib.sha224(searchText.encode(encoding="UTF-8", errors="replace")).digest()
-                base_name = str(base64.b64encode(base_name, altchars=b"_."), "UTF-8")[:-2]  # substring gets rid of final '=='
-                suffix = ""
-                counter = -1
-                while base_name + suffix in self.__database[1]:
-                    counter += 1
-                    suffix = "-{0}".format(counter)
-                base_name += suffix
-                self.__database[1].add(base_name)
-                self.__database[0][searchText] = base_name
-                self.__write_database(self.__database)
-                return base_name
+        return self.get_base_names([(formula, color, scale, formula_type, engine)])[0]
 
     def get_base_names(self, formula_color_scale_formula_type_list):
         """Get base name for formula with given formula type, color, scale and engine."""
-        result = []
-        changed = False
+        search_texts = [self.__get_search_text(formula_type, formula, color, scale, engine) for (formula, color, scale, formula_type, engine) in formula_color_scale_formula_type_list]
         with self.__internal_lock:
-            if self.__database is None:
-                self.__database = self.__read_database()
-            for (formula, color, scale, formula_type, engine) in formula_color_scale_formula_type_list:
-                searchText = self.__get_search_text(formula_type, formula, color, scale, engine)
-                if searchText in self.__database[0]:
-                    result.append(self.__database[0][searchText])
-                else:
-                    base_name = hashlib.sha224(searchText.encode(encoding="UTF-8", errors="replace")).digest()
-                    base_name = str(base64.b64encode(base_name, altchars=b"_."), "UTF-8")[:-2]  # substring gets rid of final '=='
-                    suffix = ""
-                    counter = -1
-                    while base_name + suffix in self.__database[1]:
-                        counter += 1
-                        suffix = "-{0}".format(counter)
-                    base_name += suffix
-                    self.__database[1].add(base_name)
-                    self.__database[0][searchText] = base_name
-                    changed = True
-                    result.append(base_name)
-            if changed:
-                self.__write_database(self.__database)
+            db = self.__get_connection()
+            result = [self.__lookup(db, searchText) for searchText in search_texts]
+            if None in result:
+                with self.__transaction():
+                    result = [base_name if base_name is not None else self.__insert(db, searchText) for base_name, searchText in zip(result, search_texts)]
         return result
 
+    # Maintenance
+
+    def collect_garbage(self, used_base_names):
+        """Forget all formulae except the ones in ``used_base_names`` and delete their cached content.
+
+        Returns the number of database entries and the number of files removed.
+        """
+        used_base_names = set(used_base_names)
+        with self.__internal_lock:
+            db = self.__get_connection()
+            with self.__transaction():
+                unused = [row[0] for row in db.execute("SELECT base_name FROM formulae") if row[0] not in used_base_names]
+                db.executemany("DELETE FROM formulae WHERE base_name = ?", [(base_name, ) for base_name in unused])
+        removed_files = 0
+        if self.__cache_directory is not None and os.path.isdir(self.__cache_directory):
+            database_files = {os.path.basename(self.__get_database_file()), os.path.basename(self.__get_json_database_file()) + '.imported'}
+            for fn in os.listdir(self.__cache_directory):
+                if fn.startswith(os.path.basename(self.__get_database_file())) or fn in database_files:
+                    continue
+                if fn.rsplit('.', 1)[0] not in used_base_names:
+                    try:
+                        os.remove(os.path.join(self.__cache_directory, fn))
+                        removed_files += 1
+                    except OSError as e:
+                        _LOGGER.warn("Cannot remove cache file {0}: {1}".format(fn, e))
+        return len(unused), removed_files
+
+    def compact(self):
+        """Compact the formula filename database."""
+        with self.__internal_lock:
+            self.__get_connection().execute("VACUUM")
+
     # Content cache
 
     def get_content_from_cache(self, base_name):
@@ -688,6 +725,180 @@ class LaTeXFormulaRenderer(object):
         finally:
             shutil.rmtree(tempdir, True)
 
+    # -----------------------------------------------------------------------
+    # Batch rendering
+
+    def _get_batch_conversion_steps(self, input_format, output_format, scale):
+        """Create execution steps converting every page of a multi-page file to ``page-<n>.<format>`` files.
+
+        Returns ``None`` if pages cannot be split for this combination of formats.
+        """
+        page_format = 'png' if output_format == 'png' else 'svg'
+        pages = os.path.join('{tempdir}', 'page-%d.' + page_format)
+        if output_format == 'png' and input_format == 'dvi':
+            return [{
+                'format': 'png',
+                'call': ['dvipng', '{input}', '-bg', 'Transparent', '-T', 'tight', '-D', str(int(100 * scale)), '-z', '9', '-o', pages],
+                'error': "Cannot convert DVI file to PNG files!"
+            }]
+        elif output_format == 'png' and input_format == 'pdf':
+            return [{
+                'format': 'png',
+                'call': ['convert', '-density', str(int(100 * scale)), '{input}', pages],
+                'error': "Cannot convert PDF file to PNG files!"
+            }]
+        elif output_format in ('svg', 'svgz') and input_format == 'dvi':
+            return [{
+                'format': 'svg',
+                'call': ['dvisvgm', '-n', '-p', '1-', '{input}', '-o', pages.replace('%d', '%p')],
+                'error': "Cannot convert DVI file to SVG files!"
+            }]
+        elif output_format in ('svg', 'svgz') and input_format == 'pdf':
+            return [{
+                'format': 'tmp.pdf',
+                'call': ['gs', '-o', '{output}', '-dNoOutputFonts', '-SDEVICE=pdfwrite', '{input}'],
+                'error': "Cannot convert text in PDF file to outlines!"
+            }, {
+                'format': 'svg',
+                'call': ['pdf2svg', '{input}', pages, 'all'],
+                'error': "Cannot convert PDF file to SVG files!"
+            }]
+        return None
+
+    def _create_batch_TeX_file(self, formulae, color, texfile_data):
+        """Create .tex file with one page per formula; all formulae must share the same preamble."""
+        standalone = R'\documentclass{standalone}' in texfile_data['head']
+        header = texfile_data['head'].replace(R'\documentclass{standalone}', R'\documentclass[multi=true]{standalone}')
+        pages = []
+        for formula, formula_type in formulae:
+            form_head, form_tail = self._get_form_head_tail(formula_type)
+            if standalone:
+                pages.append(''.join([R'\begin{standalone}\color{mycolor}', form_head, formula, form_tail, '\n', R'\end{standalone}', '\n']))
+            else:
+                pages.append(''.join([form_head, formula, form_tail, '\n']))
+        formula, formula_type = formulae[0]
+        return ''.join([
+            header,
+            self._get_LaTeX_header(
+                color,
+                any(self._needs_XY(f) for f, _ in formulae),
+                isinstance(formula_type, (tuple, list)) and formula_type[0] == 'tikzpicture',
+                isinstance(formula_type, (tuple, list)) and formula_type[0] == 'pstricks',
+                formula_type == 'align',
+                texfile_data['programs']
+            ),
+            texfile_data['middle'],
+            ''.join(pages) if standalone else '\\clearpage\n'.join(pages),
+            texfile_data['tail'],
+        ])
+
+    def _batch_key(self, formula, formula_type, color, scale, engine, output_format):
+        """Formulae with the same key can be compiled in one TeX document."""
+        formula_type_name = formula_type[0] if isinstance(formula_type, (tuple, list)) else formula_type
+        engine_data = self.__engines.get(engine, {}).get(formula_type_name)
+        if engine_data is None:
+            return None
+        if self._get_batch_conversion_steps(engine_data['steps'][-1]['format'], output_format, scale) is None:
+            return None
+        preamble = self._get_LaTeX_header(
+            color,
+            self._needs_XY(formula),
+            formula_type_name == 'tikzpicture',
+            formula_type_name == 'pstricks',
+            formula_type_name == 'align',
+            engine_data['texfile']['programs'])
+        return engine, id(engine_data), preamble, int(100 * scale)
+
+    def render_formula_batch(self, formulae, color, scale, output_format, engine='latex'):
+        """Render several formulae in one TeX document and split the pages into images.
+
+        ``formulae`` is a list of ``(formula, formula_type)`` tuples, which must all have
+        the same batch key (see ``render_formulae``).
+
+        Returns a list with one byte array per formula. Raises ``LaTeXError`` if the
+        document cannot be compiled or the number of pages does not match.
+        """
+        formula, formula_type = formulae[0]
+        formula_type_name = formula_type[0] if isinstance(formula_type, (tuple, list)) else formula_type
+        engine_data = self.__engines[engine][formula_type_name]
+        _LOGGER.info("Converting {0} formulae ({1} w/{2}) in one batch".format(len(formulae), formula_type_name, engine))
+        tempdir = tempfile.mkdtemp()
+        try:
+            intermediate_file = os.path.join(tempdir, 'batch.tex')
+            content = self._create_batch_TeX_file(formulae, color, engine_data['texfile'])
+            with open(intermediate_file, 'wb') as f:
+                f.write(content.encode('utf-8'))
+
+            steps = engine_data['steps']
+            steps = steps + self._get_batch_conversion_steps(steps[-1]['format'], output_format, scale)
+            for step in steps:
+                intermediate_format, intermediate_file = self._execute_step(step, intermediate_file, 'batch', tempdir)
+
+            page_re = re.compile(r'^page-(\d+)\.' + re.escape(intermediate_format) + '$')
+            pages = sorted((int(m.group(1)), m.group(0)) for m in map(page_re.match, os.listdir(tempdir)) if m)
+            if len(pages) != len(formulae):
+                raise LaTeXError("Batch produced {0} pages for {1} formulae!".format(len(pages), len(formulae)))
+
+            result = []
+            for _, page in pages:
+                with open(os.path.join(tempdir, page), "rb") as file:
+                    data = file.read()
+                if output_format == 'svgz':
+                    data = gzip.compress(data)
+                result.append(data)
+            return result
+        finally:
+            shutil.rmtree(tempdir, True)
+
+    def render_formulae(self, formulae, output_format, batch_size=100, max_workers=None):
+        """Render many formulae, compiling formulae with identical engine, preamble, colour and scale together.
+
+        ``formulae`` is a list of ``(base_name, formula, formula_type, color, scale, engine)``
+        tuples. Independent batches are compiled concurrently by ``max_workers`` threads.
+        If a batch fails (for example because one formula has an error), its formulae
+        are rendered one by one.
+
+        Returns a pair ``(results, errors)`` of dictionaries mapping ``base_name`` to the
+        rendered byte array, resp. to the exception raised while rendering it.
+        """
+        jobs = []
+        groups = {}
+        for base_name, formula, formula_type, color, scale, engine in formulae:
+            key = self._batch_key(formula, formula_type, color, scale, engine, output_format)
+            if key is None:
+                jobs.append([(base_name, formula, formula_type, color, scale, engine)])
+            else:
+                groups.setdefault(key, []).append((base_name, formula, formula_type, color, scale, engine))
+        for group in groups.values():
+            for i in range(0, len(group), batch_size):
+                jobs.append(group[i:i + batch_size])
+
+        results = {}
+        errors = {}
+
+        def render_one(base_name, formula, formula_type, color, scale, engine):
+            try:
+                results[base_name] = self.render_formula(formula, formula_type, color, scale, _sanitizeName(base_name), output_format, engine=engine)
+            except Exception as e:
+                errors[base_name] = e
+
+        def render_job(job):
+            if len(job) > 1:
+                _, _, _, color, scale, engine = job[0]
+                try:
+                    data = self.render_formula_batch([(formula, formula_type) for _, formula, formula_type, _, _, _ in job], color, scale, output_format, engine)
+                    for (base_name, _, _, _, _, _), d in zip(job, data):
+                        results[base_name] = d
+                    return
+                except Exception as e:
+                    _LOGGER.warn("Batch of {0} formulae failed, rendering them one by one: {1}".format(len(job), str(e).splitlines()[0] if str(e) else e))
+            for formula_data in job:
+                render_one(*formula_data)
+
+        with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count() or 1) as executor:
+            list(executor.map(render_job, jobs))
+        return results, errors
+
 
 def _parse_svg_unit_as_pixels(unit):
     """Parse a unit from a SVG file."""
@@ -823,6 +1034,9 @@ class LaTeXFormulaRendererPlugin(Task):
         self.__formula_additional_preamble = site.config.get('LATEX_FORMULA_ADDITIONAL_PREAMBLE', {})
         if not isinstance(self.__formula_additional_preamble, dict):
             self.__formula_additional_preamble = {'': self.__formula_additional_preamble}
+        self.__batch = site.config.get('LATEX_FORMULA_BATCH', False)
+        self.__batch_size = site.config.get('LATEX_FORMULA_BATCH_SIZE', 100)
+        self.__workers = site.config.get('LATEX_FORMULA_WORKERS', None)
 
         if not hasattr(site, 'latex_formula_collectors'):
             site.latex_formula_collectors = []
@@ -842,6 +1056,26 @@ class LaTeXFormulaRendererPlugin(Task):
             self.__formula_cache.put_content_into_cache(base_name + extension, data)
         return data
 
+    def _formulae_cached(self, base_names, extension):
+        """Check whether all formulae are in the cache."""
+        return all(self.__formula_cache.get_content_from_cache(base_name + extension) is not None for base_name in base_names)
+
+    def _prerender_formulae(self, base_names, formulae, extension):
+        """Render all formulae which are not cached yet in batches, and put them into the cache."""
+        missing = []
+        for base_name, (formula, color, scale, formula_type, engine) in zip(base_names, formulae):
+            if self.__formula_cache.get_content_from_cache(base_name + extension) is None:
+                missing.append((base_name, formula, formula_type, color, scale, engine))
+        if not missing:
+            return
+        renderer = LaTeXFormulaRenderer(self.__formula_additional_preamble)
+        results, errors = renderer.render_formulae(missing, self.__output_format, self.__batch_size, self.__workers)
+        for base_name, data in results.items():
+            self.__formula_cache.put_content_into_cache(base_name + extension, data)
+        for base_name, e in errors.items():
+            # The formula's own task will render it again and report the error
+            _LOGGER.warn("Cannot render formula {0}: {1}".format(base_name, e))
+
     def _write_formula(self, data, base_name, extension):
         """Write formula into output directory."""
         file_name = os.path.join(self.__formula_cache.get_output_directory(), base_name + extension)
@@ -889,6 +1123,39 @@ class LaTeXFormulaRendererPlugin(Task):
             css_type = formula_type
         return "<img class='img-{0}-formula img-formula' width='{1}' height='{2}' src='{3}' />".format(css_type, width, height, src)
 
+    def get_formula_cache(self):
+        """Retrieve the ``FormulaCache`` used by this plugin."""
+        return self.__formula_cache
+
+    def uses_data_URIs(self):
+        """Whether formulae are embedded as data URIs (``LATEX_FORMULA_AS_DATAURI``) instead of written to files."""
+        return self.__formula_as_data_URIs
+
+    def collect_formulae(self):
+        """Return sorted list of all distinct ``(formula, color, scale, formula_type, engine)`` tuples of the site.
+
+        Queries all registered formula collectors; make sure posts are scanned first.
+        """
+        formulae = []
+        # Process all formula collectors
+        for formula_collector in self.site.latex_formula_collectors:
+            # Get formulae
+            for formula_data in formula_collector():
+                if len(formula_data) == 4:
+                    # Add optional engine argument
+                    formula_data = tuple(list(formula_data) + ['latex'])
+                formulae.append(formula_data)
+        # Remove obvious duplicates
+        last = None
+        s = sorted(formulae)
+        formulae = []
+        for f in s:
+            if f == last:
+                continue
+            last = f
+            formulae.append(last)
+        return formulae
+
     def gen_tasks(self):
         """Generate doit tasks."""
         yield self.group_task()
@@ -896,30 +1163,22 @@ class LaTeXFormulaRendererPlugin(Task):
         if not self.__formula_as_data_URIs:
             # Make sure we have all posts scanned and can safely query the formula collectors
             self.site.scan_posts()
-            formulae = []
-            # Process all formula collectors
-            for formula_collector in self.site.latex_formula_collectors:
-                # Get formulae
-                for formula_data in formula_collector():
-                    if len(formula_data) == 4:
-                        # Add optional engine argument
-                        formula_data = tuple(list(formula_data) + ['latex'])
-                    formulae.append(formula_data)
+            formulae = self.collect_formulae()
             if len(formulae) == 0:
                 return
-            # Remove obvious duplicates
-            last = None
-            s = sorted(formulae)
-            formulae = []
-            for f in s:
-                if f == last:
-                    continue
-                last = f
-                formulae.append(last)
             # Get base names for list of formulae
             base_names = self.__formula_cache.get_base_names(formulae)
             # Generate tasks
             extension = ".{0}".format(self.__output_format)
+            task_dep = []
+            if self.__batch:
+                yield {
+                    'basename': self.name,
+                    'name': 'prerender',
+                    'actions': [(self._prerender_formulae, [base_names, formulae, extension])],
+                    'uptodate': [(self._formulae_cached, [base_names, extension])],
+                }
+                task_dep = ['{0}:prerender'.format(self.name)]
             generated = set()
             for base_name, (formula, color, scale, formula_type, engine) in zip(base_names, formulae):
                 destination = os.path.normpath(os.path.join(self.__formula_cache.get_output_directory(), base_name + extension))
@@ -931,6 +1190,7 @@ class LaTeXFormulaRendererPlugin(Task):
                         'file_dep': [],
                         'targets': [destination],
                         'actions': [(self._copy_formula, [base_name, extension, formula, color, scale, formula_type, engine])],
+                        'task_dep': task_dep,
                         'clean': True,
                         'uptodate': [utils.config_changed({0: formula, 1: color, 2: scale, 3: formula_type, 4: engine})]
                     }
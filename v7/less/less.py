@@ -27,13 +27,190 @@
 from __future__ import unicode_literals
 
 import codecs
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
+import json
 import os
+import re
 import sys
 import subprocess
 
 from nikola.plugin_categories import Task
 from nikola import utils
 
+LOGGER = utils.get_logger('build_less', utils.STDERR_HANDLER)
+
+# Comments are dropped, strings and unquoted url()s are kept as they are
+COMMENT_RE = re.compile(r'''("(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*'|url\([^)"']*\))|/\*.*?\*/|//[^\n]*''', re.DOTALL)
+IMPORT_RE = re.compile(
+    r'''@import\s*(?:\(([^)]*)\))?\s*'''
+    r'''(?:url\(\s*(?:"([^"]+)"|'([^']+)'|([^)"'\s]+))\s*\)|"([^"]+)"|'([^']+)')'''
+)
+
+
+def find_imports(text):
+    """Return the names of the files a LESS source depends on through @import.
+
+    Imports with the (css) option, or of .css files without (less) or
+    (inline), are left to the browser.  The other options, like (reference)
+    and (optional), still make the importing file depend on the imported one.
+    Remote and interpolated (@{var}) names are skipped.
+    """
+    names = []
+    text = COMMENT_RE.sub(lambda match: match.group(1) or '', text)
+    for match in IMPORT_RE.finditer(text):
+        options = set(option.strip() for option in (match.group(1) or '').split(','))
+        name = next(group for group in match.groups()[1:] if group)
+        if '@{' in name or name.startswith(('http://', 'https://', '//')):
+            continue
+        if 'css' in options or (name.endswith('.css') and not options & set(['less', 'inline'])):
+            continue
+        names.append(name)
+    return names
+
+
+def include_paths(options):
+    """Return the folders given to lessc with --include-path."""
+    paths = []
+    for i, option in enumerate(options):
+        if option.startswith('--include-path='):
+            value = option.split('=', 1)[1]
+        elif option == '--include-path' and i + 1 < len(options):
+            value = options[i + 1]
+        else:
+            continue
+        paths.extend(path for path in value.split(os.pathsep) if path)
+    return paths
+
+
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as inf:
+        for chunk in iter(lambda: inf.read(65536), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def copy_if_changed(src, dst):
+    """Copy src to dst, unless dst already has the same contents."""
+    if os.path.isfile(dst) and file_hash(src) == file_hash(dst):
+        return
+    utils.copy_file(src, dst)
+
+
+def target_digest(config, deps):
+    """Return a hash of config and of the contents of the files a target is compiled from."""
+    h = hashlib.sha1(config.encode('utf-8'))
+    for dep in deps:
+        h.update(dep.encode('utf-8'))
+        h.update(file_hash(dep).encode('ascii'))
+    return h.hexdigest()
+
+
+class TargetHashes(object):
+    """The target_digest() each CSS file was last compiled from.
+
+    When several targets are compiled by one task, doit's 'changed' does not
+    tell which of them are stale: if any target is missing, it lists every
+    file_dep.  So the task compares each target's digest with this instead.
+
+    The sass plugin has the same class, see ImportGraph.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with codecs.open(path, 'rb', 'utf-8') as inf:
+                self.hashes = json.load(inf)
+        except (IOError, OSError, ValueError):
+            self.hashes = {}
+
+    def is_stale(self, dst, digest, outputs):
+        return self.hashes.get(dst) != digest or not all(os.path.exists(path) for path in outputs)
+
+    def set(self, dst, digest):
+        self.hashes[dst] = digest
+
+    def discard(self, dst):
+        self.hashes.pop(dst, None)
+
+    def save(self):
+        utils.makedirs(os.path.dirname(self.path))
+        with codecs.open(self.path, 'wb+', 'utf-8') as outf:
+            json.dump(self.hashes, outf)
+
+
+class ImportGraph(object):
+    """Which files each LESS source imports, directly or not.
+
+    The sass plugin keeps the same kind of graph; plugins are installed
+    separately, so each has its own copy, with its language's import rules
+    in find_imports() and resolve().
+
+    Sources are compiled from their copies in the cache folder: sources maps
+    each copy to its original.  Files found through --include-path are used
+    where they are.  The names each file imports are cached in cache_path
+    until the file's mtime or size changes.
+    """
+
+    def __init__(self, cache_path, sources, root, paths=()):
+        self.cache_path = cache_path
+        self.sources = sources
+        self.root = root
+        self.paths = list(paths)
+        self.dirty = False
+        try:
+            with codecs.open(cache_path, 'rb', 'utf-8') as inf:
+                self.cache = json.load(inf)
+        except (IOError, OSError, ValueError):
+            self.cache = {}
+
+    def imports(self, path):
+        """Return the paths of the files path imports."""
+        source = self.sources.get(path, path)
+        stat = os.stat(source)
+        entry = self.cache.get(source)
+        if entry is None or entry['mtime'] != stat.st_mtime or entry['size'] != stat.st_size:
+            with codecs.open(source, 'rb', 'utf-8') as inf:
+                entry = {'mtime': stat.st_mtime, 'size': stat.st_size, 'imports': find_imports(inf.read())}
+            self.cache[source] = entry
+            self.dirty = True
+        return [dep for dep in (self.resolve(name, path) for name in entry['imports']) if dep is not None]
+
+    def resolve(self, name, importer):
+        """Find the file lessc loads for @import name in importer.
+
+        lessc appends .less to names without an extension, and looks in the
+        importer's folder, then in the include paths.  Targets are compiled
+        from root, so it is tried last.  Missing files, like (optional)
+        imports, are ignored.
+        """
+        if not re.search(r'\.[a-z]*$', name):
+            name += '.less'
+        for folder in [os.path.dirname(importer)] + self.paths + [self.root]:
+            path = os.path.normpath(os.path.join(folder, name))
+            if path in self.sources or (not path.startswith(self.root + os.sep) and os.path.isfile(path)):
+                return path
+        return None
+
+    def dependencies(self, path):
+        """Return path and all the files it imports, directly or not."""
+        seen = set([path])
+        stack = [path]
+        while stack:
+            for dep in self.imports(stack.pop()):
+                if dep not in seen:
+                    seen.add(dep)
+                    stack.append(dep)
+        return sorted(seen)
+
+    def save(self):
+        if self.dirty:
+            utils.makedirs(os.path.dirname(self.cache_path))
+            with codecs.open(self.cache_path, 'wb+', 'utf-8') as outf:
+                json.dump(self.cache, outf)
+            self.dirty = False
+
 
 class BuildLess(Task):
     """Generate CSS out of LESS sources."""
@@ -70,6 +247,7 @@ class BuildLess(Task):
             if task['name'] in tasks:
                 continue
             task['basename'] = 'prepare_less_sources'
+            task['actions'] = [(copy_if_changed, (task['file_dep'][0], task['name']))]
             tasks[task['name']] = task
             yield task
 
@@ -79,16 +257,20 @@ class BuildLess(Task):
                 if task['name'] in tasks:
                     continue
                 task['basename'] = 'prepare_less_sources'
+                task['actions'] = [(copy_if_changed, (task['file_dep'][0], task['name']))]
                 tasks[task['name']] = task
                 yield task
 
         # Build targets and write CSS files
         dst_dir = os.path.join(self.site.config['OUTPUT_FOLDER'], 'assets', 'css')
-        # Make everything depend on all sources, rough but enough
-        deps = []
-        for task in tasks.keys():
-            if task.endswith(self.sources_ext):
-                deps.append(task)
+        # Each target depends on the sources it imports
+        graph = ImportGraph(
+            os.path.join(kw['cache_folder'], 'less_imports.json'),
+            dict((os.path.normpath(name), task['file_dep'][0]) for name, task in tasks.items()),
+            os.path.normpath(os.path.join(kw['cache_folder'], self.sources_folder)),
+            include_paths(self.compiler_options),
+        )
+        workers = self.site.config.get('LESS_WORKERS', 1)
 
         def compile_target(target, dst):
             utils.makedirs(dst_dir)
@@ -103,10 +285,62 @@ class BuildLess(Task):
             with open(dst, "wb+") as outf:
                 outf.write(compiled)
 
+        def compile_targets(jobs):
+            """Compile the targets whose sources or config changed concurrently."""
+            hashes = TargetHashes(os.path.join(kw['cache_folder'], 'less_targets.json'))
+            config = json.dumps([kw, self.compiler_name, self.compiler_options], sort_keys=True)
+            stale = []
+            for target, dst, deps in jobs:
+                digest = target_digest(config, deps)
+                if hashes.is_stale(dst, digest, [dst]):
+                    stale.append((target, dst, digest))
+            LOGGER.info('compiling {0} of {1} targets using {2} workers'.format(len(stale), len(jobs), workers))
+            errors = []
+            try:
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    futures = dict((executor.submit(compile_target, target, dst), (dst, digest)) for target, dst, digest in stale)
+                    for future in as_completed(futures):
+                        dst, digest = futures[future]
+                        try:
+                            future.result()
+                        except Exception as e:
+                            hashes.discard(dst)
+                            errors.append(e)
+                        else:
+                            hashes.set(dst, digest)
+            finally:
+                hashes.save()
+            if errors:
+                raise errors[0]
+
         yield self.group_task()
 
+        jobs = []
         for target in targets:
             dst = os.path.join(dst_dir, target.replace(self.sources_ext, ".css"))
+            src = os.path.normpath(os.path.join(kw['cache_folder'], self.sources_folder, target))
+            if src in graph.sources:
+                deps = graph.dependencies(src)
+            else:
+                deps = []
+            jobs.append((target, dst, deps))
+
+        graph.save()
+
+        if workers > 1 and jobs:
+            yield {
+                'basename': self.name,
+                'name': 'all',
+                'targets': [dst for _, dst, _ in jobs],
+                'file_dep': sorted(set(dep for _, _, deps in jobs for dep in deps)),
+                'task_dep': ['prepare_less_sources'],
+                'actions': ((compile_targets, [jobs]), ),
+                'uptodate': [utils.config_changed(kw)],
+                'clean': True
+            }
+            return
+
+        for target, dst, deps in jobs:
             yield {
                 'basename': self.name,
                 'name': dst,
@@ -43,6 +43,10 @@ const rl = readline.createInterface({
 
 rl.on('line', (line) => {
     let j = JSON.parse(line);
+    if (j["version"]) {
+        console.log(JSON.stringify({"input": null, "output": katex.version, "success": true}));
+        return;
+    }
     try {
         let html = katex.renderToString(j["math"], j["options"]);
         console.log(JSON.stringify({"input": j["math"], "output": html, "success": true}));
@@ -25,9 +25,14 @@
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 from __future__ import unicode_literals
+import atexit
+import hashlib
 import subprocess
 import json
 import os.path
+import tempfile
+import threading
+from collections import OrderedDict
 
 from nikola.plugin_categories import ShortcodePlugin
 from nikola import utils
@@ -41,22 +46,121 @@ class LocalKatex(ShortcodePlugin):
     name = 'localkatex'
     _options_available = {'displayMode': bool, 'throwOnError': bool, 'errorColor': str, 'colorIsTextColor': bool}
     logger = None
+    _process = None
+    _katex_version = None
 
     def set_site(self, site):
         """Set Nikola site."""
         site.register_shortcode('lmath', self.handler)
         site.register_shortcode('lmathd', self.handler_display)
         self.logger = utils.get_logger('localkatex')
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._cache_size = site.config.get('LOCALKATEX_CACHE_SIZE', 1000)
+        self._cache_folder = None
+        if site.config.get('LOCALKATEX_PERSISTENT_CACHE', False):
+            self._cache_folder = os.path.join(site.config['CACHE_FOLDER'], 'localkatex')
+        self._hits = self._misses = 0
+        atexit.register(self._at_exit)
         return super(LocalKatex, self).set_site(site)
 
+    def _at_exit(self):
+        self._stop_worker()
+        if self._hits or self._misses:
+            self.logger.info("KaTeX cache: {0} hits, {1} misses".format(self._hits, self._misses))
+
+    def _start_worker(self):
+        """Start the Node process that renders every formula of this build."""
+        self._process = subprocess.Popen(['node', jspath], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def _stop_worker(self):
+        if self._process is not None:
+            try:
+                self._process.stdin.close()
+                self._process.wait(timeout=10)
+            except (OSError, subprocess.TimeoutExpired):
+                self._process.kill()
+            self._process = None
+
+    def _render(self, json_input):
+        """Send one JSON line to the worker and return its JSON reply, restarting the worker if it died."""
+        with self._lock:
+            for attempt in range(2):
+                if self._process is None or self._process.poll() is not None:
+                    if self._process is not None:
+                        self.logger.warning("KaTeX worker exited with code {0}, restarting it".format(self._process.returncode))
+                    self._start_worker()
+                try:
+                    self._process.stdin.write(json_input + b'\n')
+                    self._process.stdin.flush()
+                    line = self._process.stdout.readline()
+                except OSError:
+                    line = b''
+                if line:
+                    return json.loads(line.decode('utf-8').strip())
+                self._process.kill()
+                self._process.wait()
+            raise Exception("KaTeX worker (node {0}) keeps exiting".format(jspath))
+
+    @staticmethod
+    def _installed_katex_version():
+        """Version of the KaTeX package node finds from this plugin's folder, or None."""
+        folder = os.path.dirname(os.path.abspath(jspath))
+        while True:
+            try:
+                with open(os.path.join(folder, 'node_modules', 'katex', 'package.json'), 'rb') as f:
+                    return json.loads(f.read().decode('utf-8'))['version']
+            except (IOError, ValueError, KeyError):
+                pass
+            parent = os.path.dirname(folder)
+            if parent == folder:
+                return None
+            folder = parent
+
+    def _cache_key(self, data, options):
+        """Hash of the math, the normalized options and the KaTeX version."""
+        if self._katex_version is None:
+            # Avoid starting node when every formula is cached
+            self._katex_version = self._installed_katex_version()
+        if self._katex_version is None:
+            output = self._render(json.dumps({'version': True}).encode('utf-8'))
+            if not output['success']:
+                raise Exception("Cannot import KaTeX. Did you run npm install?")
+            self._katex_version = output['output']
+        key = json.dumps([data, options, self._katex_version], sort_keys=True)
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def _cache_get(self, key):
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        if self._cache_folder:
+            try:
+                with open(os.path.join(self._cache_folder, key[:2], key), 'rb') as f:
+                    html = f.read().decode('utf-8')
+            except IOError:
+                return None
+            self._cache_put(key, html, persist=False)
+            return html
+        return None
+
+    def _cache_put(self, key, html, persist=True):
+        self._cache[key] = html
+        if len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+        if persist and self._cache_folder:
+            path = os.path.join(self._cache_folder, key[:2], key)
+            utils.makedirs(os.path.dirname(path))
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as f:
+                f.write(html.encode('utf-8'))
+            os.replace(f.name, path)
+
     @staticmethod
     def _str_to_bool(v):
         return v.lower() not in ('false', 'no', 'f', 'n')
 
     def handler(self, site, lang, post, data, **options):
         """Render math."""
-        p = subprocess.Popen(['node', jspath], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-
         if 'display' in options:
             options['displayMode'] = options['display']
             del options['display']
@@ -67,10 +171,17 @@ class LocalKatex(ShortcodePlugin):
             elif k not in self._options_available:
                 raise ValueError("Unknown KaTeX option {0}={1}".format(k, v))
 
+        key = self._cache_key(data, options)
+        html = self._cache_get(key)
+        if html is not None:
+            self._hits += 1
+            return html
+        self._misses += 1
+
         json_input = json.dumps({'math': data, 'options': options}).encode('utf-8')
-        stdout, stderr = p.communicate(json_input)
-        output = json.loads(stdout.decode('utf-8').strip())
+        output = self._render(json_input)
         if output['success']:
+            self._cache_put(key, output['output'])
             return output['output']
         else:
             if output['input'] is None and output['output'] is None:
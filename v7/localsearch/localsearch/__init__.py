@@ -26,8 +26,11 @@
 
 from __future__ import unicode_literals
 import codecs
+from collections import defaultdict
+import hashlib
 import json
 import os
+import re
 
 from nikola.plugin_categories import LateTask
 from nikola.utils import apply_filters, config_changed, copy_tree, makedirs
@@ -48,6 +51,188 @@ from nikola.utils import apply_filters, config_changed, copy_tree, makedirs
 # ]};
 
 
+def _indexable(post):
+    """Don't index drafts (Issue #387)."""
+    return not (post.is_draft or post.is_private or post.publish_later)
+
+
+def _page_data(post, lang):
+    text = post.text(lang, strip_html=True)
+    text = text.replace('^', '')
+
+    data = {}
+    data["title"] = post.title(lang)
+    data["text"] = text
+    data["tags"] = ",".join(post.tags)
+    data["url"] = post.permalink(lang, absolute=True)
+    return data
+
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+# Snowball stemmer names, for the inverted index
+STEMMER_LANGUAGES = {
+    'ar': 'arabic', 'da': 'danish', 'de': 'german', 'en': 'english',
+    'es': 'spanish', 'fi': 'finnish', 'fr': 'french', 'hu': 'hungarian',
+    'it': 'italian', 'nb': 'norwegian', 'nl': 'dutch', 'no': 'norwegian',
+    'pt': 'portuguese', 'ro': 'romanian', 'ru': 'russian', 'sv': 'swedish',
+}
+
+
+def _get_stemmer(lang):
+    """Return a stemming function for lang, or None (needs NLTK)."""
+    try:
+        from nltk.stem.snowball import SnowballStemmer
+    except ImportError:
+        return None
+    language = STEMMER_LANGUAGES.get(lang.split('_')[0])
+    if language is None:
+        return None
+    return SnowballStemmer(language).stem
+
+
+def _tokenize(text):
+    return WORD_RE.findall(text.lower())
+
+
+def _page_tokens(page):
+    """Return the words of the title and tags, and of the text of a page."""
+    if "words" in page:
+        return page["head"], page["words"]
+    head = _tokenize(page["title"]) + _tokenize(page["tags"].replace(',', ' '))
+    return head, _tokenize(page["text"])
+
+
+class FragmentCache(object):
+    """The extracted text and words of every post, kept in CACHE_FOLDER.
+
+    Entries are keyed by a hash of the post (its source modification time
+    and metadata), its compiled fragment and its URL, so only changed posts
+    have their text extracted again.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.used = set()
+        self.hits = self.misses = 0
+
+    def _key(self, post, lang):
+        fragment = post.translated_base_path(lang)
+        fragment_mtime = os.stat(fragment).st_mtime if os.path.exists(fragment) else None
+        data = json.dumps([repr(post), lang, post.permalink(lang, absolute=True), fragment_mtime])
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+    def get(self, post, lang):
+        """Return the page data of a post, with its words."""
+        key = self._key(post, lang)
+        path = os.path.join(self.folder, key[:2], key + '.json')
+        self.used.add(path)
+        if os.path.exists(path):
+            with codecs.open(path, 'rb', 'utf8') as fd:
+                try:
+                    entry = json.load(fd)
+                    self.hits += 1
+                    return entry
+                except ValueError:
+                    pass
+        self.misses += 1
+        entry = _page_data(post, lang)
+        entry["head"], entry["words"] = _page_tokens(entry)
+        makedirs(os.path.dirname(path))
+        with codecs.open(path, 'wb+', 'utf8') as fd:
+            fd.write(json.dumps(entry, separators=(',', ':')))
+        return entry
+
+    def page(self, post, lang):
+        """Return the page data of a post, as written to the Tipue index."""
+        entry = self.get(post, lang)
+        return dict((k, entry[k]) for k in ("title", "text", "tags", "url"))
+
+    def prune(self):
+        """Remove the entries that were not used since this cache was created."""
+        for root, dirs, files in os.walk(self.folder):
+            for name in files:
+                path = os.path.join(root, name)
+                if path not in self.used:
+                    os.unlink(path)
+
+
+def build_inverted_index(pages, stem=None, prefix_length=0, snippet_length=160):
+    """Build an inverted index of pages, as a JSON-serializable dict.
+
+    The index has:
+
+    * docs: [title, url, number of title and tag words, snippet] per page
+    * terms: every (stemmed) word, sorted
+    * postings: for each term, a flat list of [doc delta, count, position
+      deltas...] per page that has the term.  Positions count words from
+      the start of the title, followed by the tags and the text.
+    * forms: the words that stem to a different term
+    * prefixes: for each prefix of prefix_length letters, the [start, end)
+      range of terms starting with it (if prefix_length is not 0)
+    """
+    docs = []
+    postings = defaultdict(list)
+    last_doc = {}
+    stems = {}
+    for doc_id, page in enumerate(pages):
+        head, words = _page_tokens(page)
+        text = page["text"].strip()
+        snippet = text[:snippet_length]
+        if len(text) > snippet_length:
+            snippet = snippet.rsplit(' ', 1)[0] + ' ...'
+        docs.append([page["title"], page["url"], len(head), snippet])
+
+        positions = defaultdict(list)
+        for position, word in enumerate(head + words):
+            if stem is not None:
+                if word not in stems:
+                    stems[word] = stem(word)
+                word = stems[word]
+            positions[word].append(position)
+
+        for term, term_positions in positions.items():
+            flat = postings[term]
+            flat.append(doc_id - last_doc.get(term, 0))
+            flat.append(len(term_positions))
+            previous = 0
+            for position in term_positions:
+                flat.append(position - previous)
+                previous = position
+            last_doc[term] = doc_id
+
+    terms = sorted(postings)
+    index = {
+        "docs": docs,
+        "terms": terms,
+        "postings": [postings[term] for term in terms],
+        "forms": dict((word, term) for word, term in stems.items() if word != term),
+    }
+    if prefix_length:
+        prefixes = {}
+        for i, term in enumerate(terms):
+            prefix = term[:prefix_length]
+            if prefix in prefixes:
+                prefixes[prefix][1] = i + 1
+            else:
+                prefixes[prefix] = [i, i + 1]
+        index["prefix_length"] = prefix_length
+        index["prefixes"] = prefixes
+    return index
+
+
+def _write_pages(path, pages, prefix='', suffix=''):
+    """Write pages as a compact JSON array, one page at a time."""
+    makedirs(os.path.dirname(path))
+    with codecs.open(path, "wb+", "utf8") as fd:
+        fd.write(prefix + '[')
+        for i, page in enumerate(pages):
+            if i:
+                fd.write(',\n')
+            fd.write(json.dumps(page, separators=(',', ':')))
+        fd.write(']' + suffix)
+
+
 class Tipue(LateTask):
     """Render the blog posts as JSON data."""
 
@@ -58,45 +243,132 @@ class Tipue(LateTask):
 
         kw = {
             "translations": self.site.config['TRANSLATIONS'],
+            "default_lang": self.site.config['DEFAULT_LANG'],
             "output_folder": self.site.config['OUTPUT_FOLDER'],
             "filters": self.site.config['FILTERS'],
             "timeline": self.site.timeline,
+            "sharded": self.site.config.get('LOCALSEARCH_SHARDED', False),
+            "shard_size": self.site.config.get('LOCALSEARCH_SHARD_SIZE', 500),
+            "inverted_index": self.site.config.get('LOCALSEARCH_INVERTED_INDEX', False),
+            "stemming": self.site.config.get('LOCALSEARCH_STEMMING', True),
+            "prefix_length": self.site.config.get('LOCALSEARCH_PREFIX_LENGTH', 2),
+            "snippet_length": self.site.config.get('LOCALSEARCH_SNIPPET_LENGTH', 160),
+            "cache": self.site.config.get('LOCALSEARCH_CACHE', True),
         }
 
-        posts = self.site.timeline[:]
-        dst_path = os.path.join(kw["output_folder"], "assets", "js",
-                                "tipuesearch_content.js")
+        posts = [post for post in self.site.timeline if _indexable(post)]
+        js_folder = os.path.join(kw["output_folder"], "assets", "js")
+        dst_path = os.path.join(js_folder, "tipuesearch_content.js")
+
+        if kw["cache"]:
+            fragments = FragmentCache(os.path.join(self.site.config['CACHE_FOLDER'], 'localsearch'))
+            page_data = fragments.page
+            indexed_page_data = fragments.get
+        else:
+            fragments = None
+            page_data = indexed_page_data = _page_data
+
+        def done():
+            if fragments is not None:
+                fragments.prune()
+                self.logger.info("Extracted the text of {0} pages, {1} were cached".format(
+                    fragments.misses, fragments.hits))
 
         def save_data():
-            pages = []
-            for lang in kw["translations"]:
-                for post in posts:
-                    # Don't index drafts (Issue #387)
-                    if post.is_draft or post.is_private or post.publish_later:
-                        continue
-                    text = post.text(lang, strip_html=True)
-                    text = text.replace('^', '')
-
-                    data = {}
-                    data["title"] = post.title(lang)
-                    data["text"] = text
-                    data["tags"] = ",".join(post.tags)
-                    data["url"] = post.permalink(lang, absolute=True)
-                    pages.append(data)
-            output = json.dumps({"pages": pages}, indent=2)
-            output = 'var tipuesearch = ' + output + ';'
-            makedirs(os.path.dirname(dst_path))
-            with codecs.open(dst_path, "wb+", "utf8") as fd:
-                fd.write(output)
-
-        task = {
-            "basename": str(self.name),
-            "name": dst_path,
-            "targets": [dst_path],
-            "actions": [(save_data, [])],
-            'uptodate': [config_changed(kw)],
-            'calc_dep': ['_scan_locs:sitemap']
-        }
+            pages = (
+                page_data(post, lang)
+                for lang in kw["translations"]
+                for post in posts
+            )
+            _write_pages(dst_path, pages, 'var tipuesearch = {"pages": ', '};')
+            done()
+
+        if kw["inverted_index"]:
+            # One prebuilt index per language, searched by localsearch_index.js
+            manifest = {
+                "default_language": kw["default_lang"],
+                "format": "inverted",
+                "languages": dict(
+                    (lang, ["tipuesearch_index.{0}.json".format(lang)])
+                    for lang in kw["translations"]
+                ),
+            }
+            manifest_path = os.path.join(js_folder, "tipuesearch_manifest.json")
+
+            def save_index():
+                makedirs(js_folder)
+                for lang, (index_file, ) in manifest["languages"].items():
+                    index = build_inverted_index(
+                        (indexed_page_data(post, lang) for post in posts),
+                        _get_stemmer(lang) if kw["stemming"] else None,
+                        kw["prefix_length"],
+                        kw["snippet_length"],
+                    )
+                    with codecs.open(os.path.join(js_folder, index_file), "wb+", "utf8") as fd:
+                        fd.write(json.dumps(index, separators=(',', ':'), sort_keys=True))
+                with codecs.open(manifest_path, "wb+", "utf8") as fd:
+                    fd.write(json.dumps(manifest, sort_keys=True))
+                done()
+
+            task = {
+                "basename": str(self.name),
+                "name": manifest_path,
+                "targets": [manifest_path] + [
+                    os.path.join(js_folder, index_file)
+                    for (index_file, ) in manifest["languages"].values()
+                ],
+                "actions": [(save_index, [])],
+                'uptodate': [config_changed(kw)],
+                'calc_dep': ['_scan_locs:sitemap']
+            }
+        elif kw["sharded"]:
+            # One JSON file per language (or several, with shard_size), and a
+            # manifest for tipuesearch_loader.js to find the right ones.
+            shard_size = kw["shard_size"] or max(len(posts), 1)
+            shard_count = max((len(posts) + shard_size - 1) // shard_size, 1)
+            manifest = {
+                "default_language": kw["default_lang"],
+                "languages": dict(
+                    (lang, [
+                        "tipuesearch_content.{0}.{1}.json".format(lang, i)
+                        for i in range(shard_count)
+                    ]) for lang in kw["translations"]
+                ),
+            }
+            manifest_path = os.path.join(js_folder, "tipuesearch_manifest.json")
+
+            def save_shards():
+                for lang, shards in manifest["languages"].items():
+                    for i, shard in enumerate(shards):
+                        _write_pages(
+                            os.path.join(js_folder, shard),
+                            (page_data(post, lang) for post in posts[i * shard_size:(i + 1) * shard_size]),
+                        )
+                with codecs.open(manifest_path, "wb+", "utf8") as fd:
+                    fd.write(json.dumps(manifest, sort_keys=True))
+                done()
+
+            task = {
+                "basename": str(self.name),
+                "name": manifest_path,
+                "targets": [manifest_path] + [
+                    os.path.join(js_folder, shard)
+                    for shards in manifest["languages"].values()
+                    for shard in shards
+                ],
+                "actions": [(save_shards, [])],
+                'uptodate': [config_changed(kw)],
+                'calc_dep': ['_scan_locs:sitemap']
+            }
+        else:
+            task = {
+                "basename": str(self.name),
+                "name": dst_path,
+                "targets": [dst_path],
+                "actions": [(save_data, [])],
+                'uptodate': [config_changed(kw)],
+                'calc_dep': ['_scan_locs:sitemap']
+            }
         yield apply_filters(task, kw['filters'])
 
         # Copy all the assets to the right places
@@ -0,0 +1,308 @@
+/*
+Searches the prebuilt index written with LOCALSEARCH_INVERTED_INDEX = True.
+
+    $('#tipue_search_input').localsearch({'show': 10});
+
+Loads tipuesearch_manifest.json and the index for the language of the page
+(the lang attribute of <html>, or the site's default language) from the
+folder of this script, or from tipuesearch_index_url if set, and shows the
+results in #tipue_search_content with the same markup as Tipue Search.
+
+All the words of the query must match.  Words in double quotes must appear
+as a phrase, and the last word of the query also matches longer words that
+start with it.  Matches in the title and tags count more.
+*/
+
+(function($) {
+
+     var scriptBase = document.currentScript ? document.currentScript.src.replace(/[^\/]*$/, '') : '/assets/js/';
+     var wordPattern = /[\p{L}\p{N}\p{M}_]+/gu;
+
+     function tokenize(text)
+     {
+          return text.toLowerCase().match(wordPattern) || [];
+     }
+
+     function escapeHtml(text)
+     {
+          return $('<div>').text(text).html();
+     }
+
+     // First index in terms[lo:hi] whose term is not less than word
+     function lowerBound(terms, word, lo, hi)
+     {
+          while (lo < hi)
+          {
+               var mid = (lo + hi) >> 1;
+               if (terms[mid] < word)
+               {
+                    lo = mid + 1;
+               }
+               else
+               {
+                    hi = mid;
+               }
+          }
+          return lo;
+     }
+
+     // [doc delta, count, position deltas..., ...] -> {doc: [positions]}
+     function decode(flat)
+     {
+          var postings = {};
+          var doc = 0;
+          var i = 0;
+          while (i < flat.length)
+          {
+               doc += flat[i];
+               var count = flat[i + 1];
+               var position = 0;
+               var positions = [];
+               for (var j = 0; j < count; j++)
+               {
+                    position += flat[i + 2 + j];
+                    positions.push(position);
+               }
+               postings[doc] = positions;
+               i += 2 + count;
+          }
+          return postings;
+     }
+
+     function Index(data)
+     {
+          this.data = data;
+          this.cache = {};
+     }
+
+     Index.prototype.postings = function(termId)
+     {
+          if (!(termId in this.cache))
+          {
+               this.cache[termId] = decode(this.data.postings[termId]);
+          }
+          return this.cache[termId];
+     };
+
+     // Ids of the terms matching word (and the words it starts, if prefix)
+     Index.prototype.lookup = function(word, prefix)
+     {
+          var terms = this.data.terms;
+          var ids = [];
+          var term = this.data.forms[word] || word;
+          var i = lowerBound(terms, term, 0, terms.length);
+          if (terms[i] === term)
+          {
+               ids.push(i);
+          }
+          if (prefix)
+          {
+               var lo = 0;
+               var hi = terms.length;
+               var k = this.data.prefix_length;
+               if (k && word.length >= k)
+               {
+                    var range = this.data.prefixes[word.substr(0, k)] || [0, 0];
+                    lo = range[0];
+                    hi = range[1];
+               }
+               for (i = lowerBound(terms, word, lo, hi); i < hi && terms[i].indexOf(word) === 0; i++)
+               {
+                    if (ids.indexOf(i) === -1)
+                    {
+                         ids.push(i);
+                    }
+               }
+          }
+          return ids;
+     };
+
+     Index.prototype.weight = function(termId)
+     {
+          var docs = this.data.docs.length;
+          return Math.log(1 + docs / Object.keys(this.postings(termId)).length);
+     };
+
+     // {doc: score} for the docs containing one of the words, in order
+     Index.prototype.phrase = function(words, prefix)
+     {
+          var scores = {};
+          var docs = this.data.docs;
+          var ids = [];
+          for (var w = 0; w < words.length; w++)
+          {
+               var termIds = this.lookup(words[w], prefix && w == words.length - 1);
+               if (!termIds.length)
+               {
+                    return scores;
+               }
+               ids.push(termIds);
+          }
+          // Positions of the phrase, starting from the first word
+          var self = this;
+          $.each(ids[0], function(x, firstId) {
+               $.each(self.postings(firstId), function(doc, positions) {
+                    var starts = positions;
+                    var weight = self.weight(firstId);
+                    for (var w = 1; w < ids.length && starts.length; w++)
+                    {
+                         var next = [];
+                         for (var t = 0; t < ids[w].length; t++)
+                         {
+                              var other = self.postings(ids[w][t])[doc];
+                              if (!other)
+                              {
+                                   continue;
+                              }
+                              for (var s = 0; s < starts.length; s++)
+                              {
+                                   if (other.indexOf(starts[s] + w) !== -1 && next.indexOf(starts[s]) === -1)
+                                   {
+                                        next.push(starts[s]);
+                                   }
+                              }
+                              weight += self.weight(ids[w][t]);
+                         }
+                         starts = next;
+                    }
+                    if (!starts.length)
+                    {
+                         return;
+                    }
+                    var headLength = docs[doc][2];
+                    var score = 0;
+                    for (var s = 0; s < starts.length; s++)
+                    {
+                         score += starts[s] < headLength ? 5 : 1;
+                    }
+                    scores[doc] = (scores[doc] || 0) + score * weight;
+               });
+          });
+          return scores;
+     };
+
+     Index.prototype.search = function(query)
+     {
+          var units = [];
+          var re = /"([^"]*)"|([^\s"]+)/g;
+          var match;
+          while ((match = re.exec(query)) !== null)
+          {
+               if (match[1] !== undefined)
+               {
+                    units.push(tokenize(match[1]));
+               }
+               else
+               {
+                    $.each(tokenize(match[2]), function(i, word) { units.push([word]); });
+               }
+          }
+          units = units.filter(function(words) { return words.length; });
+          if (!units.length)
+          {
+               return [];
+          }
+          var prefix = !/["\s]$/.test(query);
+          var total = null;
+          for (var u = 0; u < units.length; u++)
+          {
+               var scores = this.phrase(units[u], prefix && u == units.length - 1);
+               if (total === null)
+               {
+                    total = scores;
+               }
+               else
+               {
+                    var both = {};
+                    $.each(total, function(doc, score) {
+                         if (doc in scores)
+                         {
+                              both[doc] = score + scores[doc];
+                         }
+                    });
+                    total = both;
+               }
+          }
+          var docs = this.data.docs;
+          return $.map(total, function(score, doc) {
+               return {'title': docs[doc][0], 'url': docs[doc][1], 'text': docs[doc][3], 'score': score};
+          }).sort(function(a, b) { return b.score - a.score; });
+     };
+
+     function loadIndex()
+     {
+          var base = window.tipuesearch_index_url || scriptBase;
+          var lang = document.documentElement.lang;
+          return $.getJSON(base + 'tipuesearch_manifest.json').then(function(manifest) {
+               var files = manifest.languages[lang] || manifest.languages[manifest.default_language];
+               return $.getJSON(base + files[0]);
+          }).then(function(data) {
+               return new Index(data);
+          });
+     }
+
+     var indexPromise = null;
+
+     $.fn.localsearch = function(options) {
+
+          var set = $.extend({
+               'show': 10,
+               'showURL': true,
+               'newWindow': false
+          }, options);
+
+          if (indexPromise === null)
+          {
+               indexPromise = loadIndex();
+          }
+
+          function show(results)
+          {
+               var target = set.newWindow ? ' target="_blank"' : '';
+               var out = '<div id="tipue_search_results_count">' + results.length + ' ' +
+                    (typeof tipuesearch_string_5 !== 'undefined' ? tipuesearch_string_5 : 'results') + '</div>';
+               if (!results.length)
+               {
+                    out = '<div id="tipue_search_warning">' +
+                         (typeof tipuesearch_string_7 !== 'undefined' ? tipuesearch_string_7 : 'Nothing found.') + '</div>';
+               }
+               $.each(results.slice(0, set.show), function(i, result) {
+                    out += '<div class="tipue_search_result">';
+                    out += '<div class="tipue_search_content_title"><a href="' + result.url + '"' + target + '>' + escapeHtml(result.title) + '</a></div>';
+                    if (set.showURL)
+                    {
+                         out += '<div class="tipue_search_content_url"><a href="' + result.url + '"' + target + '>' + escapeHtml(result.url) + '</a></div>';
+                    }
+                    out += '<div class="tipue_search_content_text">' + escapeHtml(result.text) + '</div>';
+                    out += '</div>';
+               });
+               $('#tipue_search_content').html(out);
+          }
+
+          return this.each(function() {
+               var input = $(this);
+
+               function search()
+               {
+                    indexPromise.done(function(index) {
+                         show(index.search(input.val()));
+                    });
+               }
+
+               var q = new RegExp('[?&]q=([^&#]*)').exec(location.search);
+               if (q)
+               {
+                    input.val(decodeURIComponent(q[1].replace(/\+/g, ' ')));
+                    search();
+               }
+
+               input.keyup(function(event) {
+                    if (event.keyCode == 13)
+                    {
+                         search();
+                    }
+               });
+          });
+     };
+
+})(jQuery);
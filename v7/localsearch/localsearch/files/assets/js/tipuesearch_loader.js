@@ -0,0 +1,30 @@
+/*
+Loads the localsearch index written with LOCALSEARCH_SHARDED = True.
+
+Reads tipuesearch_manifest.json and fetches only the shards for the language
+of the page (the lang attribute of <html>, or the site's default language),
+adding their pages to the tipuesearch variable as they arrive.  Set
+tipuesearch_index_url before loading this file if the index is not in the
+same folder as this script.
+*/
+
+var tipuesearch = {"pages": []};
+
+(function() {
+     var base = window.tipuesearch_index_url;
+     if (!base)
+     {
+          var script = document.currentScript;
+          base = script ? script.src.replace(/[^\/]*$/, '') : '/assets/js/';
+     }
+     var lang = document.documentElement.lang;
+
+     $.getJSON(base + 'tipuesearch_manifest.json', function(manifest) {
+          var shards = manifest.languages[lang] || manifest.languages[manifest.default_language] || [];
+          $.each(shards, function(i, shard) {
+               $.getJSON(base + shard, function(pages) {
+                    Array.prototype.push.apply(tipuesearch.pages, pages);
+               });
+          });
+     });
+})();
@@ -25,16 +25,127 @@
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 from __future__ import print_function, unicode_literals
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import io
+import json
 import os
+import shutil
 import sys
 
 try:
+    from mincss import __version__ as mincss_version
     from mincss.processor import Processor
+    from lxml import etree
+    from lxml.cssselect import CSSSelector, ExpressionError, SelectorSyntaxError
 except ImportError:
     Processor = None
 
 from nikola.plugin_categories import Command
-from nikola.utils import req_missing, get_logger, STDERR_HANDLER
+from nikola.utils import req_missing, get_logger, makedirs, STDERR_HANDLER
+
+
+def file_hash(path):
+    """SHA-1 of the contents of a file."""
+    with open(path, 'rb') as inf:
+        return hashlib.sha1(inf.read()).hexdigest()
+
+
+class ProcessorAdapter(object):
+    """Everything the incremental mode needs from mincss's private Processor API.
+
+    Only mincss versions in VERSIONS are known to work; check supported()
+    before using the other methods.
+    """
+
+    VERSIONS = ((0, 11), (0, 12))
+    INTERNALS = ('_found', '_process_content', '_selector_query_found',
+                 '_find_all_ids_classes_and_tags', '_all_tags')
+
+    @classmethod
+    def supported(cls):
+        if Processor is None:
+            return False
+        try:
+            version = tuple(int(part) for part in mincss_version.split('.')[:2])
+        except ValueError:
+            return False
+        processor = Processor(preserve_remote_urls=False)
+        return (cls.VERSIONS[0] <= version < cls.VERSIONS[1] and
+                all(hasattr(processor, name) for name in cls.INTERNALS))
+
+    @staticmethod
+    def selectors(css):
+        """Return the simplified selectors mincss looks up in the pages for this CSS."""
+        p = Processor(preserve_remote_urls=False)
+        found = set()
+
+        def record(bodies, selector):
+            found.add(selector)
+            return True
+
+        p._found = record
+        p._process_content(css, [])
+        return found
+
+    @staticmethod
+    def minimize(css, used):
+        """Drop the rules of this CSS whose selectors are not in used."""
+        p = Processor(preserve_remote_urls=False)
+        p._found = lambda bodies, selector: selector in used
+        return p._process_content(css, [])
+
+    @staticmethod
+    def matcher(body, queries):
+        """Return a function telling if a selector, compiled in queries, is used in body."""
+        p = Processor(preserve_remote_urls=False)
+        p._all_tags.add('body')
+        p._find_all_ids_classes_and_tags(body)
+        p._selector_query_found = lambda bodies, selector: bool(queries[selector](body))
+        return lambda selector: p._found([body], selector)
+
+
+_worker_queries = (None, None)
+
+
+def _match_pages(pages, selectors, new):
+    """Return the selectors used in each page, and the stylesheets it links.
+
+    pages is a list of (path, only_new) pairs; selectors are compiled once per
+    worker process.  Stylesheets are (file name, no_mincss) pairs, honouring
+    data-mincss like mincss does.  For pages with only_new set, only the
+    selectors in new (which were not known in the previous run) are looked up.
+    """
+    global _worker_queries
+    if _worker_queries[0] != selectors:
+        _worker_queries = (selectors, dict((selector, CSSSelector(selector)) for selector in selectors))
+    queries = _worker_queries[1]
+
+    results = []
+    for path, only_new in pages:
+        with open(path, 'rb') as inf:
+            page = etree.fromstring(inf.read(), etree.HTMLParser(encoding='utf-8'))
+        used = []
+        links = []
+        if page is None:
+            results.append((used, links))
+            continue
+
+        for link in page.iter('link'):
+            href = link.attrib.get('href', '')
+            if link.attrib.get('rel', '') != 'stylesheet' and not href.lower().split('?')[0].endswith('.css'):
+                continue
+            data_attrib = link.attrib.get('data-mincss', '').lower()
+            if data_attrib == 'ignore':
+                continue
+            links.append((os.path.basename(href.split('?')[0]), data_attrib == 'no'))
+
+        bodies = list(page.iter('body'))[:1]
+        if bodies:
+            found = ProcessorAdapter.matcher(bodies[0], queries)
+            used = [selector for selector in (new if only_new else selectors) if found(selector)]
+        results.append((used, links))
+    return results
 
 
 class CommandMincss(Command):
@@ -44,6 +155,27 @@ class CommandMincss(Command):
     doc_usage = ""
     doc_purpose = "apply mincss to the generated site"
 
+    cmd_options = [
+        {
+            'name': 'incremental',
+            'long': 'incremental',
+            'short': 'i',
+            'type': bool,
+            'default': False,
+            'help': 'Remember the selectors used by each page, and only '
+                    'rewrite CSS files when they change.\n'
+        },
+        {
+            'name': 'workers',
+            'long': 'workers',
+            'short': 'j',
+            'type': int,
+            'default': 0,
+            'help': 'Number of processes matching pages in incremental mode '
+                    '(default: one per CPU).\n'
+        },
+    ]
+
     logger = get_logger('mincss', STDERR_HANDLER)
 
     def _execute(self, options, args):
@@ -53,7 +185,6 @@ class CommandMincss(Command):
             req_missing(['mincss'], 'use the "mincss" command')
             return
 
-        p = Processor(preserve_remote_urls=False)
         urls = []
         css_files = {}
         for root, dirs, files in os.walk(output_folder, followlinks=True):
@@ -68,8 +199,124 @@ class CommandMincss(Command):
                 if not f.endswith('.html'):
                     continue
                 urls.append(url)
+
+        if options['incremental'] and not ProcessorAdapter.supported():
+            self.logger.warn('Incremental mode needs mincss {0}.x, found {1}; processing the whole site.'.format(
+                '.'.join(str(part) for part in ProcessorAdapter.VERSIONS[0]), mincss_version))
+        elif options['incremental']:
+            self._execute_incremental(urls, css_files, options['workers'] or None)
+            return
+
+        p = Processor(preserve_remote_urls=False)
         p.process(*urls)
         for inline in p.links:
             fname = os.path.basename(inline.href)
             with open(css_files[fname], 'wb+') as outf:
                 outf.write(inline.after)
+
+    def _execute_incremental(self, urls, css_files, workers):
+        """Apply mincss using the selectors cached for each page by content hash.
+
+        Pages are matched against the selectors of all CSS files in a process
+        pool; a page seen before is only matched against selectors that are
+        new since the previous run.  The original CSS files are kept in the
+        cache folder, and a CSS file is only rewritten when the selectors
+        used by the site that appear in it change.
+        """
+        cache_folder = os.path.join(self.site.config['CACHE_FOLDER'], 'mincss')
+        cache_path = os.path.join(self.site.config['CACHE_FOLDER'], 'mincss.json')
+        try:
+            with io.open(cache_path, 'r', encoding='utf-8') as inf:
+                cache = json.load(inf)
+        except (IOError, OSError, ValueError):
+            cache = {'selectors': [], 'pages': {}, 'css': {}}
+
+        # A CSS file that is not what we wrote last time was regenerated by
+        # the build, and is the new original.
+        originals = {}
+        selectors = {}
+        for fname, path in css_files.items():
+            original = os.path.join(cache_folder, fname)
+            entry = cache['css'].get(fname)
+            if entry is None or entry['written'] != file_hash(path) or not os.path.isfile(original):
+                makedirs(cache_folder)
+                shutil.copyfile(path, original)
+                cache['css'][fname] = {'written': file_hash(path), 'used': None}
+            with io.open(original, 'r', encoding='utf-8') as inf:
+                originals[fname] = inf.read()
+            selectors[fname] = ProcessorAdapter.selectors(originals[fname])
+
+        # Selectors lxml cannot evaluate are always kept, like mincss does.
+        valid = set()
+        broken = set()
+        for selector in set().union(*selectors.values()):
+            try:
+                CSSSelector(selector)
+            except (SelectorSyntaxError, ExpressionError):
+                broken.add(selector)
+            else:
+                valid.add(selector)
+        new = valid - set(cache['selectors'])
+
+        hashes = dict((url, file_hash(url)) for url in urls)
+        jobs = {}
+        for url, digest in hashes.items():
+            if digest not in jobs and (digest not in cache['pages'] or new):
+                jobs[digest] = url
+        pages = {}
+        if jobs:
+            digests = list(jobs)
+            chunks = [
+                [(jobs[digest], digest in cache['pages']) for digest in digests[i:i + 64]]
+                for i in range(0, len(digests), 64)
+            ]
+            selectors_list, new_list = sorted(valid), sorted(new)
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = executor.map(
+                    _match_pages, chunks,
+                    [selectors_list] * len(chunks), [new_list] * len(chunks),
+                )
+                results = [result for chunk in results for result in chunk]
+            for digest, (used, links) in zip(digests, results):
+                old = cache['pages'].get(digest)
+                if old is not None:
+                    used = valid.intersection(old['used']).union(used)
+                    links = old['links']
+                pages[digest] = {'used': sorted(used), 'links': links}
+        for digest in set(hashes.values()) - set(pages):
+            pages[digest] = cache['pages'][digest]
+
+        used = set(broken)
+        linked = {}
+        for page in pages.values():
+            used.update(page['used'])
+            for fname, no_mincss in page['links']:
+                linked[fname] = linked.get(fname, False) or no_mincss
+
+        rewritten = 0
+        for fname, no_mincss in sorted(linked.items()):
+            if fname not in css_files:
+                continue
+            entry = cache['css'][fname]
+            kept = 'no' if no_mincss else hashlib.sha1(
+                '\n'.join(sorted(used & selectors[fname])).encode('utf-8')).hexdigest()
+            if entry['used'] == kept:
+                continue
+            after = originals[fname] if no_mincss else ProcessorAdapter.minimize(originals[fname], used)
+            with io.open(css_files[fname], 'w', encoding='utf-8') as outf:
+                outf.write(after)
+            entry['written'] = file_hash(css_files[fname])
+            entry['used'] = kept
+            rewritten += 1
+
+        cache = {
+            'selectors': sorted(valid),
+            'pages': pages,
+            'css': dict((fname, cache['css'][fname]) for fname in css_files),
+        }
+        makedirs(self.site.config['CACHE_FOLDER'])
+        with io.open(cache_path + '.tmp', 'w', encoding='utf-8') as outf:
+            outf.write(json.dumps(cache, sort_keys=True))
+        os.replace(cache_path + '.tmp', cache_path)
+        self.logger.info('Matched {0} of {1} pages, rewrote {2} CSS files'.format(
+            len(jobs), len(urls), rewritten))
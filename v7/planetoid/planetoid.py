@@ -25,11 +25,25 @@
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 from __future__ import print_function, unicode_literals
+import calendar
 import codecs
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import datetime
+import email.utils
 import hashlib
+import itertools
 from optparse import OptionParser
 import os
+import threading
+import time
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse  # NOQA
+
+import requests
 
 from doit.tools import timeout
 from nikola.plugin_categories import Command, Task
@@ -44,6 +58,7 @@ except ImportError:
 
 try:
     import peewee
+    from playhouse.migrate import SqliteMigrator, migrate
 except ImportError:
     peewee = None
 
@@ -67,12 +82,88 @@ if peewee is not None:
         content = peewee.TextField()
         link = peewee.CharField(max_length=200)
         title = peewee.CharField(max_length=200)
-        guid = peewee.CharField(max_length=200)
+        guid = peewee.CharField(max_length=200, unique=True)
+        content_hash = peewee.CharField(max_length=40, null=True)
+        generated_at = peewee.DateTimeField(null=True, index=True)
 
         class Meta:
             database = db
 
 
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def gen_id(entry):
+    h = hashlib.md5()
+    h.update(entry.feed.name.encode('utf8'))
+    h.update(entry.guid.encode('utf8'))
+    return h.hexdigest()
+
+
+def content_hash(date, title, content, link):
+    """Hash everything of an entry that ends up in its post."""
+    h = hashlib.sha1()
+    for value in (date.isoformat(), title, content, link):
+        h.update(value.encode('utf8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def post_paths(entry):
+    """Return the paths of the .meta and .txt files of an entry's post."""
+    unique_id = gen_id(entry)
+    return (os.path.join('posts', unique_id + '.meta'),
+            os.path.join('posts', unique_id + '.txt'))
+
+
+def generate_post(entry):
+    unique_id = gen_id(entry)
+    meta_path, post_path = post_paths(entry)
+    with codecs.open(meta_path, 'wb+', 'utf8') as fd:
+        fd.write('.. title: %s\n' % entry.title.replace('\n', ' '))
+        fd.write('.. slug: %s\n' % unique_id)
+        fd.write('.. date: %s\n' % entry.date.strftime('%Y/%m/%d %H:%M'))
+        fd.write('.. link: %s\n' % entry.link)
+    with codecs.open(post_path, 'wb+', 'utf8') as fd:
+        fd.write('.. raw:: html\n\n')
+        content = entry.content
+        if not content:
+            content = 'Sin contenido'
+        for line in content.splitlines():
+            fd.write('    %s\n' % line)
+
+
+def fetch_feed(url, etag, modified, timeout, retries, backoff=1):
+    """Download and parse a feed, using a conditional request.
+
+    Connection errors, timeouts and server errors are retried, waiting
+    backoff, 2 * backoff, ... seconds between attempts.  Returns the
+    response and the parsed feed (None if the feed was not modified).
+    """
+    headers = {}
+    if etag and etag != 'foo':
+        headers['If-None-Match'] = etag
+    if modified and modified.year > 1970:
+        headers['If-Modified-Since'] = email.utils.formatdate(
+            calendar.timegm(modified.timetuple()), usegmt=True)
+    attempt = 0
+    while True:
+        try:
+            response = requests.get(url, headers=headers, timeout=timeout)
+            if response.status_code not in RETRY_STATUSES or attempt >= retries:
+                break
+        except requests.RequestException:
+            if attempt >= retries:
+                raise
+        time.sleep(backoff * 2 ** attempt)
+        attempt += 1
+    if response.status_code == 304:
+        return response, None
+    response_headers = dict((k.lower(), v) for k, v in response.headers.items())
+    response_headers.setdefault('content-location', response.url)
+    return response, feedparser.parse(response.content, response_headers=response_headers)
+
+
 class Planetoid(Command, Task):
     """Maintain a planet-like thing."""
     name = "planetoid"
@@ -80,6 +171,25 @@ class Planetoid(Command, Task):
     def init_db(self):
         # setup database
         Feed.create_table(fail_silently=True)
+        table = Entry._meta.table_name
+        if table in db.get_tables():
+            # Databases created by older versions have no unique index on
+            # guid (which the bulk upsert needs) and miss some columns.
+            # Duplicates must go before Entry.create_table() adds the index.
+            if not any(index.unique and index.columns == ['guid'] for index in db.get_indexes(table)):
+                db.execute_sql(
+                    'DELETE FROM {0} WHERE id NOT IN '
+                    '(SELECT MAX(id) FROM {0} GROUP BY guid)'.format(table))
+            columns = [column.name for column in db.get_columns(table)]
+            migrator = SqliteMigrator(db)
+            migrate(*[
+                migrator.add_column(table, name, field)
+                for name, field in (
+                    ('content_hash', peewee.CharField(max_length=40, null=True)),
+                    ('generated_at', peewee.DateTimeField(null=True)),
+                ) if name not in columns
+            ])
+        # Creates the table, or the indexes it is missing
         Entry.create_table(fail_silently=True)
 
     def gen_tasks(self):
@@ -145,140 +255,223 @@ class Planetoid(Command, Task):
 
     def task_update_feeds(self):
         """Download feed contents, add entries to the database."""
-        def update_feed(feed):
-            modified = feed.last_modified.timetuple()
-            etag = feed.etag
-            try:
-                parsed = feedparser.parse(
-                    feed.url,
-                    etag=etag,
-                    modified=modified
-                )
-                feed.last_status = str(parsed.status)
-            except Exception:  # Probably a timeout
-                # TODO: log failure
-                return
-            if parsed.feed.get('title'):
-                LOGGER.info(parsed.feed.title)
-            else:
-                LOGGER.info(feed.url)
-            feed.etag = parsed.get('etag', 'foo')
-            modified = tuple(parsed.get('date_parsed', (1970, 1, 1)))[:6]
-            LOGGER.info("==========> %s", modified)
-            modified = datetime.datetime(*modified)
-            feed.last_modified = modified
-            feed.save()
-            # No point in adding items from missinfg feeds
-            if parsed.status > 400:
-                # TODO log failure
-                return
-            for entry_data in parsed.entries:
-                LOGGER.info("=========================================")
-                date = entry_data.get('published_parsed', None)
-                if date is None:
-                    date = entry_data.get('updated_parsed', None)
-                if date is None:
-                    LOGGER.error("Can't parse date from: %s", entry_data)
-                    return False
-                LOGGER.info("DATE:===> %s", date)
-                date = datetime.datetime(*(date[:6]))
-                title = "%s: %s" % (feed.name, entry_data.get('title', 'Sin título'))
-                content = entry_data.get('content', None)
-                if content:
-                    content = content[0].value
-                if not content:
-                    content = entry_data.get('description', None)
-                if not content:
-                    content = entry_data.get('summary', 'Sin contenido')
-                guid = str(entry_data.get('guid', entry_data.link))
-                link = entry_data.link
-                LOGGER.info(repr([date, title]))
-                e = list(Entry.select().where(Entry.guid == guid))
-                LOGGER.info(
-                    repr(dict(
-                        date=date,
-                        title=title,
-                        content=content,
-                        guid=guid,
-                        feed=feed,
-                        link=link,
-                    ))
-                )
-                if not e:
-                    entry = Entry.create(
-                        date=date,
-                        title=title,
-                        content=content,
-                        guid=guid,
-                        feed=feed,
-                        link=link,
-                    )
-                else:
-                    entry = e[0]
-                    entry.date = date
-                    entry.title = title
-                    entry.content = content
-                    entry.link = link
-                entry.save()
-        flag = False
-        for feed in Feed.select():
-            flag = True
-            task = {
+        workers = self.site.config.get('PLANETOID_WORKERS', 1)
+        uptodate = [timeout(datetime.timedelta(minutes=self.site.config.get('PLANETOID_REFRESH', 60)))]
+        feeds = list(Feed.select())
+        if feeds and workers > 1:
+            # One task, so all the due feeds are fetched at the same time
+            yield {
+                'basename': self.name + "_fetch_feed",
+                'name': 'all',
+                'actions': [(self.update_feeds, (feeds, workers))],
+                'uptodate': uptodate,
+            }
+            return
+        for feed in feeds:
+            yield {
                 'basename': self.name + "_fetch_feed",
                 'name': str(feed.url),
-                'actions': [(update_feed, (feed, ))],
-                'uptodate': [timeout(datetime.timedelta(minutes=self.site.config.get('PLANETOID_REFRESH', 60)))],
+                'actions': [(self.update_feeds, ([feed], 1))],
+                'uptodate': uptodate,
             }
-            yield task
-        if not flag:
+        if not feeds:
             yield {
                 'basename': self.name + "_fetch_feed",
                 'name': '',
                 'actions': [],
             }
 
+    def update_feeds(self, feeds, workers):
+        """Fetch feeds in a pool of threads, and store them as they arrive.
+
+        Only the downloads happen in the threads, the database is always
+        written from this one.
+        """
+        host_limit = self.site.config.get('PLANETOID_HOST_CONCURRENCY', 2)
+        host_semaphores = defaultdict(lambda: threading.Semaphore(host_limit))
+        lock = threading.Lock()
+
+        def fetch(feed):
+            with lock:
+                semaphore = host_semaphores[urlparse(feed.url).netloc]
+            with semaphore:
+                return fetch_feed(
+                    feed.url, feed.etag, feed.last_modified,
+                    self.site.config.get('PLANETOID_TIMEOUT', 30),
+                    self.site.config.get('PLANETOID_RETRIES', 2),
+                )
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = dict((executor.submit(fetch, feed), feed) for feed in feeds)
+            for future in as_completed(futures):
+                feed = futures[future]
+                try:
+                    response, parsed = future.result()
+                except Exception as e:
+                    LOGGER.error("Can't fetch %s: %s", feed.url, e)
+                    feed.last_status = str(e)[:255]
+                    feed.save()
+                    continue
+                self.store_feed(feed, response, parsed)
+
+    def store_feed(self, feed, response, parsed):
+        """Update a feed's status and upsert its entries."""
+        feed.last_status = str(response.status_code)
+        if response.status_code == 304:
+            LOGGER.info("%s: not modified", feed.url)
+            feed.save()
+            return
+        if parsed.feed.get('title'):
+            LOGGER.info(parsed.feed.title)
+        else:
+            LOGGER.info(feed.url)
+        feed.etag = response.headers.get('ETag', 'foo')[:200]
+        modified = email.utils.parsedate(response.headers.get('Last-Modified', ''))
+        if modified is None:
+            modified = (1970, 1, 1)
+        feed.last_modified = datetime.datetime(*modified[:6])
+        feed.save()
+        # No point in adding items from missing feeds
+        if response.status_code >= 400:
+            LOGGER.error("Can't fetch %s: HTTP %s", feed.url, response.status_code)
+            return
+        rows = {}
+        cutoff = self.retention_cutoff()
+        for entry_data in parsed.entries:
+            date = entry_data.get('published_parsed', None)
+            if date is None:
+                date = entry_data.get('updated_parsed', None)
+            if date is None:
+                LOGGER.error("Can't parse date from: %s", entry_data)
+                continue
+            date = datetime.datetime(*(date[:6]))
+            if cutoff is not None and date < cutoff:
+                continue
+            title = "%s: %s" % (feed.name, entry_data.get('title', 'Sin título'))
+            content = entry_data.get('content', None)
+            if content:
+                content = content[0].value
+            if not content:
+                content = entry_data.get('description', None)
+            if not content:
+                content = entry_data.get('summary', 'Sin contenido')
+            link = entry_data.get('link', '')
+            guid = str(entry_data.get('guid', link))
+            rows[guid] = dict(
+                date=date,
+                title=title,
+                content=content,
+                guid=guid,
+                feed=feed.id,
+                link=link,
+                content_hash=content_hash(date, title, content, link),
+            )
+        LOGGER.info("%s: %d entries", feed.url, len(rows))
+        with db.atomic():
+            for batch in peewee.chunked(list(rows.values()), 100):
+                Entry.insert_many(batch).on_conflict(
+                    conflict_target=[Entry.guid],
+                    preserve=[Entry.date, Entry.title, Entry.content, Entry.link, Entry.content_hash],
+                    # Unchanged entries are left alone, changed ones are
+                    # generated again.
+                    update={Entry.generated_at: None},
+                    where=(Entry.content_hash.is_null() | (Entry.content_hash != peewee.EXCLUDED.content_hash)),
+                ).execute()
+
     def task_generate_posts(self):
-        """Generate post files for the blog entries."""
-        def gen_id(entry):
-            h = hashlib.md5()
-            h.update(entry.feed.name.encode('utf8'))
-            h.update(entry.guid.encode('utf8'))
-            return h.hexdigest()
-
-        def generate_post(entry):
-            unique_id = gen_id(entry)
-            meta_path = os.path.join('posts', unique_id + '.meta')
-            post_path = os.path.join('posts', unique_id + '.txt')
-            with codecs.open(meta_path, 'wb+', 'utf8') as fd:
-                fd.write('.. title: %s\n' % entry.title.replace('\n', ' '))
-                fd.write('.. slug: %s\n' % unique_id)
-                fd.write('.. date: %s\n' % entry.date.strftime('%Y/%m/%d %H:%M'))
-                fd.write('.. link: %s\n' % entry.link)
-            with codecs.open(post_path, 'wb+', 'utf8') as fd:
-                fd.write('.. raw:: html\n\n')
-                content = entry.content
-                if not content:
-                    content = 'Sin contenido'
-                for line in content.splitlines():
-                    fd.write('    %s\n' % line)
+        """Generate post files for the new and changed blog entries."""
+        kw = {
+            'max_age': self.site.config.get('PLANETOID_MAX_AGE', None),
+            'max_entries': self.site.config.get('PLANETOID_MAX_ENTRIES', None),
+        }
+        post_files = self.post_files()
+        yield {
+            'basename': self.name + "_generate_posts",
+            'name': 'pending',
+            'actions': [(self.generate_posts, (post_files,))],
+            'targets': [path for paths in post_files.values() for path in paths],
+            'task_dep': [self.name + "_fetch_feed"],
+            'uptodate': [config_changed(kw), self.nothing_to_generate],
+            'clean': True,
+        }
+
+    def post_files(self):
+        """Return the post files of every entry, by entry id."""
+        query = Entry.select(Entry.id, Entry.guid, Feed.name).join(Feed)
+        return dict((entry.id, post_paths(entry)) for entry in query)
 
+    def nothing_to_generate(self):
+        """Check, after the feeds are fetched, that no entry is waiting to be written or pruned."""
+        if Entry.select().where(Entry.generated_at.is_null()).exists():
+            return False
+        cutoff = self.retention_cutoff()
+        return cutoff is None or not Entry.select().where(Entry.date < cutoff).exists()
+
+    def generate_posts(self, post_files):
+        """Prune old entries, then write the entries not generated yet.
+
+        Entries get their generated_at cleared whenever their content
+        changes, so only those, and the ones whose post files were deleted,
+        need to be looked at.  post_files is post_files() from when the
+        task was created; entries added since then are not generated yet.
+        """
         if not os.path.isdir('posts'):
             os.mkdir('posts')
-        flag = False
-        for entry in Entry.select().order_by(Entry.date.desc()):
-            flag = True
-            entry_id = gen_id(entry)
-            yield {
-                'basename': self.name + "_generate_posts",
-                'targets': [os.path.join('posts', entry_id + '.meta'), os.path.join('posts', entry_id + '.txt')],
-                'name': entry_id,
-                'actions': [(generate_post, (entry,))],
-                'uptodate': [config_changed({1: entry})],
-                'task_dep': [self.name + "_fetch_feed"],
-            }
-        if not flag:
-            yield {
-                'basename': self.name + "_generate_posts",
-                'name': '',
-                'actions': [],
-            }
+        self.prune_entries()
+        existing = set(os.listdir('posts'))
+        missing = [
+            entry_id for entry_id, paths in post_files.items()
+            if not all(os.path.basename(path) in existing for path in paths)
+        ]
+        query = Entry.select(Entry, Feed).join(Feed)
+        pending = [query.where(Entry.generated_at.is_null()).order_by(Entry.date.desc())]
+        pending.extend(query.where(Entry.id.in_(batch)) for batch in peewee.chunked(missing, 500))
+        generated = set()
+        for entry in itertools.chain(*pending):
+            if entry.id not in generated:
+                generate_post(entry)
+                generated.add(entry.id)
+        LOGGER.info("Generated %d posts", len(generated))
+        now = datetime.datetime.utcnow()
+        with db.atomic():
+            for batch in peewee.chunked(generated, 500):
+                Entry.update(generated_at=now).where(Entry.id.in_(batch)).execute()
+
+    def retention_cutoff(self):
+        """Return the date before which entries are not kept, or None.
+
+        This is the later of PLANETOID_MAX_AGE days ago and the date of
+        the PLANETOID_MAX_ENTRIES-th newest entry.
+        """
+        cutoffs = []
+        max_age = self.site.config.get('PLANETOID_MAX_AGE', None)
+        if max_age:
+            cutoffs.append(datetime.datetime.utcnow() - datetime.timedelta(days=max_age))
+        max_entries = self.site.config.get('PLANETOID_MAX_ENTRIES', None)
+        if max_entries:
+            oldest_kept = (Entry.select(Entry.date)
+                           .order_by(Entry.date.desc())
+                           .offset(max_entries - 1).limit(1).scalar())
+            if oldest_kept is not None:
+                cutoffs.append(oldest_kept)
+        return max(cutoffs) if cutoffs else None
+
+    def prune_entries(self):
+        """Delete the entries older than the retention cutoff, and their posts."""
+        cutoff = self.retention_cutoff()
+        if cutoff is None:
+            return
+        old = Entry.select(Entry, Feed).join(Feed).where(Entry.date < cutoff)
+        pruned = []
+        for entry in old:
+            unique_id = gen_id(entry)
+            for ext in ('.meta', '.txt'):
+                path = os.path.join('posts', unique_id + ext)
+                if os.path.exists(path):
+                    os.unlink(path)
+            pruned.append(entry.id)
+        with db.atomic():
+            for batch in peewee.chunked(pruned, 500):
+                Entry.delete().where(Entry.id.in_(batch)).execute()
+        if pruned:
+            LOGGER.info("Pruned %d entries older than %s", len(pruned), cutoff)
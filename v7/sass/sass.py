@@ -27,13 +27,259 @@
 from __future__ import unicode_literals
 
 import codecs
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
+import json
 import os
+import re
 import sys
 import subprocess
 
 from nikola.plugin_categories import Task
 from nikola import utils
 
+IMPORT_RE = re.compile(r'^\s*@(import|use|forward)\s+([^;{\n]+)', re.MULTILINE)
+QUOTED_RE = re.compile(r'"([^"]+)"|\'([^\']+)\'')
+
+
+def find_imports(text):
+    """Return the names of the files imported by a Sass source."""
+    names = []
+    for rule, args in IMPORT_RE.findall(text):
+        quoted = [a or b for a, b in QUOTED_RE.findall(args)]
+        if rule != 'import':
+            # @use "name" as x / @forward "name" show y: only the first one
+            quoted = quoted[:1]
+        elif not quoted:
+            # Indented syntax allows unquoted imports
+            quoted = [name.strip() for name in args.split(',')]
+        for name in quoted:
+            if (name.startswith(('sass:', 'http://', 'https://', '//', 'url(')) or
+                    name.endswith('.css')):
+                continue
+            names.append(name)
+    return names
+
+
+# Output styles accepted by libsass (and sassc), and by dart-sass
+LIBSASS_STYLES = ('nested', 'expanded', 'compact', 'compressed')
+DART_SASS_STYLES = ('expanded', 'compressed')
+
+
+def output_style_for(compiler, style, logger):
+    """Return the output style to give compiler for SASS_OUTPUT_STYLE, or None for its default."""
+    if style is None:
+        return None
+    if style not in LIBSASS_STYLES:
+        logger.error("Unknown SASS_OUTPUT_STYLE '{0}' (expected one of {1}), using the compiler's default.".format(
+            style, ', '.join(LIBSASS_STYLES)))
+        return None
+    if os.path.basename(compiler) in ('libsass', 'sassc') or style in DART_SASS_STYLES:
+        return style
+    logger.error("SASS_OUTPUT_STYLE '{0}' needs SASS_COMPILER 'libsass' or 'sassc', {1} only "
+                 "accepts {2}; using 'expanded'.".format(style, compiler, ' or '.join(DART_SASS_STYLES)))
+    return 'expanded'
+
+
+# SASS_OPTIONS which libsass.compile() can take as keyword arguments
+LIBSASS_OPTIONS = {
+    '-I': 'include_paths',
+    '--load-path': 'include_paths',
+    '--include-path': 'include_paths',
+    '-t': 'output_style',
+    '--style': 'output_style',
+    '--precision': 'precision',
+}
+LIBSASS_FLAGS = {
+    '-l': 'source_comments',
+    '--line-comments': 'source_comments',
+    '--line-numbers': 'source_comments',
+    '--source-comments': 'source_comments',
+}
+
+
+def libsass_options(options):
+    """Return the libsass.compile() keyword arguments for SASS_OPTIONS, or None if one has no equivalent."""
+    kwargs = {}
+    options = list(options)
+    while options:
+        option = options.pop(0)
+        if option in LIBSASS_FLAGS:
+            kwargs[LIBSASS_FLAGS[option]] = True
+            continue
+        if option.startswith('-I') and option != '-I':
+            name, value = '-I', option[2:]
+        elif '=' in option:
+            name, value = option.split('=', 1)
+        elif options:
+            name, value = option, options.pop(0)
+        else:
+            return None
+        key = LIBSASS_OPTIONS.get(name)
+        if key is None:
+            return None
+        if key == 'include_paths':
+            kwargs.setdefault(key, []).append(value)
+        elif key == 'precision':
+            try:
+                kwargs[key] = int(value)
+            except ValueError:
+                return None
+        else:
+            kwargs[key] = value
+    return kwargs
+
+
+def import_libsass():
+    """Return the libsass module, or None if it is not installed.
+
+    libsass is imported as "sass", like this plugin, so when the plugin was
+    imported under that name, look for libsass elsewhere on the path.
+    """
+    try:
+        import sass as libsass
+    except ImportError:
+        return None
+    if hasattr(libsass, 'compile'):
+        return libsass
+    try:
+        from importlib.machinery import PathFinder
+        from importlib.util import module_from_spec
+    except ImportError:
+        return None
+    here = os.path.dirname(os.path.abspath(__file__))
+    path = [p for p in sys.path if os.path.abspath(p or '.') != here]
+    spec = PathFinder.find_spec('sass', path)
+    if spec is None:
+        return None
+    libsass = module_from_spec(spec)
+    spec.loader.exec_module(libsass)
+    return libsass
+
+
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as inf:
+        for chunk in iter(lambda: inf.read(65536), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def target_digest(config, deps):
+    """Return a hash of config and of the contents of the files a target is compiled from."""
+    h = hashlib.sha1(config.encode('utf-8'))
+    for dep in deps:
+        h.update(dep.encode('utf-8'))
+        h.update(file_hash(dep).encode('ascii'))
+    return h.hexdigest()
+
+
+class TargetHashes(object):
+    """The target_digest() each CSS file was last compiled from.
+
+    When several targets are compiled by one task, doit's 'changed' does not
+    tell which of them are stale: if any target is missing, it lists every
+    file_dep.  So the task compares each target's digest with this instead.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with codecs.open(path, 'rb', 'utf-8') as inf:
+                self.hashes = json.load(inf)
+        except (IOError, OSError, ValueError):
+            self.hashes = {}
+
+    def is_stale(self, dst, digest, outputs):
+        return self.hashes.get(dst) != digest or not all(os.path.exists(path) for path in outputs)
+
+    def set(self, dst, digest):
+        self.hashes[dst] = digest
+
+    def discard(self, dst):
+        self.hashes.pop(dst, None)
+
+    def save(self):
+        utils.makedirs(os.path.dirname(self.path))
+        with codecs.open(self.path, 'wb+', 'utf-8') as outf:
+            json.dump(self.hashes, outf)
+
+
+class ImportGraph(object):
+    """The @import/@use/@forward graph of the Sass sources.
+
+    sources maps the copies of the sources in the cache folder (which is
+    where they are compiled from) to the original files.  The imports found
+    in each original are cached in cache_path, keyed by its modification
+    time and size, so unchanged files are not parsed again.
+    """
+
+    def __init__(self, cache_path, sources, root, extensions):
+        self.cache_path = cache_path
+        self.sources = sources
+        self.root = root
+        self.extensions = extensions
+        self.dirty = False
+        try:
+            with codecs.open(cache_path, 'rb', 'utf-8') as inf:
+                self.cache = json.load(inf)
+        except (IOError, OSError, ValueError):
+            self.cache = {}
+
+    def imports(self, path):
+        """Return the cached paths of the files imported by path."""
+        source = self.sources[path]
+        stat = os.stat(source)
+        entry = self.cache.get(source)
+        if entry is None or entry['mtime'] != stat.st_mtime or entry['size'] != stat.st_size:
+            with codecs.open(source, 'rb', 'utf-8') as inf:
+                entry = {'mtime': stat.st_mtime, 'size': stat.st_size, 'imports': find_imports(inf.read())}
+            self.cache[source] = entry
+            self.dirty = True
+        resolved = []
+        for name in entry['imports']:
+            dep = self.resolve(name, path)
+            if dep is not None:
+                resolved.append(dep)
+        return resolved
+
+    def resolve(self, name, importer):
+        """Find the file imported as name, like the Sass compiler would."""
+        for folder in (os.path.dirname(importer), self.root):
+            path = os.path.normpath(os.path.join(folder, name))
+            dirname, basename = os.path.split(path)
+            if basename.endswith(self.extensions):
+                candidates = [path, os.path.join(dirname, '_' + basename)]
+            else:
+                candidates = [
+                    os.path.join(base, prefix + filename + ext)
+                    for base, filename in ((dirname, basename), (path, 'index'))
+                    for prefix in ('', '_')
+                    for ext in self.extensions
+                ]
+            for candidate in candidates:
+                if candidate in self.sources:
+                    return candidate
+        return None
+
+    def dependencies(self, path):
+        """Return path and everything it imports, directly or not."""
+        seen = set([path])
+        stack = [path]
+        while stack:
+            for dep in self.imports(stack.pop()):
+                if dep not in seen:
+                    seen.add(dep)
+                    stack.append(dep)
+        return sorted(seen)
+
+    def save(self):
+        if self.dirty:
+            utils.makedirs(os.path.dirname(self.cache_path))
+            with codecs.open(self.cache_path, 'wb+', 'utf-8') as outf:
+                json.dump(self.cache, outf)
+            self.dirty = False
+
 
 class BuildSass(Task):
     """Generate CSS out of Sass sources."""
@@ -48,9 +294,20 @@ class BuildSass(Task):
         self.compiler_name = self.site.config['SASS_COMPILER']
         self.compiler_options = self.site.config['SASS_OPTIONS']
 
+        libsass_kwargs = {}
+        if self.compiler_name == 'libsass':
+            libsass_kwargs = libsass_options(self.compiler_options)
+            if libsass_kwargs is None:
+                self.logger.warning("SASS_OPTIONS {0} cannot all be given to libsass, compiling with sassc "
+                                    "instead.".format(' '.join(self.compiler_options)))
+                self.compiler_name = 'sassc'
+        libsass = import_libsass() if self.compiler_name == 'libsass' else None
+
         kw = {
             'cache_folder': self.site.config['CACHE_FOLDER'],
             'themes': self.site.THEMES,
+            'output_style': output_style_for(self.compiler_name, self.site.config.get('SASS_OUTPUT_STYLE', None), self.logger),
+            'source_maps': self.compiler_name == 'libsass' and self.site.config.get('SASS_SOURCE_MAPS', False),
         }
         tasks = {}
 
@@ -85,19 +342,27 @@ class BuildSass(Task):
 
         # Build targets and write CSS files
         dst_dir = os.path.join(self.site.config['OUTPUT_FOLDER'], 'assets', 'css')
-        # Make everything depend on all sources, rough but enough
-        deps = []
-        for task in tasks.keys():
-            for ext in self.sources_ext:
-                if task.endswith(ext):
-                    deps.append(task)
+        # Each target depends on the sources it imports
+        graph = ImportGraph(
+            os.path.join(kw['cache_folder'], 'sass_imports.json'),
+            dict((os.path.normpath(name), task['file_dep'][0]) for name, task in tasks.items()
+                 if name.endswith(self.sources_ext)),
+            os.path.normpath(os.path.join(kw['cache_folder'], self.sources_folder)),
+            self.sources_ext,
+        )
+        workers = self.site.config.get('SASS_WORKERS', 1)
 
         def compile_target(target, dst):
             utils.makedirs(dst_dir)
             run_in_shell = sys.platform == 'win32'
             src = os.path.join(kw['cache_folder'], self.sources_folder, target)
+            if self.compiler_name == 'libsass':
+                return compile_in_process(src, dst)
+            output_style = []
+            if kw['output_style']:
+                output_style = ['--style', kw['output_style']]
             try:
-                compiled = subprocess.check_output([self.compiler_name] + self.compiler_options + [src], shell=run_in_shell)
+                compiled = subprocess.check_output([self.compiler_name] + self.compiler_options + output_style + [src], shell=run_in_shell)
             except OSError:
                 utils.req_missing([self.compiler_name],
                                   'build Sass files (and use this theme)',
@@ -105,6 +370,59 @@ class BuildSass(Task):
             with open(dst, "wb+") as outf:
                 outf.write(compiled)
 
+        def compile_in_process(src, dst):
+            """Compile with libsass, writing a source map next to dst if enabled."""
+            if libsass is None:
+                utils.req_missing(['libsass'], 'build Sass files in-process (SASS_COMPILER = "libsass")', True, False)
+            options = dict(libsass_kwargs)
+            options.update({
+                'filename': src,
+                # Like --style after SASS_OPTIONS on the command line, SASS_OUTPUT_STYLE wins
+                'output_style': kw['output_style'] or libsass_kwargs.get('output_style', 'nested'),
+                'include_paths': libsass_kwargs.get('include_paths', []) + [os.path.join(kw['cache_folder'], self.sources_folder)],
+            })
+            if kw['source_maps']:
+                options.update({
+                    'source_map_filename': dst + '.map',
+                    'output_filename_hint': dst,
+                    'source_map_contents': True,
+                })
+                compiled, source_map = libsass.compile(**options)
+                with codecs.open(dst + '.map', 'wb+', 'utf-8') as outf:
+                    outf.write(source_map)
+            else:
+                compiled = libsass.compile(**options)
+            with codecs.open(dst, 'wb+', 'utf-8') as outf:
+                outf.write(compiled)
+
+        def compile_targets(jobs):
+            """Compile the targets whose sources or config changed concurrently."""
+            hashes = TargetHashes(os.path.join(kw['cache_folder'], 'sass_targets.json'))
+            config = json.dumps([kw, self.compiler_name, self.compiler_options], sort_keys=True)
+            stale = []
+            for target, dst, deps in jobs:
+                digest = target_digest(config, deps)
+                if hashes.is_stale(dst, digest, with_map(dst)):
+                    stale.append((target, dst, digest))
+            self.logger.info('compiling {0} of {1} targets using {2} workers'.format(len(stale), len(jobs), workers))
+            errors = []
+            try:
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    futures = dict((executor.submit(compile_target, target, dst), (dst, digest)) for target, dst, digest in stale)
+                    for future in as_completed(futures):
+                        dst, digest = futures[future]
+                        try:
+                            future.result()
+                        except Exception as e:
+                            hashes.discard(dst)
+                            errors.append(e)
+                        else:
+                            hashes.set(dst, digest)
+            finally:
+                hashes.save()
+            if errors:
+                raise errors[0]
+
         yield self.group_task()
 
         # We can have file conflicts.  This is a way to prevent them.
@@ -114,6 +432,11 @@ class BuildSass(Task):
         # If we didn’t do this, there would be a cryptic message from doit
         # instead.
         seennames = {}
+        jobs = []
+
+        def with_map(dst):
+            return [dst, dst + '.map'] if kw['source_maps'] else [dst]
+
         for target in targets:
             base = os.path.splitext(target)[0]
             dst = os.path.join(dst_dir, base + ".css")
@@ -126,10 +449,33 @@ class BuildSass(Task):
             else:
                 seennames.update({base: target})
 
+            src = os.path.normpath(os.path.join(kw['cache_folder'], self.sources_folder, target))
+            if src in graph.sources:
+                deps = graph.dependencies(src)
+            else:
+                deps = []
+            jobs.append((target, dst, deps))
+
+        graph.save()
+
+        if workers > 1 and jobs:
+            yield {
+                'basename': self.name,
+                'name': 'all',
+                'targets': [target for _, dst, _ in jobs for target in with_map(dst)],
+                'file_dep': sorted(set(dep for _, _, deps in jobs for dep in deps)),
+                'task_dep': ['prepare_sass_sources'],
+                'actions': ((compile_targets, [jobs]), ),
+                'uptodate': [utils.config_changed(kw)],
+                'clean': True
+            }
+            return
+
+        for target, dst, deps in jobs:
             yield {
                 'basename': self.name,
                 'name': dst,
-                'targets': [dst],
+                'targets': with_map(dst),
                 'file_dep': deps,
                 'task_dep': ['prepare_sass_sources'],
                 'actions': ((compile_target, [target, dst]), ),
@@ -26,22 +26,157 @@
 
 from __future__ import print_function, unicode_literals
 
+import hashlib
+import io
 import json
 import os
 
 import gensim
+import numpy
+import scipy.sparse
 from stop_words import get_stop_words
 
 from nikola.plugin_categories import Task
 from nikola import utils
 
 
+class SetSimilarity(object):
+    """Similarity of sets (tags, title words) as ``2 * |A & B| / (|A| + |B|)``, using a sparse matrix."""
+
+    def __init__(self, sets):
+        vocabulary = {}
+        indices = []
+        indptr = [0]
+        for items in sets:
+            indices.extend(vocabulary.setdefault(item, len(vocabulary)) for item in set(items))
+            indptr.append(len(indices))
+        self.matrix = scipy.sparse.csr_matrix(
+            (numpy.ones(len(indices)), indices, indptr), shape=(len(sets), max(len(vocabulary), 1)))
+        self.transposed = self.matrix.T.tocsr()
+        self.sizes = numpy.asarray(self.matrix.sum(axis=1)).ravel()
+
+    def similarities(self, i):
+        """Similarity of set i to all sets, as an array."""
+        sims = numpy.zeros(len(self.sizes))
+        if self.sizes[i]:
+            intersections = (self.matrix[i] * self.transposed).tocoo()
+            # Totally making this up
+            sims[intersections.col] = 2.0 * intersections.data / (self.sizes[i] + self.sizes[intersections.col])
+        return sims
+
+
+class SimilarityModel(object):
+    """Tag, title and body similarity of all posts in one language.
+
+    The words of every post and the LSI similarity index are kept in
+    ``cache_folder``. Only posts whose source changed are read again, and
+    the index is only rebuilt if any post changed.
+    """
+
+    num_topics = 2
+
+    def __init__(self, posts, lang, split_text, cache_folder, logger):
+        self.posts = posts
+        self.lang = lang
+        self.logger = logger
+        self.cache_folder = cache_folder
+        self.tags = SetSimilarity([p.tags for p in posts])
+        self.titles = SetSimilarity([split_text(p.title(lang)) for p in posts])
+        self.index_of = {p.source_path: i for i, p in enumerate(posts)}
+        texts, fingerprint = self._load_texts(split_text)
+        if not self._load_model(fingerprint):
+            self._build_model(texts, fingerprint)
+
+    def _path(self, name):
+        return os.path.join(self.cache_folder, name)
+
+    def _load_texts(self, split_text):
+        """Return the words of every post, only extracting the text of changed posts."""
+        try:
+            with io.open(self._path('texts.json'), 'r', encoding='utf-8') as inf:
+                cached = json.load(inf)
+        except (IOError, ValueError):
+            cached = {}
+        texts = []
+        documents = {}
+        extracted = 0
+        for p in self.posts:
+            try:
+                with open(p.translated_source_path(self.lang), 'rb') as inf:
+                    source_hash = hashlib.sha256(inf.read()).hexdigest()
+            except IOError:
+                source_hash = ''
+            if p.source_path in cached and cached[p.source_path][0] == source_hash:
+                words = cached[p.source_path][1]
+            else:
+                words = split_text(p.text(strip_html=True, lang=self.lang))
+                extracted += 1
+            documents[p.source_path] = [source_hash, words]
+            texts.append(words)
+        self.logger.info("{0}: extracted text of {1} of {2} posts".format(self.lang, extracted, len(self.posts)))
+        if extracted or len(cached) != len(documents):
+            utils.makedirs(self.cache_folder)
+            with io.open(self._path('texts.json'), 'w', encoding='utf-8') as outf:
+                outf.write(json.dumps(documents, ensure_ascii=False))
+        fingerprint = hashlib.sha256(json.dumps(
+            [self.num_topics] + [[p.source_path, documents[p.source_path][0]] for p in self.posts]).encode('utf-8')).hexdigest()
+        return texts, fingerprint
+
+    def _load_model(self, fingerprint):
+        try:
+            with io.open(self._path('model.json'), 'r', encoding='utf-8') as inf:
+                if json.load(inf)['fingerprint'] != fingerprint:
+                    return False
+            self.index = gensim.similarities.MatrixSimilarity.load(self._path('index'))
+        except Exception as e:  # noqa
+            self.logger.debug("{0}: cannot load model: {1}".format(self.lang, e))
+            return False
+        return True
+
+    def _build_model(self, texts, fingerprint):
+        self.logger.info("{0}: building model".format(self.lang))
+        dictionary = gensim.corpora.Dictionary(texts)
+        corpus = [dictionary.doc2bow(text) for text in texts]
+        lsi = gensim.models.LsiModel(corpus, id2word=dictionary, num_topics=self.num_topics)
+        self.index = gensim.similarities.MatrixSimilarity(lsi[corpus], num_features=self.num_topics)
+        utils.makedirs(self.cache_folder)
+        self.index.save(self._path('index'))
+        with io.open(self._path('model.json'), 'w', encoding='utf-8') as outf:
+            outf.write(json.dumps({'fingerprint': fingerprint}))
+
+    def related(self, post, count):
+        """Return the ``count`` posts most similar to post, best first, as dicts."""
+        i = self.index_of[post.source_path]
+        tag_sims = self.tags.similarities(i)
+        title_sims = self.titles.similarities(i)
+        # Rows of the index are the normalized LSI vectors of the posts
+        body_sims = self.index.index.dot(self.index.index[i]).astype(float)
+        full_sims = tag_sims + title_sims + body_sims * 1.5
+        full_sims[i] = -numpy.inf
+        count = min(count, len(self.posts) - 1)
+        if count <= 0:
+            return []
+        best = numpy.argpartition(-full_sims, count - 1)[:count]
+        best = best[numpy.argsort(-full_sims[best], kind='stable')]
+        data = []
+        for j in best:
+            p = self.posts[j]
+            data.append({
+                'url': '/' + p.destination_path(sep='/'),
+                'title': p.title(),
+                'score': float(full_sims[j]),
+                'detailed_score': [float(tag_sims[j]), float(title_sims[j]), float(body_sims[j])],
+            })
+        return data
+
+
 class Similarity(Task):
     """Calculate post similarity."""
     name = "similarity"
 
     def set_site(self, site):
         self.site = site
+        self.logger = utils.get_logger('similarity', utils.STDERR_HANDLER)
 
     def gen_tasks(self):
         """Build similarity data for each post."""
@@ -56,76 +191,68 @@ class Similarity(Task):
 
         stopwords = {}
         for l in self.site.translations:
-            stopwords[l] = get_stop_words(l)
-
-        def split_text(text, lang="en"):
-            words = text.lower().split()
-            return [w for w in words if w not in stopwords[lang]]
+            stopwords[l] = set(get_stop_words(l))
 
         yield self.group_task()
 
-        def tags_similarity(p1, p2):
-            t1 = set(p1.tags)
-            t2 = set(p2.tags)
-            if not (t1 and t2):
-                return 0
-            # Totally making this up
-            return 2.0 * len(t1.intersection(t2)) / (len(t1) + len(t2))
+        models = {}
 
-        def title_similarity(p1, p2):
-            t1 = set(split_text(p1.title()))
-            t2 = set(split_text(p2.title()))
-            if not (t1 and t2):
-                return 0
-            # Totally making this up
-            return 2.0 * len(t1.intersection(t2)) / (len(t1) + len(t2))
-
-        indexes = {}
-        dictionaries = {}
-        lsis = {}
-
-        def create_idx(indexes, dictionaries, lsis, lang):
-            texts = []
-            for p in timeline:
-                texts.append(split_text(p.text(strip_html=True, lang=lang), lang=lang))
-            dictionary = gensim.corpora.Dictionary(texts)
-            corpus = [dictionary.doc2bow(text) for text in texts]
-            lsi = gensim.models.LsiModel(corpus, id2word=dictionary, num_topics=2)
-            indexes[lang] = gensim.similarities.MatrixSimilarity(lsi[corpus])
-            dictionaries[lang] = dictionary
-            lsis[lang] = lsi
-
-        def write_similar(path, post, lang, indexes=indexes, dictionaries=dictionaries, lsis=lsis):
-            if lang not in dictionaries:
-                create_idx(indexes, dictionaries, lsis, lang)
-            doc = split_text(post.text(lang), lang)
-            vec_bow = dictionaries[lang].doc2bow(doc)
-            vec_lsi = lsis[lang][vec_bow]
-            body_sims = indexes[lang][vec_lsi]
-
-            tag_sims = [tags_similarity(post, p) for p in timeline]
-            title_sims = [title_similarity(post, p) for p in timeline]
-            full_sims = [tag_sims[i] + title_sims[i] + body_sims[i] * 1.5 for i in range(len(timeline))]
-            full_sims = sorted(enumerate(full_sims), key=lambda item: -item[1])
-            idx = timeline.index(post)
-            related = [(timeline[s[0]], s[1], tag_sims[s[0]], title_sims[s[0]], body_sims[s[0]]) for s in
-                       full_sims[:kw['similar_count'] + 1] if s[0] != idx]
-            data = []
-            for p, score, tag, title, body in related:
-                data.append({
-                    'url': '/' + p.destination_path(sep='/'),
-                    'title': p.title(),
-                    'score': score,
-                    'detailed_score': [tag, title, float(body)],
-                })
+        def get_model(lang):
+            if lang not in models:
+                def split_text(text):
+                    words = text.lower().split()
+                    return [w for w in words if w not in stopwords[lang]]
+
+                cache_folder = os.path.join(self.site.config['CACHE_FOLDER'], 'similarity', lang)
+                models[lang] = SimilarityModel(timeline, lang, split_text, cache_folder, self.logger)
+            return models[lang]
+
+        def write_similar(path, post, lang):
+            data = get_model(lang).related(post, kw['similar_count'])
             with open(path, 'w+') as outf:
                 json.dump(data, outf)
 
+        def write_all_similar(paths, lang):
+            """Write the data of all posts, skipping files whose content did not change."""
+            hashes_path = os.path.join(self.site.config['CACHE_FOLDER'], 'similarity', lang, 'related.json')
+            try:
+                with io.open(hashes_path, 'r', encoding='utf-8') as inf:
+                    old_hashes = json.load(inf)
+            except (IOError, ValueError):
+                old_hashes = {}
+            model = get_model(lang)
+            hashes = {}
+            written = 0
+            for path, post in zip(paths, timeline):
+                data = json.dumps(model.related(post, kw['similar_count']))
+                hashes[path] = hashlib.sha256(data.encode('utf-8')).hexdigest()
+                if old_hashes.get(path) != hashes[path] or not os.path.exists(path):
+                    utils.makedirs(os.path.dirname(path))
+                    with open(path, 'w+') as outf:
+                        outf.write(data)
+                    written += 1
+            self.logger.info("{0}: wrote {1} of {2} related posts files".format(lang, written, len(paths)))
+            utils.makedirs(os.path.dirname(hashes_path))
+            with io.open(hashes_path, 'w', encoding='utf-8') as outf:
+                outf.write(json.dumps(hashes))
+
+        single_task = self.site.config.get('SIMILARITY_SINGLE_TASK', False)
         for lang in self.site.translations:
             file_dep = [p.translated_source_path(lang) for p in timeline]
             uptodate = utils.config_changed({1: kw}, 'similarity')
-            for i, post in enumerate(timeline):
-                out_name = os.path.join(kw['output_folder'], post.destination_path(lang=lang)) + '.related.json'
+            out_names = [os.path.join(kw['output_folder'], post.destination_path(lang=lang)) + '.related.json' for post in timeline]
+            if single_task:
+                yield {
+                    'basename': self.name,
+                    'name': 'all:' + lang,
+                    'targets': out_names,
+                    'actions': [(write_all_similar, (out_names, lang))],
+                    'file_dep': file_dep,
+                    'uptodate': [utils.config_changed({1: kw, 2: out_names}, 'similarity:all:' + lang)],
+                    'clean': True,
+                }
+                continue
+            for out_name, post in zip(out_names, timeline):
                 task = {
                     'basename': self.name,
                     'name': out_name,
@@ -26,14 +26,85 @@
 
 from __future__ import print_function, unicode_literals
 
+from concurrent.futures import ProcessPoolExecutor
+import io
+import json
+import os
+
 from nikola.plugin_categories import LateTask
-from nikola.utils import config_changed, LOGGER
+from nikola.utils import config_changed, LOGGER, makedirs
 
 import enchant
 from enchant.checker import SpellChecker
 from enchant.tokenize import EmailFilter, URLFilter
 
 
+class Checker(object):
+    """ Spell checkers and dictionaries, loaded once and shared by posts.
+
+    Verdicts for words that the main dictionary rejects are cached, so each
+    such word is looked up in the other dictionaries of a language once.
+
+    """
+
+    def __init__(self):
+        self._checkers = {}
+        self._other_dicts = {}
+        self._verdicts = {}
+        self._langs = enchant.list_languages()
+
+    def check(self, text, lang):
+        """ Return the mis-spelt words in text, or None if lang has no dictionary. """
+
+        if lang not in self._checkers:
+            if not enchant.dict_exists(lang):
+                self._checkers[lang] = None
+            else:
+                self._checkers[lang] = SpellChecker(lang, filters=[EmailFilter, URLFilter])
+                # look for en_GB, en_US, ...
+                self._other_dicts[lang] = [
+                    enchant.Dict(language) for language in self._langs
+                    if language.startswith('%s_' % lang)
+                ]
+                self._verdicts[lang] = {}
+
+        checker = self._checkers[lang]
+        if checker is None:
+            return None
+
+        checker.set_text(text)
+        words = [error.word for error in checker]
+
+        return [
+            word for word in words if
+            self._not_in_other_dictionaries(word, lang)
+        ]
+
+    def _not_in_other_dictionaries(self, word, lang):
+        """ Return True if the word is not present any dictionary for the lang.
+
+        """
+
+        verdicts = self._verdicts[lang]
+        if word not in verdicts:
+            verdicts[word] = not any(
+                dictionary.check(word) for dictionary in self._other_dicts[lang]
+            )
+
+        return verdicts[word]
+
+
+_worker_checker = None
+
+
+def _check_in_worker(text, lang):
+    # Each worker process builds its own Checker on first use.
+    global _worker_checker
+    if _worker_checker is None:
+        _worker_checker = Checker()
+    return _worker_checker.check(text, lang)
+
+
 class RenderPosts(LateTask):
     """ Run spell check on any post that may have changed. """
 
@@ -41,8 +112,7 @@ class RenderPosts(LateTask):
 
     def __init__(self):
         super(RenderPosts, self).__init__()
-        self._dicts = dict()
-        self._langs = enchant.list_languages()
+        self._checker = None
 
     def gen_tasks(self):
         """ Run spell check on any post that may have changed. """
@@ -51,6 +121,29 @@ class RenderPosts(LateTask):
         kw = {'translations': self.site.config['TRANSLATIONS']}
         yield self.group_task()
 
+        workers = self.site.config.get('SPELL_CHECK_WORKERS', 0)
+        if workers:
+            # A single task that checks the changed posts in a process pool
+            # and writes a JSON report.
+            kw['report'] = self.site.config.get(
+                'SPELL_CHECK_REPORT',
+                os.path.join(self.site.config['CACHE_FOLDER'], 'spell_check.json')
+            )
+            file_dep = []
+            for lang in kw['translations']:
+                for post in self.site.timeline:
+                    file_dep.extend(post.fragment_deps(lang))
+            yield {
+                'basename': self.name,
+                'name': 'all',
+                'file_dep': file_dep,
+                'targets': [kw['report']],
+                'actions': [(self.spell_check_all, (kw['translations'], kw['report'], workers))],
+                'clean': True,
+                'uptodate': [config_changed(kw, 'spell_check:all')],
+            }
+            return
+
         for lang in kw['translations']:
             for post in self.site.timeline[:]:
                 path = post.fragment_deps(lang)
@@ -67,14 +160,11 @@ class RenderPosts(LateTask):
     def spell_check(self, post, lang):
         """ Check spellings for the given post and given language. """
 
-        if enchant.dict_exists(lang):
-            checker = SpellChecker(lang, filters=[EmailFilter, URLFilter])
-            checker.set_text(post.text(lang=lang, strip_html=True))
-            words = [error.word for error in checker]
-            words = [
-                word for word in words if
-                self._not_in_other_dictionaries(word, lang)
-            ]
+        if self._checker is None:
+            self._checker = Checker()
+
+        words = self._checker.check(post.text(lang=lang, strip_html=True), lang)
+        if words is not None:
             LOGGER.notice(
                 'Mis-spelt words in %s: %s' % (
                     post.fragment_deps(lang), ', '.join(words)
@@ -84,17 +174,58 @@ class RenderPosts(LateTask):
         else:
             LOGGER.notice('No dictionary found for %s' % lang)
 
-    def _not_in_other_dictionaries(self, word, lang):
-        """ Return True if the word is not present any dictionary for the lang.
+    def spell_check_all(self, langs, report_path, workers):
+        """ Check all the changed posts, and write the report.
+
+        Posts whose fragments did not change since the previous report are
+        not checked again.
 
         """
 
-        for language in self._langs:
-            if language.startswith('%s_' % lang):  # look for en_GB, en_US, ...
-                dictionary = self._dicts.setdefault(
-                    language, enchant.Dict(language)
+        report = {}
+        if os.path.isfile(report_path):
+            with io.open(report_path, 'r', encoding='utf-8') as f:
+                try:
+                    report = json.load(f)
+                except ValueError:
+                    LOGGER.warn('Ignoring invalid spell check report: %s' % report_path)
+
+        new_report = {}
+        jobs = []
+        for lang in langs:
+            for post in self.site.timeline:
+                deps = post.fragment_deps(lang)
+                key = '%s:%s' % (lang, post.source_path)
+                mtime = max([os.stat(dep).st_mtime for dep in deps] or [0])
+                entry = report.get(key)
+                if entry is not None and entry['mtime'] == mtime:
+                    new_report[key] = entry
+                    continue
+                new_report[key] = {
+                    'source': post.source_path,
+                    'lang': lang,
+                    'mtime': mtime,
+                }
+                jobs.append((key, post.text(lang=lang, strip_html=True), lang))
+
+        if jobs:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = executor.map(
+                    _check_in_worker,
+                    [text for _, text, _ in jobs],
+                    [lang for _, _, lang in jobs],
+                    chunksize=16,
                 )
-                if dictionary.check(word):
-                    return False
+                for (key, _, _), words in zip(jobs, results):
+                    new_report[key]['words'] = words
+
+        makedirs(os.path.dirname(report_path))
+        with io.open(report_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(new_report, indent=2, sort_keys=True, ensure_ascii=False))
 
-        return True
+        misspelt = [entry for entry in new_report.values() if entry['words']]
+        missing = set(entry['lang'] for entry in new_report.values() if entry['words'] is None)
+        for lang in missing:
+            LOGGER.notice('No dictionary found for %s' % lang)
+        LOGGER.notice('Checked %d changed posts; %d posts have mis-spelt words, see %s' % (
+            len(jobs), len(misspelt), report_path))
@@ -26,21 +26,28 @@
 
 from __future__ import unicode_literals, print_function
 import codecs
-from collections import defaultdict
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import hashlib
+import heapq
 import io
+import json
 import math
+import os
 from os.path import relpath
 import re
+import shutil
 from textwrap import dedent
 
 from nikola.plugin_categories import Command
-from nikola.utils import bytes_str, LOGGER, req_missing, sys_decode, unicode_str
+from nikola.utils import bytes_str, LOGGER, makedirs, req_missing, sys_decode, unicode_str
 from nikola.plugins.compile.ipynb import flag as ipy_flag
 if ipy_flag:
     from nikola.plugins.compile.ipynb import current_nbformat, nbformat
 
 
-def add_tags(site, tags, filepaths, dry_run=False):
+def add_tags(site, tags, filepaths, dry_run=False, workers=1):
     """ Adds a list of comma-separated tags, given a list of filepaths.
 
         $ nikola tags --add "foo,bar" posts/*.rst
@@ -51,31 +58,16 @@ def add_tags(site, tags, filepaths, dry_run=False):
 
     tags = _process_comma_separated_tags(tags)
 
-    posts = [post for post in site.timeline if post.source_path in filepaths]
+    posts = _find_posts(site, filepaths)
 
     if len(tags) == 0 or len(posts) == 0:
         print("ERROR: Need at least one tag and post.")
         return
 
-    FMT = 'Tags for {0}:\n{1:>6} - {2}\n{3:>6} - {4}\n'
-    OLD = 'old'
-    NEW = 'new'
-
-    all_new_tags = []
-    for post in posts:
-        old_tags = _post_tags(post)
-        new_tags = _add_tags(old_tags[:], tags)
-        all_new_tags.append(new_tags)
-
-        if dry_run:
-            print(FMT.format(
-                post.source_path, OLD, old_tags, NEW, new_tags)
-            )
-
-        elif new_tags != old_tags:
-            _replace_tags(site, post, new_tags)
-
-    return all_new_tags
+    return _edit_tags(
+        site, posts, lambda post, old_tags: _add_tags(old_tags, tags),
+        dry_run, workers
+    )
 
 
 def list_tags(site, sorting='alpha'):
@@ -102,7 +94,7 @@ def list_tags(site, sorting='alpha'):
     return tags
 
 
-def merge_tags(site, tags, filepaths, dry_run=False):
+def merge_tags(site, tags, filepaths, dry_run=False, workers=1):
     """ Merges a list of comma-separated tags, replacing them with the last tag
 
     Requires a list of file names to be passed as arguments.
@@ -116,34 +108,20 @@ def merge_tags(site, tags, filepaths, dry_run=False):
 
     tags = _process_comma_separated_tags(tags)
 
-    posts = [post for post in site.timeline if post.source_path in filepaths]
+    posts = _find_posts(site, filepaths)
 
     if len(tags) < 2 or len(posts) == 0:
         print("ERROR: Need at least two tags and a post.")
         return
 
-    FMT = 'Tags for {0}:\n{1:>6} - {2}\n{3:>6} - {4}\n'
-    OLD = 'old'
-    NEW = 'new'
-
-    all_new_tags = []
-    for post in posts:
-        old_tags = _post_tags(post)
-        new_tags = _clean_tags(old_tags[:], set(tags[:-1]), tags[-1])
-        all_new_tags.append(new_tags)
-
-        if dry_run:
-            print(FMT.format(
-                post.source_path, OLD, old_tags, NEW, new_tags)
-            )
-
-        elif new_tags != old_tags:
-            _replace_tags(site, post, new_tags)
-
-    return all_new_tags
+    return _edit_tags(
+        site, posts,
+        lambda post, old_tags: _clean_tags(old_tags, set(tags[:-1]), tags[-1]),
+        dry_run, workers
+    )
 
 
-def remove_tags(site, tags, filepaths, dry_run=False):
+def remove_tags(site, tags, filepaths, dry_run=False, workers=1):
     """ Removes a list of comma-separated tags, given a list of filepaths.
 
         $ nikola tags --remove "foo,bar" posts/*.rst
@@ -154,34 +132,16 @@ def remove_tags(site, tags, filepaths, dry_run=False):
 
     tags = _process_comma_separated_tags(tags)
 
-    posts = [post for post in site.timeline if post.source_path in filepaths]
+    posts = _find_posts(site, filepaths)
 
     if len(tags) == 0 or len(posts) == 0:
         print("ERROR: Need at least one tag and post.")
         return
 
-    FMT = 'Tags for {0}:\n{1:>6} - {2}\n{3:>6} - {4}\n'
-    OLD = 'old'
-    NEW = 'new'
-
-    if len(posts) == 0:
-        new_tags = []
-
-    all_new_tags = []
-    for post in posts:
-        old_tags = _post_tags(post)
-        new_tags = _remove_tags(old_tags[:], tags)
-        all_new_tags.append(new_tags)
-
-        if dry_run:
-            print(FMT.format(
-                post.source_path, OLD, old_tags, NEW, new_tags)
-            )
-
-        elif new_tags != old_tags:
-            _replace_tags(site, post, new_tags)
-
-    return all_new_tags
+    return _edit_tags(
+        site, posts, lambda post, old_tags: _remove_tags(old_tags, tags),
+        dry_run, workers
+    )
 
 
 def search_tags(site, term):
@@ -207,7 +167,7 @@ def search_tags(site, term):
     return new_tags
 
 
-def sort_tags(site, filepaths, dry_run=False):
+def sort_tags(site, filepaths, dry_run=False, workers=1):
     """ Sorts all the tags in the given list of posts.
 
         $ nikola tags --sort posts/*.rst
@@ -217,21 +177,36 @@ def sort_tags(site, filepaths, dry_run=False):
 
     """
 
-    posts = [post for post in site.timeline if post.source_path in filepaths]
+    posts = _find_posts(site, filepaths)
 
     if len(posts) == 0:
         LOGGER.error("Need at least one post.")
 
         return
 
+    return _edit_tags(
+        site, posts, lambda post, old_tags: sorted(old_tags), dry_run, workers
+    )
+
+
+def _edit_tags(site, posts, edit, dry_run=False, workers=1):
+    """ Apply an edit to the tags of posts, and return all the new tags.
+
+    edit is called with each post and a copy of its tags, and returns the
+    new tags.  The changed files are written once all the edits are done,
+    in parallel if workers > 1.
+
+    """
+
     FMT = 'Tags for {0}:\n{1:>6} - {2}\n{3:>6} - {4}\n'
     OLD = 'old'
     NEW = 'new'
 
     all_new_tags = []
+    changes = []
     for post in posts:
         old_tags = _post_tags(post)
-        new_tags = sorted(old_tags)
+        new_tags = edit(post, old_tags[:])
         all_new_tags.append(new_tags)
 
         if dry_run:
@@ -240,11 +215,32 @@ def sort_tags(site, filepaths, dry_run=False):
             )
 
         elif new_tags != old_tags:
+            changes.append((post, new_tags))
+
+    if workers > 1 and len(changes) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(_replace_tags, site, post, new_tags)
+                for post, new_tags in changes
+            ]
+            for future in futures:
+                future.result()
+
+    else:
+        for post, new_tags in changes:
             _replace_tags(site, post, new_tags)
 
     return all_new_tags
 
 
+def _find_posts(site, filepaths):
+    """ Return the posts for the given source paths, in timeline order. """
+
+    filepaths = set(filepaths)
+
+    return [post for post in site.timeline if post.source_path in filepaths]
+
+
 def _format_doc_string(function):
     text = dedent(' ' * 4 + function.__doc__.strip())
     doc_lines = [line for line in text.splitlines() if line.strip()]
@@ -354,6 +350,14 @@ class CommandTags(Command):
             'type': bool,
             'help': 'Automatically tag a given set of posts.'
         },
+        {
+            'name': 'workers',
+            'long': 'workers',
+            'short': 'j',
+            'type': int,
+            'default': 1,
+            'help': 'Number of files to write in parallel.\n'
+        },
         {
             'name': 'dry-run',
             'long': 'dry-run',
@@ -377,30 +381,39 @@ class CommandTags(Command):
         self._unicode_options(options)
 
         filepaths = [relpath(path) for path in args]
+        workers = options['workers']
 
         if len(options['add']) > 0 and len(filepaths) > 0:
-            add_tags(self.site, options['add'], filepaths, options['dry-run'])
+            add_tags(self.site, options['add'], filepaths, options['dry-run'], workers)
 
         elif options['list']:
             list_tags(self.site, options['list_sorting'])
 
         elif options['merge'].count(',') > 0 and len(filepaths) > 0:
-            merge_tags(self.site, options['merge'], filepaths, options['dry-run'])
+            merge_tags(self.site, options['merge'], filepaths, options['dry-run'], workers)
 
         elif len(options['remove']) > 0 and len(filepaths) > 0:
-            remove_tags(self.site, options['remove'], filepaths, options['dry-run'])
+            remove_tags(self.site, options['remove'], filepaths, options['dry-run'], workers)
 
         elif len(options['search']) > 0:
             search_tags(self.site, options['search'])
 
         elif options['tag'] and len(filepaths) > 0:
-            tagger = _AutoTag(self.site)
-            for post in filepaths:
-                tags = ','.join(tagger.tag(post))
-                add_tags(self.site, tags, [post], options['dry-run'])
+            tagger = _AutoTag(
+                self.site,
+                cache_folder=os.path.join(self.site.config['CACHE_FOLDER'], 'tags')
+            )
+            posts = _find_posts(self.site, filepaths)
+            for path in set(filepaths) - set(post.source_path for post in posts):
+                LOGGER.error('No post found for path: %s' % path)
+            _edit_tags(
+                self.site, posts,
+                lambda post, old_tags: _add_tags(old_tags, tagger.tag(post)),
+                options['dry-run'], workers
+            )
 
         elif options['sort'] and len(filepaths) > 0:
-            sort_tags(self.site, filepaths, options['dry-run'])
+            sort_tags(self.site, filepaths, options['dry-run'], workers)
 
         else:
             print(self.help())
@@ -416,6 +429,7 @@ class _AutoTag(object):
     """ A class to auto tag posts, using tf-idf. """
 
     WORDS = '([A-Za-z]+[A-Za-z-]*[A-Za-z]+|[A-Za-z]+)'
+    CACHE_VERSION = 1
 
     def tag(self, post, count=5):
         """ Return a list of top tags, given a post.
@@ -436,16 +450,21 @@ class _AutoTag(object):
 
     # ### 'object' interface ###################################################
 
-    def __init__(self, site, use_nltk=True):
+    def __init__(self, site, use_nltk=True, cache_folder=None):
         """ Set up a dictionary of documents.
 
-        Each post is mapped to a list of words it contains.
+        Each post is mapped to a list of words it contains.  If a
+        cache_folder is given, the tokens of each post and the stems of
+        all words are kept there, and only changed posts are tokenized
+        again on the next run.
 
         """
 
         self._site = site
         self._documents = {}
         self._stem_cache = {}
+        self._cache_path = None
+        self._posts_by_source_path = None
         self._use_nltk = use_nltk and self._nltk_available()
         self._tag_set = set([])
 
@@ -463,53 +482,46 @@ class _AutoTag(object):
         else:
             self._tag_pattern = re.compile(self.WORDS)
 
+        if cache_folder is not None:
+            self._cache_path = os.path.join(
+                cache_folder,
+                'autotag-nltk.json' if self._use_nltk else 'autotag.json'
+            )
+        self._cache = self._load_cache()
+        if self._use_nltk:
+            self._stem_cache = self._cache['stems']
+
         self._process_tags()
         self._process_posts()
         self._document_count = len(self._documents)
+        self._build_index()
+        self._save_cache()
 
     # ### 'Private' interface ##################################################
 
-    def _find_stems_for_words_in_documents(self, text):
-        """ Process text to get list of stems. """
-
-        words = []
-
-        for word in self._tokenize(text):
-            if self._tag_pattern.match(word) is not None:
-                if word not in self._stopwords:
-                    words.append(self._get_stem_from_cache(word))
-
-        return words
-
     def _find_top_scoring_tags(self, post, count):
         """ Return the tags with the top tf-idf score. """
 
-        tf_idf_table = {}
-
-        for word in self._documents[post.source_path]:
-            tf_idf_table[word] = self._tf_idf(word, post)
-            tags = sorted(
-                tf_idf_table, key=lambda x: tf_idf_table[x], reverse=True
-            )
+        scores = self._tf_idf_matrix[post.source_path]
+        tags = heapq.nlargest(count, scores, key=scores.get)
 
         if self._use_nltk:
             tags = [
                 sorted(self._stem_word_mapping[tag], key=len)[0]
-                for tag in tags[:count]
+                for tag in tags
             ]
 
-        else:
-            tags = tags[:count]
-
         return tags
 
     def _get_post_from_source_path(self, source):
         """ Return a post given the source path. """
 
-        posts = [
-            post for post in self._site.timeline
-            if post.source_path == source
-        ]
+        if self._posts_by_source_path is None:
+            self._posts_by_source_path = {}
+            for post in self._site.timeline:
+                self._posts_by_source_path.setdefault(post.source_path, []).append(post)
+
+        posts = self._posts_by_source_path.get(source, [])
 
         post = posts[0] if len(posts) == 1 else None
 
@@ -528,12 +540,7 @@ class _AutoTag(object):
     def _get_word_count(self, post):
         """ Get the count of all words in a given post. """
 
-        word_counts = defaultdict(lambda: 0)
-
-        for word in self._documents[post.source_path]:
-            word_counts[word] += 1
-
-        return word_counts
+        return self._word_counts[post.source_path]
 
     def _get_stem_from_cache(self, word):
         """ Return the stem for a word, and cache it, if required. """
@@ -541,12 +548,88 @@ class _AutoTag(object):
         if word not in self._stem_cache:
             stem = self._stemmer.stem(word)
             self._stem_cache[word] = stem
-            self._stem_word_mapping[stem].add(word)
         else:
             stem = self._stem_cache[word]
+        self._stem_word_mapping[stem].add(word)
 
         return stem
 
+    def _get_tokens(self, post):
+        """ Return the (unstemmed) tokens of a post, using the cache. """
+
+        source_path = post.source_path
+        stat = os.stat(source_path)
+        entry = self._cache['posts'].get(source_path)
+        if (entry is not None and entry['mtime'] == stat.st_mtime and
+                entry['size'] == stat.st_size and
+                entry['two_file'] == post.is_two_file):
+            return entry['tokens']
+
+        text = self._get_post_text(post)
+        text_hash = hashlib.sha1(text.encode('utf-8')).hexdigest()
+        if (entry is not None and entry['hash'] == text_hash and
+                entry['two_file'] == post.is_two_file):
+            tokens = entry['tokens']
+        else:
+            tokens = self._tokenize_text(text)
+
+        self._cache['posts'][source_path] = {
+            'mtime': stat.st_mtime,
+            'size': stat.st_size,
+            'two_file': post.is_two_file,
+            'hash': text_hash,
+            'tokens': tokens,
+        }
+
+        return tokens
+
+    def _load_cache(self):
+        """ Load the token and stem cache, if there is one. """
+
+        cache = {'version': self.CACHE_VERSION, 'posts': {}, 'stems': {}}
+        if self._cache_path is None or not os.path.isfile(self._cache_path):
+            return cache
+
+        try:
+            with io.open(self._cache_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except ValueError:
+            LOGGER.warn('Ignoring corrupt auto-tag cache: {0}'.format(self._cache_path))
+            return cache
+
+        if data.get('version') == self.CACHE_VERSION:
+            cache = data
+
+        return cache
+
+    def _save_cache(self):
+        """ Write the tokens of the current posts and the stems they use. """
+
+        if self._cache_path is None:
+            return
+
+        timeline = set(post.source_path for post in self._site.timeline)
+        posts = self._cache['posts']
+        data = {
+            'version': self.CACHE_VERSION,
+            'posts': dict(
+                (path, entry) for path, entry in posts.items() if path in timeline
+            ),
+            'stems': {},
+        }
+        if self._use_nltk:
+            data['stems'] = dict(
+                (word, stem)
+                for stem, words in self._stem_word_mapping.items()
+                for word in words
+            )
+
+        makedirs(os.path.dirname(self._cache_path))
+        temp_path = self._cache_path + '.tmp'
+        with io.open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(unicode_str(json.dumps(data)))
+        os.replace(temp_path, self._cache_path)
+
     def _modified_inverse_document_frequency(self, word):
         """ Gets the inverse document frequency of a word.
 
@@ -556,9 +639,7 @@ class _AutoTag(object):
         """
 
         if word not in self._tag_set:
-            count = sum(
-                1 for doc in self._documents.values() if word.lower() in doc
-            )
+            count = self._document_frequency[word.lower()]
         else:
             count = 0.25
 
@@ -580,13 +661,13 @@ class _AutoTag(object):
 
         for post in self._site.timeline:
 
-            text = self._get_post_text(post)
+            tokens = self._get_tokens(post)
 
             if not self._use_nltk:
-                words = self._tag_pattern.findall(text)
+                words = tokens
 
             else:
-                words = self._find_stems_for_words_in_documents(text)
+                words = [self._get_stem_from_cache(word) for word in tokens]
 
             self._documents[post.source_path] = words
 
@@ -601,6 +682,18 @@ class _AutoTag(object):
         else:
             self._tag_set = set(self._get_stem_from_cache(tag) for tag in tags)
 
+    def _tokenize_text(self, text):
+        """ Return the words in text that are candidates for tags. """
+
+        if not self._use_nltk:
+            return self._tag_pattern.findall(text)
+
+        return [
+            word for word in self._tokenize(text)
+            if self._tag_pattern.match(word) is not None and
+            word not in self._stopwords
+        ]
+
     def _term_frequncy(self, word, post):
         """ Returns the frequency of a word, given a post. """
 
@@ -609,7 +702,7 @@ class _AutoTag(object):
         # A mix of augmented, logarithmic frequency.  We divide with
         # the max frequency to prevent a bias towards longer document.
         tf = math.log(
-            1 + float(word_counts[word]) / max(word_counts.values())
+            1 + float(word_counts[word]) / self._max_word_counts[post.source_path]
         )
 
         return tf
@@ -622,6 +715,36 @@ class _AutoTag(object):
 
         return tf * idf
 
+    def _build_index(self):
+        """ Build the document frequencies and the sparse tf-idf matrix.
+
+        Each document is stored as a mapping of only the words it
+        contains, so that scoring a post never has to look at the rest
+        of the corpus again.
+
+        """
+
+        self._word_counts = {}
+        self._max_word_counts = {}
+        self._document_frequency = Counter()
+
+        for source_path, words in self._documents.items():
+            word_counts = Counter(words)
+            self._word_counts[source_path] = word_counts
+            self._max_word_counts[source_path] = max(word_counts.values()) if word_counts else 1
+            self._document_frequency.update(word_counts.keys())
+
+        idf = {}
+        self._tf_idf_matrix = {}
+        for source_path, word_counts in self._word_counts.items():
+            max_count = float(self._max_word_counts[source_path])
+            row = {}
+            for word, word_count in word_counts.items():
+                if word not in idf:
+                    idf[word] = self._modified_inverse_document_frequency(word)
+                row[word] = math.log(1 + word_count / max_count) * idf[word]
+            self._tf_idf_matrix[source_path] = row
+
 
 def _add_tags(tags, additions):
     """ In all tags list, add tags in additions if not already present. """
@@ -633,6 +756,21 @@ def _add_tags(tags, additions):
     return tags
 
 
+@contextmanager
+def _atomic_open(path):
+    """ Open a temporary file for writing, that replaces path when closed. """
+
+    temp_path = path + '.tags-tmp'
+    try:
+        with io.open(temp_path, 'w', encoding='utf-8', newline='') as f:
+            yield f
+        shutil.copymode(path, temp_path)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
 def _clean_tags(tags, remove, keep):
     """ In all tags list, replace tags in remove with keep tag. """
     original_tags = tags[:]
@@ -680,7 +818,7 @@ def _replace_ipynb_tags(post, tags):
     metadata = nb['metadata']['nikola']
     metadata['tags'] = ','.join(tags)
 
-    with io.open(post.source_path, "w+", encoding="utf8") as fd:
+    with _atomic_open(post.source_path) as fd:
         nbformat.write(nb, fd, 4)
 
 
@@ -711,5 +849,5 @@ def _replace_tags_line(post, tags):
             text[index] = new_tags
             break
 
-    with codecs.open(path, 'w+', 'utf-8') as f:
+    with _atomic_open(path) as f:
         f.writelines(text)
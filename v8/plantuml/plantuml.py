@@ -1,9 +1,21 @@
+import atexit
+import hashlib
+import json
 import os
+import re
+import socket
 import subprocess
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from itertools import chain
 from logging import DEBUG
 from pathlib import Path
-from typing import List, Optional, Sequence, Tuple
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
 
 from nikola import utils
 from nikola.log import get_logger
@@ -21,6 +33,20 @@ DEFAULT_PLANTUML_FILES = (
 
 DEFAULT_PLANTUML_CONTINUE_AFTER_FAILURE = False
 
+DEFAULT_PLANTUML_SERVER = False
+
+DEFAULT_PLANTUML_SERVER_START_TIMEOUT = 60
+
+DEFAULT_PLANTUML_BATCH = False
+
+DEFAULT_PLANTUML_WORKERS = None
+
+DEFAULT_PLANTUML_CACHE = False
+
+DEFAULT_PLANTUML_CACHE_MAX_SIZE = 100 * 1024 * 1024
+
+INCLUDE_DIRECTIVE_RE = re.compile(r'^\s*!include(?:sub|_many|_once)?\s+([^\s!]+)', re.MULTILINE)
+
 
 # TODO when 3.5 support is dropped
 # - Use capture_output arg in subprocess.run()
@@ -32,11 +58,13 @@ class PlantUmlTask(Task):
     name = 'plantuml'
 
     _common_args = ...  # type: List[str]
+    _workers = ...  # type: int
     plantuml_manager = ...  # Optional[PlantUmlManager]
 
     def set_site(self, site):
         super().set_site(site)
         self._common_args = list(site.config.get('PLANTUML_ARGS', DEFAULT_PLANTUML_ARGS))
+        self._workers = site.config.get('PLANTUML_WORKERS', DEFAULT_PLANTUML_WORKERS) or os.cpu_count() or 1
         self.plantuml_manager = PlantUmlManager(site)
 
     def gen_tasks(self):
@@ -45,17 +73,63 @@ class PlantUmlTask(Task):
         filters = self.site.config['FILTERS']
         output_folder = self.site.config['OUTPUT_FOLDER']
         plantuml_files = self.site.config.get('PLANTUML_FILES', DEFAULT_PLANTUML_FILES)
-        output_path = Path(output_folder)
 
-        # Logic derived from nikola.plugins.misc.scan_posts.ScanPosts.scan()
-        for pattern, destination, extension, args in plantuml_files:
-            combined_args = self._common_args + args
+        if self.site.config.get('PLANTUML_BATCH', DEFAULT_PLANTUML_BATCH):
+            yield from self._gen_batch_task(plantuml_files, filters, output_folder)
+            return
 
+        for src, dst, combined_args, includes in self._find_files(plantuml_files, output_folder):
             kw = {
                 'combined_args': combined_args,
                 'filters': filters,
                 'output_folder': output_folder,
             }
+            dst_str = str(dst)
+            task = {
+                'basename': self.name,
+                'name': dst_str,
+                'file_dep': includes + [str(src)],
+                'targets': [dst_str],
+                'actions': [(self.render_file, [src, dst, combined_args + ['-filename', src.name]])],
+                'uptodate': [utils.config_changed(kw, 'plantuml:' + dst_str)],
+                'clean': True,
+            }
+            yield utils.apply_filters(task, filters)
+
+    def _gen_batch_task(self, plantuml_files, filters, output_folder):
+        """A single task that renders every stale file using a pool of workers"""
+        jobs = list(self._find_files(plantuml_files, output_folder))
+        if not jobs:
+            return
+
+        kw = {
+            'plantuml_files': plantuml_files,
+            'common_args': self._common_args,
+            'filters': filters,
+            'output_folder': output_folder,
+        }
+        file_dep = set()
+        for src, _, _, includes in jobs:
+            file_dep.add(str(src))
+            file_dep.update(includes)
+        task = {
+            'basename': self.name,
+            'name': 'batch',
+            'file_dep': sorted(file_dep),
+            'targets': [str(dst) for _, dst, _, _ in jobs],
+            'actions': [(self.render_batch, [jobs, kw])],
+            'uptodate': [utils.config_changed(kw, 'plantuml:batch')],
+            'clean': True,
+        }
+        yield utils.apply_filters(task, filters)
+
+    def _find_files(self, plantuml_files, output_folder) -> Iterator[Tuple[Path, Path, List[str], List[str]]]:
+        """Yields (src, dst, combined_args, includes)"""
+        output_path = Path(output_folder)
+
+        # Logic derived from nikola.plugins.misc.scan_posts.ScanPosts.scan()
+        for pattern, destination, extension, args in plantuml_files:
+            combined_args = self._common_args + args
 
             # TODO figure out exactly what the PlantUML include patterns do and expand them similarly here
             includes = list(set(a[2:] for a in combined_args if a.startswith('-I') and '*' not in a and '?' not in a))
@@ -65,20 +139,55 @@ class PlantUmlTask(Task):
 
             for src in root.rglob(pattern.name):
                 dst = output_path / destination / src.relative_to(root).parent / src.with_suffix(extension).name
-                dst_str = str(dst)
-                task = {
-                    'basename': self.name,
-                    'name': dst_str,
-                    'file_dep': includes + [str(src)],
-                    'targets': [dst_str],
-                    'actions': [(self.render_file, [src, dst, combined_args + ['-filename', src.name]])],
-                    'uptodate': [utils.config_changed(kw, 'plantuml:' + dst_str)],
-                    'clean': True,
-                }
-                yield utils.apply_filters(task, filters)
+                yield src, dst, combined_args, includes
+
+    def render_batch(self, jobs: Sequence[Tuple[Path, Path, List[str], List[str]]], kw: Dict) -> bool:
+        """
+        Renders the stale files in jobs concurrently.
+
+        doit's 'changed' can't tell which files are stale: when any target is missing it lists every file_dep.
+        So the key of each rendered file (its source, args & included files, plus config) is kept in the cache folder.
+        """
+        config = json.dumps(kw, cls=utils.CustomEncoder, sort_keys=True)
+        state_path = Path(self.site.config.get('CACHE_FOLDER', 'cache')) / 'plantuml_batch.json'
+        try:
+            state = json.loads(state_path.read_text(encoding='utf8'))
+        except (OSError, ValueError):
+            state = {}
+
+        stale = []
+        for src, dst, combined_args, _ in jobs:
+            args = combined_args + ['-filename', src.name]
+            key = PlantUmlCache.key(src.read_bytes(), args, config, src)
+            if not dst.exists() or state.get(str(dst)) != key:
+                stale.append((src, dst, args, key))
+
+        self.logger.info('rendering %d of %d files using %d workers', len(stale), len(jobs), self._workers)
+
+        failed = []
+        try:
+            with ThreadPoolExecutor(max_workers=self._workers) as executor:
+                futures = {executor.submit(self.render_file, src, dst, args): (src, dst, key) for src, dst, args, key in stale}
+                for future in as_completed(futures):
+                    src, dst, key = futures[future]
+                    try:
+                        future.result()
+                    except Exception as e:  # noqa
+                        self.logger.error("'%s': %s", src, e)
+                        failed.append(str(src))
+                        state.pop(str(dst), None)
+                    else:
+                        state[str(dst)] = key
+        finally:
+            state_path.parent.mkdir(parents=True, exist_ok=True)
+            state_path.write_text(json.dumps(state, sort_keys=True), encoding='utf8')
+
+        if failed:
+            raise Exception('PlantUML failed to render {} file(s): {}'.format(len(failed), ', '.join(sorted(failed))))
+        return True
 
     def render_file(self, src: Path, dst: Path, args: Sequence[str]) -> bool:
-        output, error = self.plantuml_manager.render(src.read_bytes(), args)
+        output, error = self.plantuml_manager.render(src.read_bytes(), args, src)
         dst.parent.mkdir(parents=True, exist_ok=True)
         dst.write_bytes(output)
 
@@ -102,16 +211,61 @@ class PlantUmlManager:
         self.logger = get_logger('plantuml_manager')
         if site.config.get('PLANTUML_DEBUG', DEFAULT_PLANTUML_DEBUG):
             self.logger.level = DEBUG
+        self.server = None  # type: Optional[PlantUmlServer]
+        if site.config.get('PLANTUML_SERVER', DEFAULT_PLANTUML_SERVER):
+            self.server = PlantUmlServer(
+                self.exec,
+                self.logger,
+                site.config.get('PLANTUML_SERVER_START_TIMEOUT', DEFAULT_PLANTUML_SERVER_START_TIMEOUT),
+            )
+        self.cache = None  # type: Optional[PlantUmlCache]
+        if site.config.get('PLANTUML_CACHE', DEFAULT_PLANTUML_CACHE):
+            self.cache = PlantUmlCache(
+                Path(site.config.get('CACHE_FOLDER', 'cache')) / 'plantuml',
+                site.config.get('PLANTUML_CACHE_MAX_SIZE', DEFAULT_PLANTUML_CACHE_MAX_SIZE),
+                self.logger,
+            )
+        self._version = None  # type: Optional[str]
+        self._version_lock = threading.Lock()
+
+    @property
+    def version(self) -> str:
+        """The first line of "plantuml -version", which is part of the cache key"""
+        with self._version_lock:
+            if self._version is None:
+                self._version = self._get_version()
+        return self._version
+
+    def _get_version(self) -> str:
+        command = list(map(process_arg, chain(self.exec, ['-version'])))
+        result = subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            raise Exception('Cannot get PlantUML version (return code {}): {}'.format(
+                result.returncode, result.stderr.decode('utf8', 'replace').rstrip()))
+        return result.stdout.decode('utf8', 'replace').strip().split('\n')[0]
+
+    def render(self, source: bytes, args: Sequence[str], source_path: Optional[Path] = None) -> Tuple[bytes, Optional[str]]:
+        """Returns (output, error), source_path is where source was read from, if anywhere"""
+
+        if not self.cache:
+            return self._render(source, args)
+
+        key = self.cache.key(source, args, self.version, source_path)
+        output = self.cache.get(key)
+        if output is not None:
+            self.logger.debug('render() cache hit: %s', key)
+            return output, None
+
+        output, error = self._render(source, args)
+        if not error:
+            self.cache.put(key, output)
+        return output, error
 
-    def render(self, source: bytes, args: Sequence[str]) -> Tuple[bytes, Optional[str]]:
-        """Returns (output, error)"""
-
-        def process_arg(arg):
-            return arg \
-                .replace('%site_path%', os.getcwd()) \
-                .encode('utf8')
+    def _render(self, source: bytes, args: Sequence[str]) -> Tuple[bytes, Optional[str]]:
+        if self.server:
+            return self.server.render(source, list(map(process_arg, args)))
 
-        command = list(map(process_arg, chain(self.exec, args, ['-pipe', '-stdrpt'])))
+        command = [arg.encode('utf8') for arg in map(process_arg, chain(self.exec, args, ['-pipe', '-stdrpt']))]
 
         self.logger.debug('render() exec: %s\n%s', command, source)
 
@@ -126,3 +280,253 @@ class PlantUmlManager:
             details = str(result.stderr)
 
         return result.stdout, "PlantUML error (return code {}): {}".format(result.returncode, details)
+
+
+class PlantUmlServerStartError(Exception):
+    """The PlantUML server process could not be started"""
+
+
+class PlantUmlServer:
+    """
+    A long-lived PlantUML "picoweb" process that renders diagrams sent to its "/render" endpoint.
+
+    This avoids starting a new JVM for every diagram.  The process is started lazily on first use, restarted if it
+    dies, and stopped when Python exits.
+    """
+
+    def __init__(self, plantuml_exec: Sequence[str], logger, start_timeout: float) -> None:
+        self.exec = list(plantuml_exec)
+        self.logger = logger
+        self.start_timeout = start_timeout
+        self._lock = threading.Lock()
+        self._process = None  # type: Optional[subprocess.Popen]
+        self._url = None  # type: Optional[str]
+        self._start_error = None  # type: Optional[PlantUmlServerStartError]
+        atexit.register(self.stop)
+
+    def render(self, source: bytes, args: Sequence[str]) -> Tuple[bytes, Optional[str]]:
+        """Returns (output, error)"""
+
+        request = json.dumps({
+            'options': list(args),
+            'source': source.decode('utf8'),
+        }).encode('utf8')
+
+        self.logger.debug('render() server options: %s\n%s', args, source)
+
+        try:
+            return self._post(request)
+        except PlantUmlServerStartError as e:
+            return b'', str(e)
+        except (ConnectionError, urllib.error.URLError) as e:
+            # The JVM may have crashed or been killed, so try once more with a fresh process
+            self.logger.warning('PlantUML server request failed (%s), restarting the server', e)
+            self.stop()
+
+        try:
+            return self._post(request)
+        except PlantUmlServerStartError as e:
+            return b'', str(e)
+        except (ConnectionError, urllib.error.URLError) as e:
+            return b'', 'PlantUML server error: {}'.format(e)
+
+    def stop(self) -> None:
+        with self._lock:
+            if self._process and self._process.poll() is None:
+                self._process.terminate()
+                try:
+                    self._process.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    self._process.kill()
+            self._process = None
+            self._url = None
+
+    def _post(self, request: bytes) -> Tuple[bytes, Optional[str]]:
+        url = self._ensure_started() + '/render'
+        try:
+            with urllib.request.urlopen(urllib.request.Request(url, data=request, method='POST')) as response:
+                return response.read(), self._diagram_error(response.headers)
+        except urllib.error.HTTPError as e:
+            output = e.read()
+            error = self._diagram_error(e.headers)
+            if error:
+                return output, error
+            return output, 'PlantUML server error (HTTP {}): {}'.format(e.code, output.decode('utf8', 'replace').rstrip())
+
+    @staticmethod
+    def _diagram_error(headers) -> Optional[str]:
+        error = headers.get('X-PlantUML-Diagram-Error')
+        if error is None:
+            return None
+        return 'PlantUML error (line {}): {}'.format(headers.get('X-PlantUML-Diagram-Error-Line', '?'), error)
+
+    def _ensure_started(self) -> str:
+        with self._lock:
+            if self._process and self._process.poll() is not None:
+                self.logger.warning('PlantUML server exited with return code %s, restarting it', self._process.returncode)
+                self._process = None
+
+            if not self._process:
+                # Don't wait for a server that cannot start once per diagram
+                if self._start_error:
+                    raise self._start_error
+                try:
+                    self._start()
+                except PlantUmlServerStartError as e:
+                    self._start_error = e
+                    raise
+
+            return self._url
+
+    def _start(self) -> None:
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+
+        command = list(map(process_arg, self.exec)) + ['-picoweb:{}:127.0.0.1'.format(port)]
+        self.logger.debug('starting server: %s', command)
+        try:
+            self._process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+        except OSError as e:
+            raise PlantUmlServerStartError('PlantUML server failed to start: {}'.format(e))
+
+        deadline = time.monotonic() + self.start_timeout
+        while True:
+            if self._process.poll() is not None:
+                returncode = self._process.returncode
+                self._process = None
+                raise PlantUmlServerStartError('PlantUML server failed to start (return code {})'.format(returncode))
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    self._process.kill()
+                    self._process = None
+                    raise PlantUmlServerStartError('PlantUML server did not start within {} seconds'.format(self.start_timeout))
+                time.sleep(0.1)
+
+        self._url = 'http://127.0.0.1:{}'.format(port)
+
+
+class PlantUmlCache:
+    """
+    On-disk cache of rendered diagrams, content-addressed by source, args, PlantUML version & included files.
+
+    Files are evicted least recently used first when the total size exceeds max_size bytes.
+    """
+
+    def __init__(self, path: Path, max_size: int, logger) -> None:
+        self.path = path
+        self.max_size = max_size
+        self.logger = logger
+        self._entries = None  # type: Optional[OrderedDict]
+        self._lock = threading.Lock()
+        self._size = 0
+
+    @staticmethod
+    def key(source: bytes, args: Sequence[str], version: str, source_path: Optional[Path] = None) -> str:
+        h = hashlib.sha256()
+        for part in (version.encode('utf8'), json.dumps(list(args)).encode('utf8'), source):
+            h.update(hashlib.sha256(part).digest())
+
+        # Only the files a diagram actually includes are part of its key,
+        # so changing an unrelated include does not invalidate it
+        for path in sorted(PlantUmlCache._included_files(source, args, source_path)):
+            h.update(path.encode('utf8'))
+            try:
+                h.update(hashlib.sha256(Path(path).read_bytes()).digest())
+            except OSError:
+                h.update(b'\0missing')
+
+        return h.hexdigest()
+
+    @staticmethod
+    def _included_files(source: bytes, args: Sequence[str], source_path: Optional[Path] = None) -> set:
+        # Like PlantUML, "!include" is relative to the including file, then to the current directory.
+        # Patterns like "-Ipath/*.iuml" are not expanded, same as for the doit file_dep
+        source_dir = source_path.parent if source_path else Path('.')
+        pending = [(Path('.'), a[2:]) for a in args if a.startswith('-I') and '*' not in a and '?' not in a]
+        pending.extend((source_dir, name) for name in INCLUDE_DIRECTIVE_RE.findall(source.decode('utf8', 'replace')))
+        found = set()
+        while pending:
+            folder, name = pending.pop()
+            name = process_arg(name).split('!')[0]
+            if '://' in name or name.startswith('<'):
+                continue
+            candidates = [os.path.normpath(str(folder / name)), os.path.normpath(name)]
+            path = next((c for c in candidates if os.path.isfile(c)), candidates[0])
+            if path in found:
+                continue
+            found.add(path)
+            try:
+                text = Path(path).read_text(encoding='utf8', errors='replace')
+            except OSError:
+                continue
+            pending.extend((Path(path).parent, name) for name in INCLUDE_DIRECTIVE_RE.findall(text))
+        return found
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entries = self._load()
+            if key not in entries:
+                return None
+            file = self._file(key)
+            try:
+                output = file.read_bytes()
+                os.utime(str(file))
+            except OSError:
+                self._size -= entries.pop(key)
+                return None
+            entries.move_to_end(key)
+            return output
+
+    def put(self, key: str, output: bytes) -> None:
+        with self._lock:
+            entries = self._load()
+            file = self._file(key)
+            file.parent.mkdir(parents=True, exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=str(file.parent), suffix='.tmp', delete=False) as f:
+                f.write(output)
+            os.replace(f.name, str(file))
+            self._size += len(output) - entries.pop(key, 0)
+            entries[key] = len(output)
+            self._evict()
+
+    def _evict(self) -> None:
+        while self._size > self.max_size and len(self._entries) > 1:
+            key, size = self._entries.popitem(last=False)
+            self.logger.debug('cache evict: %s', key)
+            try:
+                self._file(key).unlink()
+            except OSError:
+                pass
+            self._size -= size
+
+    def _file(self, key: str) -> Path:
+        return self.path / key[:2] / key
+
+    def _load(self) -> OrderedDict:
+        """Lazily scan the cache dir, ordering entries by last use (oldest first)"""
+        if self._entries is None:
+            found = []
+            if self.path.is_dir():
+                for file in self.path.glob('??/*'):
+                    if file.name.endswith('.tmp'):
+                        # Left behind by a crash during put(), unless another process is writing it right now
+                        try:
+                            if file.stat().st_mtime < time.time() - 3600:
+                                file.unlink()
+                        except OSError:
+                            pass
+                        continue
+                    stat = file.stat()
+                    found.append((stat.st_mtime, file.name, stat.st_size))
+            found.sort()
+            self._entries = OrderedDict((name, size) for _, name, size in found)
+            self._size = sum(self._entries.values())
+        return self._entries
+
+
+def process_arg(arg: str) -> str:
+    return arg.replace('%site_path%', os.getcwd())
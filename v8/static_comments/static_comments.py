@@ -175,28 +175,39 @@ class StaticComments(SignalHandler):
         comment.content = self._compile_content(compiler_name, content, filename)
         return comment
 
-    def _scan_comments(self, path, file, owner):
-        """Scan comments for post."""
-        comments = {}
-        for dirpath, dirnames, filenames in os.walk(path, followlinks=True):
-            if dirpath != path:
+    def _index_comments(self, directories):
+        """Find the comment files in the given directories.
+
+        Returns a dict mapping (directory, owner file name without extension)
+        to a list of (comment file name, comment ID) pairs.
+        """
+        index = {}
+        for path in directories:
+            try:
+                entries = list(os.scandir(path))
+            except OSError:
                 continue
-            for filename in filenames:
-                if not filename.startswith(file + '.'):
-                    continue
-                rest = filename[len(file):].split('.')
-                if len(rest) != 3:
+            for entry in entries:
+                if not entry.name.endswith('.wpcomment') or entry.is_dir():
                     continue
-                if rest[0] != '' or rest[2] != 'wpcomment':
+                file, dot, comment_id = entry.name[:-len('.wpcomment')].rpartition('.')
+                if not dot:
                     continue
-                try:
-                    comment = self._read_comment(os.path.join(dirpath, filename), owner, rest[1])
-                    if comment is not None:
-                        # _LOGGER.info("Found comment '{0}' with ID {1}".format(os.path.join(dirpath, filename), comment.id))
-                        comments[comment.id] = comment
-                except ValueError as e:
-                    _LOGGER.warn("Exception '{1}' while reading file '{0}'!".format(os.path.join(dirpath, filename), e))
-                    pass
+                index.setdefault((path, file), []).append((os.path.join(path, entry.name), comment_id))
+        return index
+
+    def _scan_comments(self, filenames, owner):
+        """Read the comments for post from the given (file name, ID) pairs."""
+        comments = {}
+        for filename, comment_id in filenames:
+            try:
+                comment = self._read_comment(filename, owner, comment_id)
+                if comment is not None:
+                    # _LOGGER.info("Found comment '{0}' with ID {1}".format(filename, comment.id))
+                    comments[comment.id] = comment
+            except ValueError as e:
+                _LOGGER.warn("Exception '{1}' while reading file '{0}'!".format(filename, e))
+                pass
         return sorted(list(comments.values()), key=lambda c: c.date_utc)
 
     def _hash_post_comments(self, post):
@@ -235,12 +246,12 @@ class StaticComments(SignalHandler):
             comment.indent_change_after = node.indent_change_after
         return [node.comment for node in comment_nodes]
 
-    def _process_post_object(self, post):
-        """Add comments to a post object."""
+    def _process_post_object(self, post, index):
+        """Add comments to a post object, looking them up in the index from _index_comments()."""
         # Get all comments
         path, ext = os.path.splitext(post.source_path)
         path, file = os.path.split(path)
-        comments = self._scan_comments(path, file, post)
+        comments = self._scan_comments(index.get((path, file), []), post)
         # Add ordered comment list to post
         post.comments = self._process_comments(comments)
         # Add dependency to post
@@ -250,8 +261,10 @@ class StaticComments(SignalHandler):
     def _process_posts_and_pages(self, site):
         """Add comments to all posts."""
         if site is self.site:
+            # List every source directory once, instead of once per post.
+            index = self._index_comments(set(os.path.dirname(post.source_path) for post in site.timeline))
             for post in site.timeline:
-                self._process_post_object(post)
+                self._process_post_object(post, index)
 
     def set_site(self, site):
         """Set Nikola site object."""